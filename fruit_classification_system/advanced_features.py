@@ -3,8 +3,19 @@ import cv2
 import numpy as np
 from collections import defaultdict
 import csv
+import json
+import os
+import tempfile
+import time
 from datetime import datetime
 
+try:
+    from scipy.optimize import linear_sum_assignment
+    from scipy.spatial import cKDTree
+except ImportError:  # scipy không bắt buộc: ObjectTracker ghép tham lam, CustomKNN quét toàn bộ
+    linear_sum_assignment = None
+    cKDTree = None
+
 
 class AdvancedFeatures:
     def __init__(self):
@@ -24,99 +35,148 @@ class ObjectTracker:
         """
         Theo dõi đối tượng qua các frame
 
-        Chức năng: Gán ID persistent cho các đối tượng, đếm chính xác
+        Chức năng: Gán ID persistent cho các đối tượng, đếm chính xác.
+        Ma trận khoảng cách tính vector hóa một lần, ghép track-detection tối ưu
+        (Hungarian, tổng khoảng cách nhỏ nhất) và chỉ chấp nhận cặp trong
+        max_distance; mapping trả về lấy trực tiếp từ kết quả ghép.
         """
         self.next_object_id = 0
         self.objects = {}  # {id: centroid}
         self.disappeared = {}  # {id: số frame biến mất}
         self.max_disappeared = max_disappeared
         self.max_distance = max_distance
+        # Hàm gọi khi một ID bị hủy (vd. TrackClassificationCache.evict)
+        self.on_deregister = None
+
+    @classmethod
+    def from_config(cls, config, **overrides):
+        """Tạo tracker theo mục "tracking" của cấu hình (overrides ưu tiên)"""
+        cfg = config.get("tracking", {})
+        settings = {
+            "max_disappeared": cfg.get("max_disappeared", 15),
+            "max_distance": cfg.get("max_distance", 80),
+        }
+        settings.update({k: v for k, v in overrides.items() if v is not None})
+        return cls(**settings)
 
     def register(self, centroid):
-        """Đăng ký đối tượng mới"""
-        self.objects[self.next_object_id] = centroid
-        self.disappeared[self.next_object_id] = 0
+        """Đăng ký đối tượng mới, trả về ID"""
+        object_id = self.next_object_id
+        self.objects[object_id] = centroid
+        self.disappeared[object_id] = 0
         self.next_object_id += 1
+        return object_id
 
     def deregister(self, object_id):
         """Hủy đăng ký đối tượng"""
         del self.objects[object_id]
         del self.disappeared[object_id]
+        if self.on_deregister is not None:
+            self.on_deregister(object_id)
 
-    def update(self, detections):
+    def mark_disappeared(self, object_ids):
+        """Tăng số frame biến mất, hủy ID mất quá max_disappeared frame"""
+        for object_id in object_ids:
+            self.disappeared[object_id] += 1
+            if self.disappeared[object_id] > self.max_disappeared:
+                self.deregister(object_id)
+
+    def predict(self, object_ids, dt=1):
+        """
+        Vị trí dự kiến (N, 2) của các track ở frame hiện tại và ngưỡng ghép
+
+        Track đứng yên tại centroid cuối; ngưỡng là max_distance cho mọi track
+        """
+        positions = np.array([self.objects[i] for i in object_ids], dtype=np.float64).reshape(-1, 2)
+        return positions, self.max_distance
+
+    def correct(self, object_ids, centroids):
+        """Cập nhật các track đã ghép theo centroid đo được (K, 2)"""
+        for object_id, centroid in zip(object_ids, centroids.tolist()):
+            self.objects[object_id] = tuple(centroid)
+
+    def update(self, detections, dt=1):
         """
         Cập nhật tracker với detections mới
 
         Chức năng: Liên kết detections với các đối tượng đã biết
+        - dt: số frame kể từ lần cập nhật trước (khi bỏ qua khung, vd. governor stride)
+        Trả về mapping {object_id: detection_index} cho mọi detection
+        (đã ghép với track cũ hoặc vừa đăng ký mới)
         """
+        object_ids = list(self.objects.keys())
+        predicted, gate = self.predict(object_ids, dt)
+
         if len(detections) == 0:
             # Tăng counter cho các objects bị mất
-            for object_id in list(self.disappeared.keys()):
-                self.disappeared[object_id] += 1
-                if self.disappeared[object_id] > self.max_disappeared:
-                    self.deregister(object_id)
+            self.mark_disappeared(object_ids)
             return {}
 
-        # Nếu chưa có object nào được track
-        if len(self.objects) == 0:
-            for detection in detections:
-                centroid = self.compute_centroid(detection)
-                self.register(centroid)
-        else:
-            # Tính khoảng cách giữa objects hiện tại và detections
-            object_centroids = list(self.objects.values())
-            object_ids = list(self.objects.keys())
-
-            detection_centroids = [self.compute_centroid(d) for d in detections]
-
-            # Tính ma trận khoảng cách
-            D = self.compute_distance_matrix(object_centroids, detection_centroids)
-
-            # Gán objects tới detections gần nhất
-            used_detection_indices = set()
-            used_object_ids = set()
+        detection_centroids = self.compute_centroids(detections)
+        mapping = {}
+        matched = np.zeros(len(detections), dtype=bool)
 
-            # Sắp xếp theo khoảng cách tăng dần
-            rows, cols = D.shape
-            for _ in range(min(rows, cols)):
-                (min_row, min_col) = np.unravel_index(D.argmin(), D.shape)
+        if object_ids:
+            D = self.compute_distance_matrix(predicted, detection_centroids)
+            rows, cols = self.assign(D, gate)
 
-                if D[min_row, min_col] > self.max_distance:
-                    break
-
-                object_id = object_ids[min_row]
-                self.objects[object_id] = detection_centroids[min_col]
+            matched_ids = [object_ids[row] for row in rows.tolist()]
+            self.correct(matched_ids, detection_centroids[cols])
+            for object_id, col in zip(matched_ids, cols.tolist()):
                 self.disappeared[object_id] = 0
+                mapping[object_id] = col
+            matched[cols] = True
 
-                used_object_ids.add(object_id)
-                used_detection_indices.add(min_col)
+            # Xử lý objects không được gán
+            unmatched_rows = np.setdiff1d(np.arange(len(object_ids)), rows)
+            self.mark_disappeared([object_ids[row] for row in unmatched_rows.tolist()])
 
-                # Đặt giá trị lớn để không chọn lại
-                D[min_row, :] = np.inf
-                D[:, min_col] = np.inf
+        # Đăng ký detections mới
+        for col in np.flatnonzero(~matched).tolist():
+            mapping[self.register(tuple(detection_centroids[col].tolist()))] = col
 
-            # Xử lý objects không được gán
-            unused_object_ids = set(object_ids) - used_object_ids
-            for object_id in unused_object_ids:
-                self.disappeared[object_id] += 1
-                if self.disappeared[object_id] > self.max_disappeared:
-                    self.deregister(object_id)
-
-            # Đăng ký detections mới
-            unused_detection_indices = set(range(len(detections))) - used_detection_indices
-            for i in unused_detection_indices:
-                self.register(detection_centroids[i])
-
-        # Trả về mapping {object_id: detection_index}
-        result = {}
-        for i, detection in enumerate(detections):
-            detection_centroid = self.compute_centroid(detection)
-            for object_id, object_centroid in self.objects.items():
-                if np.linalg.norm(np.array(detection_centroid) - np.array(object_centroid)) < 5:
-                    result[object_id] = i
-                    break
+        return mapping
 
-        return result
+    @staticmethod
+    def assign(D, max_distance):
+        """
+        Ghép tối ưu hàng (track) - cột (detection) theo ma trận khoảng cách D
+
+        max_distance: một số hoặc mảng (N, 1) ngưỡng riêng cho từng track.
+        Chỉ xét các hàng (track) / cột (detection) có ít nhất một cặp nằm trong
+        ngưỡng max_distance của hàng đó; cặp ngoài ngưỡng mang chi phí lớn hơn
+        tổng mọi cặp hợp lệ nên số cặp hợp lệ được ghép luôn tối đa, rồi bị
+        loại khỏi kết quả. Không có scipy thì ghép tham lam theo khoảng cách
+        tăng dần.
+        Trả về (rows, cols): mảng chỉ số các cặp đã ghép
+        """
+        empty = np.empty(0, dtype=np.intp)
+        gate = D <= max_distance
+        row_idx = np.flatnonzero(gate.any(axis=1))
+        col_idx = np.flatnonzero(gate.any(axis=0))
+        if row_idx.size == 0:
+            return empty, empty
+
+        sub = D[np.ix_(row_idx, col_idx)]
+        sub_gate = gate[np.ix_(row_idx, col_idx)]
+        if linear_sum_assignment is not None:
+            big = float(np.max(max_distance)) * (min(sub.shape) + 1) + 1.0
+            rows, cols = linear_sum_assignment(np.where(sub_gate, sub, big))
+            keep = sub_gate[rows, cols]
+            return row_idx[rows[keep]], col_idx[cols[keep]]
+
+        # Ghép tham lam: duyệt các cặp hợp lệ theo khoảng cách tăng dần
+        cand_rows, cand_cols = np.nonzero(sub_gate)
+        order = np.argsort(sub[cand_rows, cand_cols], kind="stable")
+        used_rows = np.zeros(sub.shape[0], dtype=bool)
+        used_cols = np.zeros(sub.shape[1], dtype=bool)
+        rows, cols = [], []
+        for row, col in zip(cand_rows[order].tolist(), cand_cols[order].tolist()):
+            if not used_rows[row] and not used_cols[col]:
+                used_rows[row] = used_cols[col] = True
+                rows.append(row)
+                cols.append(col)
+        return row_idx[np.array(rows, dtype=np.intp)], col_idx[np.array(cols, dtype=np.intp)]
 
     def compute_centroid(self, detection):
         """Tính centroid của detection"""
@@ -125,13 +185,224 @@ class ObjectTracker:
             return (x + w // 2, y + h // 2)
         return (0, 0)
 
+    def compute_centroids(self, detections):
+        """Centroid của mọi detection dưới dạng mảng (M, 2)"""
+        boxes = np.array([d.get('bbox', (0, 0, 0, 0)) for d in detections], dtype=np.int64).reshape(-1, 4)
+        centroids = boxes[:, :2] + boxes[:, 2:] // 2
+        # Detection không có bbox giữ centroid (0, 0) như compute_centroid
+        missing = np.array(['bbox' not in d for d in detections])
+        centroids[missing] = 0
+        return centroids
+
     def compute_distance_matrix(self, object_centroids, detection_centroids):
-        """Tính ma trận khoảng cách Euclidean"""
-        D = np.zeros((len(object_centroids), len(detection_centroids)))
-        for i, obj_centroid in enumerate(object_centroids):
-            for j, det_centroid in enumerate(detection_centroids):
-                D[i, j] = np.linalg.norm(np.array(obj_centroid) - np.array(det_centroid))
-        return D
+        """Tính ma trận khoảng cách Euclidean (vector hóa, kích thước N x M)"""
+        a = np.asarray(object_centroids, dtype=np.float64).reshape(-1, 2)
+        b = np.asarray(detection_centroids, dtype=np.float64).reshape(-1, 2)
+        diff = a[:, None, :] - b[None, :, :]
+        return np.hypot(diff[..., 0], diff[..., 1])
+
+
+class KalmanTracker(ObjectTracker):
+    """
+    Tracker dự đoán theo mô hình vận tốc không đổi (Kalman) cho băng tải nhanh
+
+    Chức năng: Mỗi track giữ vị trí, vận tốc và hiệp phương sai (giống nhau cho
+    trục x và y nên chỉ cần 3 số). Track mới nhận vận tốc của băng tải
+    (belt_velocity, px/frame) nên ngay frame sau đã được dự đoán đúng chỗ; việc
+    ghép dùng vị trí dự đoán, ngưỡng = max_distance + gate_sigma * độ lệch
+    chuẩn dự đoán. Track mất dấu tiếp tục trôi theo vận tốc ước lượng. Dự đoán
+    và cập nhật tính vector hóa cho mọi track cùng lúc.
+    """
+
+    # Cột trong mảng trạng thái: x, y, vx, vy, P_pp, P_pv, P_vv
+    STATE_SIZE = 7
+
+    def __init__(self, max_disappeared=10, max_distance=50, belt_velocity=(0.0, 0.0),
+                 process_noise=1.0, measurement_noise=4.0, velocity_std=None, gate_sigma=3.0):
+        super().__init__(max_disappeared=max_disappeared, max_distance=max_distance)
+        self.belt_velocity = np.asarray(belt_velocity, dtype=np.float64).reshape(2)
+        self.process_noise = float(process_noise)  # phương sai gia tốc (px/frame²)²
+        self.measurement_noise = float(measurement_noise)  # phương sai vị trí đo (px²)
+        # Độ tin vận tốc băng tải ban đầu: mặc định 25% tốc độ (tối thiểu 1 px/frame)
+        if velocity_std is None:
+            velocity_std = max(1.0, 0.25 * float(np.hypot(*self.belt_velocity)))
+        self.velocity_var = float(velocity_std) ** 2
+        self.gate_sigma = float(gate_sigma)
+        self.states = {}  # {id: mảng STATE_SIZE}
+
+    @classmethod
+    def from_config(cls, config, belt_velocity=None, **overrides):
+        """
+        Tạo tracker theo mục "tracking" của cấu hình
+
+        belt_velocity mặc định lấy từ "belt_speed_px_per_frame" và "belt_direction"
+        """
+        cfg = config.get("tracking", {})
+        if belt_velocity is None:
+            belt_velocity = ConveyorBeltHandler.from_config(config).belt_velocity()
+        settings = {
+            "max_disappeared": cfg.get("max_disappeared", 15),
+            "max_distance": cfg.get("max_distance", 80),
+            "belt_velocity": belt_velocity,
+            "process_noise": cfg.get("process_noise", 1.0),
+            "measurement_noise": cfg.get("measurement_noise", 4.0),
+            "velocity_std": cfg.get("velocity_std"),
+            "gate_sigma": cfg.get("gate_sigma", 3.0),
+        }
+        settings.update({k: v for k, v in overrides.items() if v is not None})
+        return cls(**settings)
+
+    def register(self, centroid):
+        object_id = super().register(centroid)
+        state = np.empty(self.STATE_SIZE, dtype=np.float64)
+        state[0:2] = centroid
+        state[2:4] = self.belt_velocity
+        state[4:7] = (self.measurement_noise, 0.0, self.velocity_var)
+        self.states[object_id] = state
+        return object_id
+
+    def deregister(self, object_id):
+        del self.states[object_id]
+        super().deregister(object_id)
+
+    def _stack(self, object_ids):
+        if not object_ids:
+            return np.empty((0, self.STATE_SIZE), dtype=np.float64)
+        return np.stack([self.states[i] for i in object_ids])
+
+    def _unstack(self, object_ids, states):
+        for object_id, state in zip(object_ids, states):
+            self.states[object_id] = state
+            self.objects[object_id] = (int(round(state[0])), int(round(state[1])))
+
+    def predict(self, object_ids, dt=1):
+        """
+        Dự đoán mọi track tới frame hiện tại (x += v*dt, P = F P F^T + Q)
+
+        Trạng thái dự đoán được lưu lại: track không được ghép sẽ giữ nguyên nó
+        """
+        S = self._stack(object_ids)
+        if len(S):
+            dt = float(dt)
+            q = self.process_noise
+            p_pp, p_pv, p_vv = S[:, 4].copy(), S[:, 5].copy(), S[:, 6].copy()
+            S[:, 0:2] += S[:, 2:4] * dt
+            S[:, 4] = p_pp + 2.0 * dt * p_pv + dt * dt * p_vv + q * dt ** 4 / 4.0
+            S[:, 5] = p_pv + dt * p_vv + q * dt ** 3 / 2.0
+            S[:, 6] = p_vv + q * dt * dt
+            self._unstack(object_ids, S)
+        gate = self.max_distance + self.gate_sigma * np.sqrt(S[:, 4:5] + self.measurement_noise)
+        return S[:, 0:2], gate
+
+    def correct(self, object_ids, centroids):
+        """Cập nhật Kalman các track đã ghép theo centroid đo được (K, 2)"""
+        if not object_ids:
+            return
+        S = self._stack(object_ids)
+        p_pp, p_pv = S[:, 4].copy(), S[:, 5].copy()
+        innovation_var = p_pp + self.measurement_noise
+        gain_p = p_pp / innovation_var
+        gain_v = p_pv / innovation_var
+        innovation = centroids - S[:, 0:2]
+        S[:, 0:2] += gain_p[:, None] * innovation
+        S[:, 2:4] += gain_v[:, None] * innovation
+        S[:, 4] = (1.0 - gain_p) * p_pp
+        S[:, 5] = (1.0 - gain_p) * p_pv
+        S[:, 6] -= gain_v * p_pv
+        self._unstack(object_ids, S)
+
+    def velocity(self, object_id):
+        """Vận tốc ước lượng (vx, vy) px/frame của một track"""
+        return tuple(self.states[object_id][2:4].tolist())
+
+
+class TrackClassificationCache:
+    def __init__(self, tracker, confirm_frames=3, revalidate_every=0):
+        """
+        Cache đặc trưng và phân loại theo ID của ObjectTracker
+
+        Chức năng: Một quả trên băng tải nằm trong khung 20-40 frame; sau
+        confirm_frames lần liên tiếp cho cùng kết quả (size/ripeness/defect),
+        đặc trưng và phân loại được giữ cố định, các frame sau chỉ cập nhật vị trí.
+        revalidate_every > 0: phân loại lại mỗi N frame để kiểm tra. Mục cache bị
+        xóa khi tracker hủy ID.
+        """
+        self.tracker = tracker
+        self.confirm_frames = max(1, int(confirm_frames))
+        self.revalidate_every = int(revalidate_every)
+        self.entries = {}  # {id: {"features", "key", "confirmations", "frozen", "validated_at"}}
+        self.frame_index = 0
+        self.hits = 0
+        self.misses = 0
+        tracker.on_deregister = self.evict
+
+    @classmethod
+    def from_config(cls, tracker, config):
+        """Tạo cache từ mục "track_cache" của cấu hình"""
+        cfg = config.get("track_cache", {})
+        return cls(tracker, confirm_frames=cfg.get("confirm_frames", 3),
+                   revalidate_every=cfg.get("revalidate_every", 0))
+
+    def assign(self, bboxes, dt=1):
+        """
+        Cập nhật tracker với các bbox của frame hiện tại
+
+        dt: số frame kể từ lần gán trước (cho KalmanTracker dự đoán đúng khi bỏ khung)
+        Trả về list ID tracking theo thứ tự bboxes (None nếu không gán được)
+        """
+        self.frame_index += 1
+        mapping = self.tracker.update([{"bbox": bbox} for bbox in bboxes], dt=dt)
+        track_ids = [None] * len(bboxes)
+        for track_id, detection_idx in mapping.items():
+            if detection_idx < len(track_ids):
+                track_ids[detection_idx] = track_id
+        return track_ids
+
+    def lookup(self, track_id, bbox):
+        """
+        Kết quả đã xác nhận của track_id với vị trí mới bbox
+
+        Trả về bản sao dict kết quả, hoặc None nếu cần trích xuất và phân loại lại
+        (chưa đủ xác nhận hoặc đến hạn kiểm tra lại)
+        """
+        entry = self.entries.get(track_id)
+        if entry is None or not entry["frozen"]:
+            self.misses += 1
+            return None
+        if self.revalidate_every > 0 and self.frame_index - entry["validated_at"] >= self.revalidate_every:
+            self.misses += 1
+            return None
+        self.hits += 1
+        result = dict(entry["features"])
+        result["bbox"] = tuple(bbox)
+        return result
+
+    def store(self, track_id, features):
+        """Lưu kết quả vừa phân loại; cùng kết quả với lần trước thì tăng số lần xác nhận"""
+        key = (features.get("size"), features.get("ripeness"), features.get("defect"))
+        entry = self.entries.get(track_id)
+        if entry is None or entry["key"] != key:
+            # Mới hoặc đổi kết quả (kể cả khi kiểm tra lại): đếm xác nhận lại từ đầu
+            entry = {"key": key, "confirmations": 0, "frozen": False}
+            self.entries[track_id] = entry
+        entry["confirmations"] += 1
+        entry["features"] = dict(features)
+        entry["validated_at"] = self.frame_index
+        if entry["confirmations"] >= self.confirm_frames:
+            entry["frozen"] = True
+
+    def evict(self, track_id):
+        """Xóa mục cache của một ID (tracker đã hủy ID)"""
+        self.entries.pop(track_id, None)
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def reset(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
 
 
 class QualityAnalyzer:
@@ -233,78 +504,421 @@ class QualityAnalyzer:
 
 
 class CustomKNN:
-    def __init__(self, k=5):
+    # Thuật toán tìm láng giềng: "brute" (quét toàn bộ), "kd_tree" (scipy cKDTree),
+    # "auto" = kd_tree khi có scipy, số chiều <= tree_max_dims và tập huấn luyện đủ lớn,
+    # "ivf" = gần đúng qua danh sách đảo (chỉ quét n_probe cụm gần nhất)
+    ALGORITHMS = ("auto", "brute", "kd_tree", "ivf")
+    # Tham số khởi tạo được ghi vào meta.json khi save()
+    PARAMS = ("k", "algorithm", "leaf_size", "tree_max_dims", "chunk_elements", "n_lists",
+              "n_probe", "ivf_iterations", "ivf_sample", "seed", "standardize")
+    META_FILE = "meta.json"
+    FORMAT_VERSION = 1
+
+    def __init__(self, k=5, algorithm="auto", leaf_size=32, tree_max_dims=10,
+                 chunk_elements=1 << 22, n_lists=None, n_probe=8, ivf_iterations=10,
+                 ivf_sample=256, seed=0, standardize=False):
         """
         KNN classifier tự cài đặt (không dùng sklearn)
 
-        Chức năng: Phân loại dựa trên k láng giềng gần nhất
+        Chức năng: Phân loại dựa trên k láng giềng gần nhất, dự đoán theo lô:
+        khoảng cách cả lô tính bằng một phép ma trận (chia khối chunk_elements
+        phần tử để giới hạn bộ nhớ), chọn k nhỏ nhất bằng argpartition thay cho
+        sắp xếp toàn bộ. Láng giềng bằng khoảng cách xếp theo chỉ số mẫu nên
+        kết quả xác định và giống hệt cách quét từng mẫu.
+
+        Chế độ "ivf" (tập tham chiếu rất lớn): k-means chia tập huấn luyện thành
+        n_lists cụm (mặc định ~sqrt(n_samples)), mỗi truy vấn chỉ tính khoảng cách
+        tới mẫu trong n_probe cụm có tâm gần nhất. n_probe là núm chỉnh độ phủ /
+        tốc độ (n_probe = n_lists cho kết quả như "brute"); đo bằng recall_report.
+
+        standardize=True chuẩn hóa từng đặc trưng về (x - mean) / std trước khi
+        tính khoảng cách (đặc trưng mm và tỷ lệ 0..1 có trọng số ngang nhau).
+        save()/load() lưu mô hình dạng .npy + meta.json, load mặc định ánh xạ bộ
+        nhớ (mmap) nên nhiều tiến trình dùng chung một bản trên RAM.
         """
+        if algorithm not in self.ALGORITHMS:
+            raise ValueError(f"algorithm phải là một trong {self.ALGORITHMS}")
         self.k = k
+        self.algorithm = algorithm
+        self.leaf_size = leaf_size
+        self.tree_max_dims = tree_max_dims
+        self.chunk_elements = int(chunk_elements)
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.ivf_iterations = ivf_iterations
+        self.ivf_sample = ivf_sample  # số mẫu huấn luyện k-means cho mỗi cụm
+        self.seed = seed
+        self.standardize = standardize
         self.X_train = None
-        self.y_train = None
         self.feature_names = []
+        self.mean = None  # trung bình / độ lệch chuẩn từng đặc trưng (khi standardize)
+        self.std = None
+        self.classes = None  # các lớp đã sắp xếp (cột của predict_proba)
+        self._y_codes = None  # chỉ số lớp của từng mẫu huấn luyện
+        self._tree = None
+        # Danh sách đảo: tâm cụm, chỉ số mẫu xếp theo cụm, vị trí bắt đầu mỗi cụm
+        self._ivf_centroids = None
+        self._ivf_rows = None
+        self._ivf_offsets = None
+        self.last_candidates = 0  # tổng số ứng viên đã quét ở lần truy vấn "ivf" gần nhất
 
     def fit(self, X, y, feature_names=None):
         """
         Huấn luyện mô hình
 
-        X: ma trận đặc trưng (n_samples x n_features)
+        X: ma trận đặc trưng (n_samples x n_features) hoặc đường dẫn file .npy
+           (mở bằng mmap). Ma trận số thực giữ nguyên kiểu lưu (vd. float32 của
+           db_helper.export_training_set) và không bị sao chép; khoảng cách tính
+           bằng float64 theo từng khối truy vấn. standardize=True tạo một bản sao
+           đã chuẩn hóa (cùng kiểu) trong RAM; KD-tree của scipy luôn chép dữ
+           liệu float32 sang float64.
         y: nhãn (n_samples,)
         """
-        self.X_train = np.array(X)
-        self.y_train = np.array(y)
-        self.feature_names = feature_names or [f"feature_{i}" for i in range(X.shape[1])]
+        if isinstance(X, (str, os.PathLike)):
+            X = np.load(X, mmap_mode="r")
+        X = np.asarray(X)
+        if not np.issubdtype(X.dtype, np.floating):
+            X = X.astype(np.float64)
+        self.mean = self.std = None
+        if self.standardize:
+            self.mean = X.mean(axis=0, dtype=np.float64)
+            std = X.std(axis=0, dtype=np.float64)
+            # Đặc trưng hằng: giữ nguyên thang đo
+            self.std = np.where(std > 0, std, 1.0)
+            X = ((X - self.mean) / self.std).astype(X.dtype, copy=False)
+        self.X_train = X
+        self.feature_names = feature_names or [f"feature_{i}" for i in range(self.X_train.shape[1])]
+        self.classes, self._y_codes = np.unique(np.asarray(y), return_inverse=True)
+        self._build_index()
+
+    @property
+    def y_train(self):
+        """Nhãn của từng mẫu huấn luyện (giải mã từ chỉ số lớp)"""
+        if self._y_codes is None:
+            return None
+        return self.classes[self._y_codes]
+
+    def _build_index(self):
+        self._tree = None
+        self._ivf_centroids = None
+        if self.algorithm == "ivf":
+            self._build_ivf()
+        elif self._use_tree():
+            self._tree = cKDTree(self.X_train, leafsize=self.leaf_size)
+
+    def _prepare(self, X):
+        """Đưa truy vấn về ma trận float64 (n x n_features), chuẩn hóa như tập huấn luyện"""
+        X = np.array(X, dtype=np.float64).reshape(-1, self.X_train.shape[1])
+        if self.mean is not None:
+            X = (X - self.mean) / self.std
+        return X
+
+    def save(self, path):
+        """
+        Lưu mô hình đã fit vào thư mục path
 
-    def predict(self, X):
+        Chức năng: Mỗi mảng một file .npy (X_train, y_codes, scale nếu chuẩn hóa,
+        danh sách đảo nếu "ivf"), tham số/lớp/tên đặc trưng trong meta.json
         """
-        Dự đoán cho dữ liệu mới
+        if self.X_train is None:
+            raise ValueError("Mô hình chưa được fit")
+        os.makedirs(path, exist_ok=True)
+        arrays = {"X_train": self.X_train, "y_codes": self._y_codes}
+        if self.mean is not None:
+            arrays["scale"] = np.vstack([self.mean, self.std])
+        if self._ivf_centroids is not None:
+            arrays.update(ivf_centroids=self._ivf_centroids, ivf_rows=self._ivf_rows,
+                          ivf_offsets=self._ivf_offsets)
+        for name, array in arrays.items():
+            np.save(os.path.join(path, f"{name}.npy"), np.ascontiguousarray(array))
+
+        meta = {
+            "format_version": self.FORMAT_VERSION,
+            "params": {name: getattr(self, name) for name in self.PARAMS},
+            "n_samples": int(self.X_train.shape[0]),
+            "n_features": int(self.X_train.shape[1]),
+            "feature_names": list(self.feature_names),
+            "classes": self.classes.tolist(),
+            "classes_dtype": self.classes.dtype.str,
+            "arrays": sorted(arrays),
+            "saved_at": datetime.now().isoformat(),
+        }
+        with open(os.path.join(path, self.META_FILE), 'w', encoding='utf-8') as f:
+            json.dump(meta, f, indent=2, ensure_ascii=False)
 
-        Chức năng: Tìm k láng giềng gần nhất và voting
+    @classmethod
+    def load(cls, path, mmap_mode="r"):
         """
-        X = np.array(X)
-        predictions = []
+        Nạp mô hình đã save()
 
-        for sample in X:
-            # Tính khoảng cách tới tất cả training samples
-            distances = np.sqrt(np.sum((self.X_train - sample) ** 2, axis=1))
+        mmap_mode="r": các mảng được ánh xạ chỉ đọc từ file, nạp gần như tức thì
+        và các tiến trình cùng nạp dùng chung page cache; None để đọc hẳn vào RAM.
+        Chỉ KD-tree (nếu dùng) được dựng lại khi nạp.
+        """
+        with open(os.path.join(path, cls.META_FILE), encoding='utf-8') as f:
+            meta = json.load(f)
+        if meta.get("format_version") != cls.FORMAT_VERSION:
+            raise ValueError(f"Không hỗ trợ phiên bản mô hình KNN: {meta.get('format_version')}")
+
+        def array(name):
+            return np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mmap_mode)
+
+        knn = cls(**meta["params"])
+        knn.X_train = array("X_train")
+        knn._y_codes = array("y_codes")
+        knn.classes = np.array(meta["classes"], dtype=meta["classes_dtype"])
+        knn.feature_names = meta["feature_names"]
+        if "scale" in meta["arrays"]:
+            knn.mean, knn.std = array("scale")
+        if "ivf_centroids" in meta["arrays"]:
+            knn._ivf_centroids = array("ivf_centroids")
+            knn._ivf_rows = array("ivf_rows")
+            knn._ivf_offsets = array("ivf_offsets")
+        elif knn._use_tree():
+            knn._tree = cKDTree(knn.X_train, leafsize=knn.leaf_size)
+        return knn
+
+    def _use_tree(self):
+        if self.algorithm in ("brute", "ivf") or cKDTree is None:
+            return False
+        if self.algorithm == "kd_tree":
+            return True
+        n_samples, n_features = self.X_train.shape
+        return n_features <= self.tree_max_dims and n_samples >= 1024
 
-            # Tìm k láng giềng gần nhất
-            k_nearest_indices = np.argsort(distances)[:self.k]
-            k_nearest_labels = self.y_train[k_nearest_indices]
+    def _distances(self, X, rows=None):
+        """
+        Khoảng cách Euclidean (n_queries x n_train) từ X tới tập huấn luyện
 
-            # Voting
-            unique_labels, counts = np.unique(k_nearest_labels, return_counts=True)
-            predicted_label = unique_labels[np.argmax(counts)]
-            predictions.append(predicted_label)
+        Cùng phép tính với sqrt(sum((X_train - sample) ** 2)) cho từng mẫu,
+        chia khối theo số mẫu huấn luyện để mảng trung gian không quá chunk_elements
+        """
+        train = self.X_train if rows is None else self.X_train[rows]
+        n_train, n_features = train.shape
+        distances = np.empty((len(X), n_train), dtype=np.float64)
+        block = max(1, self.chunk_elements // max(1, len(X) * n_features))
+        for start in range(0, n_train, block):
+            diff = train[None, start:start + block, :] - X[:, None, :]
+            distances[:, start:start + block] = np.sqrt(np.sum(diff ** 2, axis=2))
+        return distances
+
+    @staticmethod
+    def _select_smallest(distances, k):
+        """
+        Chỉ số k phần tử nhỏ nhất mỗi hàng, xếp theo (khoảng cách, chỉ số)
 
-        return np.array(predictions)
+        argpartition tìm ngưỡng thứ k; các phần tử bằng ngưỡng được lấy theo
+        chỉ số tăng dần nên kết quả không phụ thuộc thứ tự phân hoạch
+        """
+        n_queries, n = distances.shape
+        if k >= n:
+            return np.argsort(distances, axis=1, kind="stable")
+        part = np.argpartition(distances, k - 1, axis=1)[:, k - 1]
+        kth = distances[np.arange(n_queries), part][:, None]
+        less = distances < kth
+        equal = distances == kth
+        need = k - less.sum(axis=1, keepdims=True)
+        selected = less | (equal & (np.cumsum(equal, axis=1) <= need))
+        indices = np.nonzero(selected)[1].reshape(n_queries, k)
+        order = np.argsort(np.take_along_axis(distances, indices, axis=1), axis=1, kind="stable")
+        return np.take_along_axis(indices, order, axis=1)
+
+    def kneighbors(self, X):
+        """
+        Tìm k láng giềng gần nhất cho cả lô X
 
-    def predict_proba(self, X):
+        Trả về (distances, indices), mỗi mảng (n_queries x k), xếp theo khoảng
+        cách rồi chỉ số mẫu huấn luyện
         """
-        Dự đoán xác suất cho các lớp
+        X = self._prepare(X)
+        k = min(self.k, len(self.X_train))
+        if len(X) == 0:
+            return np.empty((0, k)), np.empty((0, k), dtype=np.intp)
+        if self._ivf_centroids is not None:
+            return self._kneighbors_ivf(X, k)
+        if self._tree is not None:
+            return self._kneighbors_tree(X, k)
+        return self._kneighbors_brute(X, k)
+
+    def _kneighbors_brute(self, X, k):
+        all_distances, all_indices = [], []
+        # Chia lô truy vấn để ma trận khoảng cách không quá chunk_elements phần tử
+        batch = max(1, self.chunk_elements // len(self.X_train))
+        for start in range(0, len(X), batch):
+            distances = self._distances(X[start:start + batch])
+            indices = self._select_smallest(distances, k)
+            all_distances.append(np.take_along_axis(distances, indices, axis=1))
+            all_indices.append(indices)
+        if not all_indices:
+            return np.empty((0, k)), np.empty((0, k), dtype=np.intp)
+        return np.vstack(all_distances), np.vstack(all_indices)
+
+    def _kneighbors_tree(self, X, k):
+        """
+        Tìm láng giềng qua cKDTree, kết quả giống hệt quét toàn bộ
 
-        Chức năng: Trả về phân phối xác suất dựa trên voting của k neighbors
+        Cây cho bán kính láng giềng thứ k; truy vấn lại mọi điểm trong bán kính
+        đó (nới nhẹ sai số làm tròn) rồi tính lại khoảng cách đúng như "brute"
+        trên tập ứng viên và chọn theo (khoảng cách, chỉ số)
+        """
+        tree_distances, _ = self._tree.query(X, k=k)
+        radius = np.asarray(tree_distances, dtype=np.float64).reshape(len(X), -1)[:, -1]
+        candidates = self._tree.query_ball_point(X, radius * (1.0 + 1e-9) + 1e-12)
+
+        distances = np.empty((len(X), k), dtype=np.float64)
+        indices = np.empty((len(X), k), dtype=np.intp)
+        for i, rows in enumerate(candidates):
+            rows = np.sort(np.asarray(rows, dtype=np.intp))
+            row_distances = self._distances(X[i:i + 1], rows)
+            best = self._select_smallest(row_distances, k)[0]
+            distances[i] = row_distances[0, best]
+            indices[i] = rows[best]
+        return distances, indices
+
+    @staticmethod
+    def _nearest_centroid(data, centroids, chunk=65536):
+        """Chỉ số tâm gần nhất của từng hàng (|x|^2 - 2x.c + |c|^2, chia khối)"""
+        centroid_norms = np.einsum("ij,ij->i", centroids, centroids)
+        labels = np.empty(len(data), dtype=np.intp)
+        for start in range(0, len(data), chunk):
+            block = data[start:start + chunk]
+            labels[start:start + chunk] = np.argmin(centroid_norms - 2.0 * block @ centroids.T, axis=1)
+        return labels
+
+    def _build_ivf(self):
+        """
+        Dựng danh sách đảo: k-means (Lloyd) trên mẫu ngẫu nhiên của tập huấn
+        luyện để tìm tâm cụm, rồi gán mọi mẫu vào cụm có tâm gần nhất
+        """
+        n_samples = len(self.X_train)
+        n_lists = self.n_lists or int(round(np.sqrt(n_samples)))
+        n_lists = max(1, min(int(n_lists), n_samples))
+        rng = np.random.default_rng(self.seed)
+
+        sample_size = min(n_samples, n_lists * self.ivf_sample)
+        sample = self.X_train[rng.choice(n_samples, sample_size, replace=False)]
+        centroids = sample[rng.choice(sample_size, n_lists, replace=False)].astype(np.float64)
+        for _ in range(self.ivf_iterations):
+            labels = self._nearest_centroid(sample, centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, sample)
+            counts = np.bincount(labels, minlength=n_lists)
+            # Cụm rỗng giữ tâm cũ
+            filled = counts > 0
+            centroids[filled] = sums[filled] / counts[filled, None]
+
+        labels = self._nearest_centroid(self.X_train, centroids)
+        self._ivf_rows = np.argsort(labels, kind="stable")
+        self._ivf_offsets = np.concatenate(([0], np.cumsum(np.bincount(labels, minlength=n_lists))))
+        self._ivf_centroids = centroids
+
+    def _kneighbors_ivf(self, X, k):
         """
-        X = np.array(X)
-        probabilities = []
+        Tìm láng giềng gần đúng trong n_probe cụm có tâm gần nhất
+
+        Khoảng cách trên tập ứng viên tính đúng như "brute"; nếu n_probe cụm có
+        ít hơn k mẫu thì dò thêm cụm kế tiếp cho đủ k
+        """
+        n_lists = len(self._ivf_centroids)
+        n_probe = max(1, min(int(self.n_probe), n_lists))
+        centroid_distances = self._distances_to(X, self._ivf_centroids)
+        list_order = np.argsort(centroid_distances, axis=1, kind="stable")
+        sizes = np.diff(self._ivf_offsets)
+
+        distances = np.empty((len(X), k), dtype=np.float64)
+        indices = np.empty((len(X), k), dtype=np.intp)
+        self.last_candidates = 0
+        for i in range(len(X)):
+            order = list_order[i]
+            probe = max(n_probe, int(np.searchsorted(np.cumsum(sizes[order]), k)) + 1)
+            rows = np.sort(np.concatenate([self._ivf_rows[self._ivf_offsets[c]:self._ivf_offsets[c + 1]]
+                                           for c in order[:probe]]))
+            row_distances = self._distances(X[i:i + 1], rows)
+            best = self._select_smallest(row_distances, k)[0]
+            distances[i] = row_distances[0, best]
+            indices[i] = rows[best]
+            self.last_candidates += len(rows)
+        return distances, indices
+
+    @staticmethod
+    def _distances_to(X, points):
+        """Khoảng cách Euclidean (n_queries x n_points) tới một tập điểm nhỏ"""
+        diff = points[None, :, :] - X[:, None, :]
+        return np.sqrt(np.sum(diff ** 2, axis=2))
+
+    def recall_report(self, X, n_probes=None):
+        """
+        Đo độ phủ (recall@k) của chế độ "ivf" so với KNN chính xác
+
+        Chức năng: Với mỗi giá trị n_probe (mặc định 1, 2, 4, ... tới n_lists):
+        tỷ lệ láng giềng chính xác tìm được, tỷ lệ nhãn dự đoán trùng, số ứng
+        viên trung bình mỗi truy vấn và thời gian (ms) so với quét toàn bộ.
+        n_probe của mô hình được giữ nguyên sau khi đo.
+        """
+        if self._ivf_centroids is None:
+            raise ValueError("recall_report cần mô hình fit với algorithm='ivf'")
+        X = self._prepare(X)
+        k = min(self.k, len(self.X_train))
+        n_lists = len(self._ivf_centroids)
+        if n_probes is None:
+            n_probes = sorted({min(2 ** i, n_lists) for i in range(int(np.log2(n_lists)) + 2)})
+
+        start = time.perf_counter()
+        _, exact = self._kneighbors_brute(X, k)
+        exact_ms = (time.perf_counter() - start) * 1000.0
+        exact_labels = self._vote_labels(exact)
+
+        report = {"k": k, "n_queries": len(X), "n_lists": n_lists, "exact_ms": exact_ms, "probes": []}
+        saved_probe = self.n_probe
+        try:
+            for n_probe in n_probes:
+                self.n_probe = n_probe
+                start = time.perf_counter()
+                _, approx = self._kneighbors_ivf(X, k)
+                approx_ms = (time.perf_counter() - start) * 1000.0
+                hits = sum(len(np.intersect1d(a, e, assume_unique=True)) for a, e in zip(approx, exact))
+                report["probes"].append({
+                    "n_probe": n_probe,
+                    "recall": hits / exact.size if exact.size else 1.0,
+                    "label_agreement": float(np.mean(self._vote_labels(approx) == exact_labels)) if len(X) else 1.0,
+                    "mean_candidates": self.last_candidates / len(X) if len(X) else 0.0,
+                    "approx_ms": approx_ms,
+                    "speedup": exact_ms / approx_ms if approx_ms > 0 else 0.0,
+                })
+        finally:
+            self.n_probe = saved_probe
+        return report
 
-        # Lấy tất cả các lớp unique
-        unique_classes = np.unique(self.y_train)
+    def _vote_labels(self, indices):
+        """Nhãn thắng phiếu (hòa phiếu: lớp đứng trước theo thứ tự sắp xếp)"""
+        return self.classes[np.argmax(self._vote_counts(indices), axis=1)]
 
-        for sample in X:
-            distances = np.sqrt(np.sum((self.X_train - sample) ** 2, axis=1))
-            k_nearest_indices = np.argsort(distances)[:self.k]
-            k_nearest_labels = self.y_train[k_nearest_indices]
+    def _vote_counts(self, indices):
+        """Số phiếu (n_queries x n_classes) của các láng giềng cho từng lớp"""
+        codes = self._y_codes[indices]
+        counts = np.zeros((len(codes), len(self.classes)), dtype=np.int64)
+        np.add.at(counts, (np.arange(len(codes))[:, None], codes), 1)
+        return counts
 
-            # Tính xác suất cho mỗi lớp
-            class_probs = []
-            for cls in unique_classes:
-                prob = np.sum(k_nearest_labels == cls) / self.k
-                class_probs.append(prob)
+    def predict(self, X):
+        """
+        Dự đoán cho dữ liệu mới
 
-            probabilities.append(class_probs)
+        Chức năng: Tìm k láng giềng gần nhất và voting (hòa phiếu: lớp đứng
+        trước theo thứ tự sắp xếp)
+        """
+        _, indices = self.kneighbors(X)
+        return self._vote_labels(indices)
 
-        return np.array(probabilities)
+    def predict_proba(self, X):
+        """
+        Dự đoán xác suất cho các lớp
+
+        Chức năng: Trả về phân phối xác suất dựa trên voting của k neighbors
+        (cột theo thứ tự self.classes)
+        """
+        _, indices = self.kneighbors(X)
+        return self._vote_counts(indices) / self.k
 
     def score(self, X, y):
         """Tính accuracy trên tập test"""
@@ -313,15 +927,97 @@ class CustomKNN:
 
 
 class StatisticsManager:
-    def __init__(self):
+    # Một bản ghi chi tiết: thời điểm (epoch giây), mã nhãn kích thước/độ chín/khuyết
+    # tật (tra trong self.categories) và hai giá trị đo, 30 byte/quả thay cho một dict
+    RECORD_DTYPE = np.dtype([
+        ('timestamp', 'f8'),
+        ('size', 'i2'),
+        ('ripeness', 'i2'),
+        ('defect', 'i2'),
+        ('diameter_mm', 'f8'),
+        ('defect_ratio', 'f8'),
+    ])
+    LABEL_FIELDS = ('size', 'ripeness', 'defect')
+    CSV_FIELDS = ['timestamp', 'size', 'ripeness', 'defect', 'diameter_mm', 'defect_ratio']
+
+    def __init__(self, chunk_rows=65536, max_chunks_in_memory=16, spill_dir=None):
         """
         Quản lý thống kê và báo cáo
 
-        Chức năng: Thu thập, phân tích và xuất báo cáo
+        Chức năng: Thu thập, phân tích và xuất báo cáo. Dữ liệu chi tiết lưu theo
+        cột trong các khối mảng numpy cấp phát sẵn chunk_rows bản ghi; giữ tối đa
+        max_chunks_in_memory khối đầy trong RAM, khối cũ hơn được ghi ra .npy
+        trong spill_dir (mặc định thư mục tạm, xóa khi đối tượng bị hủy) và đọc
+        lại bằng mmap khi xuất CSV. Xu hướng chất lượng dùng tổng theo ngày nên
+        không cần quét lại dữ liệu chi tiết.
         """
         self.daily_stats = defaultdict(lambda: defaultdict(int))
-        self.session_data = []
         self.quality_trends = []
+        self.chunk_rows = max(1, int(chunk_rows))
+        self.max_chunks_in_memory = max(0, int(max_chunks_in_memory))
+        self.spill_dir = spill_dir
+        self.record_count = 0
+        # Nhãn → mã (và ngược lại) cho từng cột nhãn
+        self.categories = {field: [] for field in self.LABEL_FIELDS}
+        self._codes = {field: {} for field in self.LABEL_FIELDS}
+        # Tổng defect_ratio và số quả theo ngày cho analyze_quality_trends
+        self._daily_defect = defaultdict(lambda: [0.0, 0])
+        self._chunks = []  # khối đầy: mảng trong RAM hoặc đường dẫn .npy đã ghi ra đĩa
+        self._current = np.empty(self.chunk_rows, dtype=self.RECORD_DTYPE)
+        self._filled = 0
+        self._temp_dir = None
+
+    def _code(self, field, value):
+        codes = self._codes[field]
+        code = codes.get(value)
+        if code is None:
+            code = codes[value] = len(self.categories[field])
+            self.categories[field].append(value)
+        return code
+
+    @staticmethod
+    def _as_float(value):
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return float('nan')
+
+    def _seal_chunk(self):
+        """Chuyển khối hiện tại vào danh sách khối đầy, ghi khối cũ ra đĩa khi vượt giới hạn"""
+        self._chunks.append(self._current)
+        self._current = np.empty(self.chunk_rows, dtype=self.RECORD_DTYPE)
+        self._filled = 0
+        in_memory = [i for i, chunk in enumerate(self._chunks) if isinstance(chunk, np.ndarray)]
+        for i in in_memory[:max(0, len(in_memory) - self.max_chunks_in_memory)]:
+            self._chunks[i] = self._spill(self._chunks[i], i)
+
+    def _spill(self, chunk, index):
+        if self.spill_dir is None:
+            self._temp_dir = tempfile.TemporaryDirectory(prefix="fruit_stats_")
+            self.spill_dir = self._temp_dir.name
+        os.makedirs(self.spill_dir, exist_ok=True)
+        path = os.path.join(self.spill_dir, f"stats_chunk_{id(self):x}_{index:06d}.npy")
+        np.save(path, chunk)
+        return path
+
+    def iter_chunks(self):
+        """Các khối bản ghi theo thứ tự thời gian (khối đã ghi ra đĩa được mở bằng mmap)"""
+        for chunk in self._chunks:
+            yield np.load(chunk, mmap_mode='r') if isinstance(chunk, str) else chunk
+        if self._filled:
+            yield self._current[:self._filled]
+
+    def memory_usage(self):
+        """Số bản ghi và dung lượng (byte) của dữ liệu chi tiết trong RAM / trên đĩa"""
+        itemsize = self.RECORD_DTYPE.itemsize
+        in_memory = sum(1 for chunk in self._chunks if isinstance(chunk, np.ndarray)) + 1
+        on_disk = sum(1 for chunk in self._chunks if isinstance(chunk, str))
+        return {
+            'records': self.record_count,
+            'bytes_per_record': itemsize,
+            'memory_bytes': in_memory * self.chunk_rows * itemsize,
+            'disk_bytes': on_disk * self.chunk_rows * itemsize,
+        }
 
     def update_stats(self, results, timestamp=None):
         """
@@ -350,15 +1046,25 @@ class StatisticsManager:
             defect = result.get('defect', 'OK')
             self.daily_stats[date_key][f'defect_{defect}'] += 1
 
-            # Lưu dữ liệu chi tiết
-            self.session_data.append({
-                'timestamp': timestamp,
-                'size': size,
-                'ripeness': ripeness,
-                'defect': defect,
-                'diameter_mm': result.get('d_eq_mm', 0),
-                'defect_ratio': result.get('defect_ratio', 0)
-            })
+            # Lưu dữ liệu chi tiết (một hàng của khối cột)
+            defect_ratio = self._as_float(result.get('defect_ratio', 0))
+            self._current[self._filled] = (
+                timestamp.timestamp(),
+                self._code('size', size),
+                self._code('ripeness', ripeness),
+                self._code('defect', defect),
+                self._as_float(result.get('d_eq_mm', 0)),
+                defect_ratio,
+            )
+            self._filled += 1
+            self.record_count += 1
+            if self._filled == self.chunk_rows:
+                self._seal_chunk()
+
+            if not np.isnan(defect_ratio):
+                daily = self._daily_defect[date_key]
+                daily[0] += defect_ratio
+                daily[1] += 1
 
     def generate_daily_report(self, date=None):
         """
@@ -417,13 +1123,18 @@ class StatisticsManager:
             filename = f"fruit_classification_data_{timestamp}.csv"
 
         with open(filename, 'w', newline='', encoding='utf-8') as csvfile:
-            fieldnames = ['timestamp', 'size', 'ripeness', 'defect',
-                          'diameter_mm', 'defect_ratio']
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-
-            writer.writeheader()
-            for data in self.session_data:
-                writer.writerow(data)
+            writer = csv.writer(csvfile)
+            writer.writerow(self.CSV_FIELDS)
+            # Ghi từng khối: chỉ một khối được giải mã trong RAM tại một thời điểm
+            for chunk in self.iter_chunks():
+                labels = [np.array(self.categories[field], dtype=object)[chunk[field]]
+                          for field in self.LABEL_FIELDS]
+                writer.writerows(zip(
+                    (datetime.fromtimestamp(ts) for ts in chunk['timestamp'].tolist()),
+                    *labels,
+                    chunk['diameter_mm'].tolist(),
+                    chunk['defect_ratio'].tolist(),
+                ))
 
         print(f"Đã xuất dữ liệu ra: {filename}")
         return filename
@@ -434,20 +1145,14 @@ class StatisticsManager:
 
         Chức năng: Theo dõi thay đổi chất lượng theo thời gian
         """
-        if len(self.session_data) < 10:
+        if self.record_count < 10:
             return "Không đủ dữ liệu để phân tích xu hướng"
 
-        # Nhóm dữ liệu theo ngày
-        daily_quality = defaultdict(list)
-        for data in self.session_data:
-            date_key = data['timestamp'].strftime("%Y-%m-%d")
-            daily_quality[date_key].append(data['defect_ratio'])
-
-        # Tính trung bình defect ratio theo ngày
+        # Tính trung bình defect ratio theo ngày (tổng cộng dồn trong update_stats)
         trends = []
-        for date in sorted(daily_quality.keys())[-days:]:
-            avg_defect = np.mean(daily_quality[date])
-            trends.append({'date': date, 'avg_defect_ratio': avg_defect})
+        for date in sorted(self._daily_defect.keys())[-days:]:
+            total, count = self._daily_defect[date]
+            trends.append({'date': date, 'avg_defect_ratio': total / count})
 
         # Phân tích xu hướng
         if len(trends) >= 3:
@@ -471,13 +1176,16 @@ class StatisticsManager:
 
 
 class ConveyorBeltHandler:
-    def __init__(self, belt_speed_px_per_frame=10):
+    def __init__(self, belt_speed_px_per_frame=10, belt_direction=(1, 0)):
         """
         Xử lý băng tải di chuyển
 
         Chức năng: Theo dõi đối tượng trên băng tải, tránh đếm trùng
+        - belt_direction: hướng chạy của băng tải trong ảnh (mặc định trái → phải,
+          vùng entry → exit)
         """
         self.belt_speed = belt_speed_px_per_frame
+        self.belt_direction = belt_direction
         self.processing_zones = {
             'entry': (0, 200),  # Vùng vào
             'analysis': (200, 600),  # Vùng phân tích chính
@@ -485,6 +1193,21 @@ class ConveyorBeltHandler:
         }
         self.counted_objects = set()  # IDs đã được đếm
 
+    @classmethod
+    def from_config(cls, config):
+        """Tạo bộ xử lý theo tốc độ/hướng băng tải trong mục "tracking" của cấu hình"""
+        cfg = config.get("tracking", {})
+        return cls(belt_speed_px_per_frame=cfg.get("belt_speed_px_per_frame", 12),
+                   belt_direction=tuple(cfg.get("belt_direction", (1, 0))))
+
+    def belt_velocity(self):
+        """Vận tốc băng tải (vx, vy) px/frame theo belt_speed và belt_direction"""
+        dx, dy = self.belt_direction
+        norm = float(np.hypot(dx, dy))
+        if norm == 0:
+            return 0.0, 0.0
+        return self.belt_speed * dx / norm, self.belt_speed * dy / norm
+
     def is_in_analysis_zone(self, bbox):
         """
         Kiểm tra đối tượng có trong vùng phân tích không
@@ -517,15 +1240,32 @@ class ConveyorBeltHandler:
         """Reset bộ đếm cho session mới"""
         self.counted_objects.clear()
 
+    def roi_x_range(self, zones=None):
+        """
+        Dải x bao các vùng xử lý (mặc định: mọi vùng)
+
+        Chức năng: Làm vùng quan tâm cho FruitClassificationSystem.set_roi,
+        bỏ qua mép băng tải và máy móc ngoài các vùng; None nếu không có vùng nào
+        """
+        names = zones or list(self.processing_zones)
+        ranges = [self.processing_zones[name] for name in names if name in self.processing_zones]
+        if not ranges:
+            return None
+        return min(start for start, _ in ranges), max(end for _, end in ranges)
+
 
 class BatchProcessor:
-    def __init__(self, system):
+    def __init__(self, system, statistics=None, workers=None):
         """
         Xử lý hàng loạt ảnh/video
 
-        Chức năng: Xử lý nhiều file cùng lúc, xuất báo cáo tổng hợp
+        Chức năng: Xử lý nhiều file cùng lúc (song song nhiều tiến trình), xuất báo cáo tổng hợp
+        - statistics: StatisticsManager (tùy chọn) được cập nhật theo kết quả từng ảnh
+        - workers: số tiến trình (None = theo mục "batch" của cấu hình / số lõi CPU)
         """
         self.system = system
+        self.statistics = statistics
+        self.workers = workers
         self.batch_results = []
 
     def process_image_batch(self, image_paths, output_dir="batch_results"):
@@ -534,35 +1274,32 @@ class BatchProcessor:
 
         Chức năng: Phân loại nhiều ảnh và tạo báo cáo
         """
-        import os
+        from batch_executor import BatchExecutor
+
         os.makedirs(output_dir, exist_ok=True)
 
         batch_stats = defaultdict(int)
 
-        for i, image_path in enumerate(image_paths):
-            print(f"Đang xử lý {i + 1}/{len(image_paths)}: {image_path}")
-
-            image = cv2.imread(image_path)
-            if image is None:
-                print(f"Không thể đọc ảnh: {image_path}")
-                continue
-
-            # Xử lý ảnh
-            vis, results, mask = self.system.process_frame(image)
+        # Worker tự ghi ảnh kết quả; bản ghi trả về theo đúng thứ tự image_paths
+        with BatchExecutor.from_system(self.system, workers=self.workers, save_masks=False) as executor:
+            for i, record in enumerate(executor.run(image_paths, output_dir)):
+                image_path = record["path"]
+                print(f"Đang xử lý {i + 1}/{len(image_paths)}: {image_path}")
 
-            # Lưu kết quả
-            base_name = os.path.splitext(os.path.basename(image_path))[0]
-            output_path = os.path.join(output_dir, f"{base_name}_result.jpg")
-            cv2.imwrite(output_path, vis)
+                if record["image_size"] is None:
+                    print(f"Không thể xử lý ảnh {image_path}: {record['error']}")
+                    continue
+                results = record["results"]
 
-            # Cập nhật thống kê
-            for result in results:
-                if result:
+                # Cập nhật thống kê
+                for result in results:
                     batch_stats[f"size_{result.get('size', 'Unknown')}"] += 1
                     batch_stats[f"ripeness_{result.get('ripeness', 'Unknown')}"] += 1
                     batch_stats[f"defect_{result.get('defect', 'OK')}"] += 1
+                if self.statistics is not None and results:
+                    self.statistics.update_stats(results)
 
-            self.batch_results.extend(results)
+                self.batch_results.extend(results)
 
         # Tạo báo cáo
         self.generate_batch_report(batch_stats, output_dir)
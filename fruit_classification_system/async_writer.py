@@ -0,0 +1,148 @@
+# async_writer.py - Ghi ảnh/JSON kết quả trên luồng nền để không chặn xử lý
+import atexit
+import json
+import os
+import queue
+import threading
+
+import cv2
+
+
+class AsyncImageWriter:
+    """
+    Bộ ghi file bất đồng bộ có hàng đợi giới hạn
+
+    Chức năng: Luồng xử lý chỉ đưa ảnh/dữ liệu vào hàng đợi, các luồng nền mã hóa
+    (JPEG/PNG theo phần mở rộng) và ghi ra đĩa. Hàng đợi đầy thì submit chờ
+    (giới hạn bộ nhớ). flush() chờ ghi xong mọi việc đã gửi; close() được gọi
+    tự động khi thoát chương trình để không mất file.
+    """
+
+    def __init__(self, threads=2, queue_size=32, jpeg_quality=95, png_compression=1,
+                 save_masks=True, mask_format="jpg"):
+        self.jpeg_quality = int(jpeg_quality)
+        self.png_compression = int(png_compression)
+        self.save_masks = bool(save_masks)
+        self.mask_format = mask_format.lstrip(".").lower()
+        self.written = 0
+        self.errors = []
+
+        self._queue = queue.Queue(maxsize=max(1, int(queue_size)))
+        self._lock = threading.Lock()
+        self._closed = False
+        self._threads = []
+        for i in range(max(1, int(threads))):
+            t = threading.Thread(target=self._worker, name=f"AsyncImageWriter-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+        atexit.register(self.close)
+
+    @classmethod
+    def from_config(cls, config):
+        """Tạo bộ ghi từ mục "output" của cấu hình"""
+        cfg = config.get("output", {})
+        return cls(threads=cfg.get("writer_threads", 2),
+                   queue_size=cfg.get("queue_size", 32),
+                   jpeg_quality=cfg.get("jpeg_quality", 95),
+                   png_compression=cfg.get("png_compression", 1),
+                   save_masks=cfg.get("save_masks", True),
+                   mask_format=cfg.get("mask_format", "jpg"))
+
+    def mask_path(self, output_dir, base_name):
+        """Đường dẫn file mask theo mask_format; None nếu cấu hình không lưu mask"""
+        if not self.save_masks:
+            return None
+        return os.path.join(output_dir, f"{base_name}_mask.{self.mask_format}")
+
+    def encode_params(self, path):
+        """Tham số cv2.imwrite theo phần mở rộng của file"""
+        ext = os.path.splitext(path)[1].lower()
+        if ext in (".jpg", ".jpeg"):
+            return [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality]
+        if ext == ".png":
+            return [cv2.IMWRITE_PNG_COMPRESSION, self.png_compression]
+        return []
+
+    def write_image(self, path, image, copy=False):
+        """
+        Đưa một ảnh vào hàng đợi ghi
+
+        copy=True khi người gọi còn sửa/dùng lại mảng ảnh sau khi gửi
+        (vd. khung camera); ảnh kết quả mới tạo mỗi khung thì không cần.
+        """
+        if path is None or image is None:
+            return
+        self._put(self._write_image, path, image.copy() if copy else image)
+
+    def write_json(self, path, data):
+        """
+        Đưa dữ liệu JSON vào hàng đợi ghi
+
+        Chuỗi JSON được tạo ngay (rẻ) để người gọi có thể sửa dữ liệu sau đó;
+        chỉ việc ghi đĩa chạy nền.
+        """
+        text = json.dumps(data, indent=2, ensure_ascii=False, default=str)
+        self._put(self._write_text, path, text)
+
+    def _put(self, fn, *args):
+        if self._closed:
+            # Đã đóng (vd. đang thoát chương trình): ghi đồng bộ để không mất dữ liệu
+            self._run(fn, args)
+            return
+        self._queue.put((fn, args))
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                self._run(*item)
+            finally:
+                self._queue.task_done()
+
+    def _run(self, fn, args):
+        try:
+            fn(*args)
+            with self._lock:
+                self.written += 1
+        except Exception as e:
+            with self._lock:
+                self.errors.append((args[0], str(e)))
+            print(f"Lỗi ghi file {args[0]}: {e}")
+
+    def _write_image(self, path, image):
+        if not cv2.imwrite(path, image, self.encode_params(path)):
+            raise IOError("cv2.imwrite thất bại")
+
+    @staticmethod
+    def _write_text(path, text):
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(text)
+
+    def pending(self):
+        """Số việc đang chờ trong hàng đợi"""
+        return self._queue.qsize()
+
+    def flush(self):
+        """Chờ ghi xong mọi file đã gửi"""
+        self._queue.join()
+
+    def close(self):
+        """Ghi nốt hàng đợi rồi dừng các luồng nền (gọi nhiều lần không sao)"""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        for _ in self._threads:
+            self._queue.put(None)
+        for t in self._threads:
+            t.join()
+        atexit.unregister(self.close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
@@ -0,0 +1,214 @@
+# batch_executor.py - Xử lý hàng loạt ảnh song song bằng nhiều tiến trình
+import multiprocessing
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+
+from async_writer import AsyncImageWriter
+from main import FruitClassificationSystem
+
+# Hệ thống phân loại và bộ ghi ảnh của tiến trình worker (tạo một lần trong initializer)
+_worker_system = None
+_worker_writer = None
+
+
+def build_system(config, options):
+    """Tạo FruitClassificationSystem từ dict cấu hình và các tùy chọn runtime"""
+    system = FruitClassificationSystem(config=config)
+    if options.get("render_mode"):
+        system.set_render_mode(options["render_mode"])
+    if options.get("segmentation_scale") is not None:
+        system.set_segmentation_scale(options["segmentation_scale"])
+    if options.get("mm_per_px") is not None:
+        # Dùng lại tỷ lệ đã hiệu chuẩn ở tiến trình chính, worker không dò lại
+        system.scale_state["mm_per_px"] = options["mm_per_px"]
+    return system
+
+
+def _init_worker(config, options, cv2_threads):
+    global _worker_system, _worker_writer
+    cv2.setNumThreads(cv2_threads)
+    _worker_system = build_system(config, options)
+    _worker_writer = AsyncImageWriter.from_config(config)
+
+
+def _run_chunk(paths, output_dir, render, save_masks):
+    return process_chunk(_worker_system, _worker_writer, paths, output_dir, render, save_masks)
+
+
+def process_chunk(system, writer, paths, output_dir=None, render=True, save_masks=True):
+    """
+    Xử lý một lô ảnh bằng system.process_image_files và ghi ảnh kết quả
+
+    Ảnh kết quả/mask được ghi bởi AsyncImageWriter của worker (song song với
+    ảnh tiếp theo) và chờ ghi xong trước khi trả lô; chỉ danh sách bản ghi
+    (kết quả phân loại, đường dẫn, thời gian) được gửi về tiến trình chính.
+    """
+    records = []
+    outputs = system.process_image_files(paths, chunk_size=len(paths), render=render)
+    for path, image, output, elapsed, error in outputs:
+        record = {"path": path, "results": [], "process_time": elapsed, "error": error,
+                  "image_size": None, "result_path": None, "mask_path": None}
+        if output is not None:
+            vis, results, mask = output
+            record["results"] = [r for r in results if r is not None]
+            record["image_size"] = (image.shape[1], image.shape[0])
+            if output_dir:
+                base_name = os.path.splitext(os.path.basename(path))[0]
+                if vis is not None:
+                    record["result_path"] = os.path.join(output_dir, f"{base_name}_result.jpg")
+                    writer.write_image(record["result_path"], vis)
+                if save_masks:
+                    record["mask_path"] = writer.mask_path(output_dir, base_name)
+                    writer.write_image(record["mask_path"], mask)
+        records.append(record)
+
+    # File của lô phải có trên đĩa khi bản ghi về tới tiến trình chính
+    errors_before = len(writer.errors)
+    writer.flush()
+    if len(writer.errors) > errors_before:
+        failed = {path for path, _ in writer.errors[errors_before:]}
+        for record in records:
+            if record["result_path"] in failed or record["mask_path"] in failed:
+                record["error"] = "Lỗi ghi ảnh"
+    return records
+
+
+class BatchExecutor:
+    """
+    Bộ thực thi hàng loạt nhiều tiến trình
+
+    Chức năng: Mỗi worker tạo FruitClassificationSystem một lần, nhận từng lô
+    chunk_size ảnh và xử lý bằng process_frames. Kết quả được trả về theo đúng
+    thứ tự gửi (generator), số lô đang chờ bị giới hạn để không giữ quá nhiều
+    kết quả trong bộ nhớ. Số luồng OpenCV mỗi worker = số lõi / số worker để
+    các worker không tranh nhau lõi CPU.
+    """
+
+    def __init__(self, config, workers=None, chunk_size=8, render=True, save_masks=True,
+                 options=None, cv2_threads=None, max_pending=None):
+        cpu = os.cpu_count() or 1
+        self.config = config
+        self.workers = max(1, int(workers or cpu))
+        self.chunk_size = max(1, int(chunk_size))
+        self.render = render
+        self.save_masks = save_masks
+        self.options = dict(options or {})
+        self.cv2_threads = cv2_threads if cv2_threads is not None else max(1, cpu // self.workers)
+        self.max_pending = max_pending or self.workers * 2
+        self.elapsed_s = 0.0
+        self.processed = 0
+        self._pool = None
+        self._local_system = None
+        self._local_writer = None
+
+    @classmethod
+    def from_system(cls, system, **kwargs):
+        """
+        Tạo bộ thực thi theo mục "batch" của cấu hình và trạng thái của system
+
+        Tham số trong kwargs ghi đè cấu hình (vd. workers từ dòng lệnh)
+        """
+        batch_cfg = system.config.get("batch", {})
+        settings = {
+            "workers": batch_cfg.get("workers", 0) or None,
+            "chunk_size": batch_cfg.get("chunk_size", 8),
+            "cv2_threads": batch_cfg.get("cv2_threads"),
+        }
+        settings.update({k: v for k, v in kwargs.items() if v is not None})
+        options = {
+            "render_mode": system.render_mode,
+            "segmentation_scale": system.segmentation_scale,
+            "mm_per_px": system.scale_state.get("mm_per_px"),
+        }
+        return cls(system.config, options=options, **settings)
+
+    def _get_pool(self):
+        if self._pool is None:
+            # "spawn": tránh fork một tiến trình đã khởi tạo thread pool của OpenCV
+            ctx = multiprocessing.get_context("spawn")
+            self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=ctx,
+                                             initializer=_init_worker,
+                                             initargs=(self.config, self.options, self.cv2_threads))
+        return self._pool
+
+    def run(self, image_paths, output_dir=None):
+        """
+        Xử lý danh sách ảnh, trả về generator bản ghi theo thứ tự image_paths
+
+        Mỗi bản ghi: {"path", "results", "process_time", "error", "image_size",
+        "result_path", "mask_path"}
+        """
+        image_paths = list(image_paths)
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
+        chunks = [image_paths[i:i + self.chunk_size] for i in range(0, len(image_paths), self.chunk_size)]
+        start = time.time()
+        self.processed = 0
+        try:
+            if self.workers == 1 or len(chunks) <= 1:
+                records = self._run_local(chunks, output_dir)
+            else:
+                records = self._run_pool(chunks, output_dir)
+            for record in records:
+                self.processed += 1
+                yield record
+        finally:
+            self.elapsed_s = time.time() - start
+
+    def _run_local(self, chunks, output_dir):
+        # Một worker: xử lý ngay trong tiến trình hiện tại, không đổi số luồng OpenCV
+        if self._local_system is None:
+            self._local_system = build_system(self.config, self.options)
+            self._local_writer = AsyncImageWriter.from_config(self.config)
+        for chunk in chunks:
+            yield from process_chunk(self._local_system, self._local_writer, chunk, output_dir,
+                                     self.render, self.save_masks)
+
+    def _run_pool(self, chunks, output_dir):
+        pool = self._get_pool()
+        remaining = iter(chunks)
+        pending = deque()
+
+        def submit_next():
+            chunk = next(remaining, None)
+            if chunk is not None:
+                pending.append((chunk, pool.submit(_run_chunk, chunk, output_dir,
+                                                   self.render, self.save_masks)))
+
+        for _ in range(self.max_pending):
+            submit_next()
+
+        while pending:
+            chunk, future = pending.popleft()
+            try:
+                records = future.result()
+            except Exception as e:
+                records = [{"path": path, "results": [], "process_time": 0.0,
+                            "error": f"Lỗi worker: {e}", "image_size": None,
+                            "result_path": None, "mask_path": None} for path in chunk]
+            submit_next()
+            yield from records
+
+    def images_per_second(self):
+        return self.processed / self.elapsed_s if self.elapsed_s > 0 else 0.0
+
+    def shutdown(self):
+        """Dừng các tiến trình worker (ảnh đã gửi ghi luôn được ghi hết)"""
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+        if self._local_writer is not None:
+            self._local_writer.close()
+            self._local_writer = None
+            self._local_system = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.shutdown()
+        return False
@@ -0,0 +1,462 @@
+# benchmark.py - Đo hiệu năng process_frame trên cảnh tổng hợp (không cần camera/dữ liệu)
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import cv2
+import numpy as np
+
+from advanced_features import StatisticsManager
+from fruit_configs import FruitConfigManager
+from main import FruitClassificationSystem
+
+RESOLUTIONS = {
+    "480p": (640, 480),
+    "720p": (1280, 720),
+    "1080p": (1920, 1080),
+    "4k": (3840, 2160),
+}
+
+PRESETS = {
+    "quick": {"resolutions": ["480p", "720p"], "objects": [1, 10], "products": ["tomato"],
+              "pyramid_scales": [1.0, 0.5], "frames": 10, "warmup": 2},
+    "full": {"resolutions": list(RESOLUTIONS), "objects": [1, 10, 50, 100], "products": None,
+             "pyramid_scales": [1.0, 0.5], "frames": 30, "warmup": 3},
+    # Độ chính xác / tốc độ theo pyramid.scale
+    "pyramid": {"resolutions": ["720p", "1080p"], "objects": [10, 50], "products": ["tomato"],
+                "pyramid_scales": [1.0, 0.75, 0.5, 0.25], "frames": 10, "warmup": 3},
+}
+
+# Ngưỡng mặc định khi so sánh với baseline (tỷ lệ thay đổi cho phép)
+DEFAULT_TOLERANCE = {"fps": 0.10, "frame_ms_p95": 0.15, "peak_rss_mb": 0.20}
+
+
+class SyntheticSceneGenerator:
+    """
+    Sinh cảnh băng tải tổng hợp cho benchmark
+
+    Chức năng: Vẽ n quả hình elip (màu lấy từ tâm các khoảng hsv_ranges của cấu
+    hình, có vân sáng tối và nhiễu), đốm tối khuyết tật trên một phần số quả và
+    một đồng xu tham chiếu ở dải lề phải để bước hiệu chuẩn tìm được.
+    """
+
+    BACKGROUND_BGR = (62, 60, 58)  # nền băng tải xám, độ bão hòa thấp
+    COIN_BGR = (185, 188, 190)
+
+    def __init__(self, width, height, n_objects, config, seed=0, defect_every=3):
+        self.width = int(width)
+        self.height = int(height)
+        self.n_objects = int(n_objects)
+        self.defect_every = defect_every
+        self.rng = np.random.default_rng(seed)
+        self.colors = self._class_colors(config.get("hsv_ranges", {}))
+
+        # Đồng xu: bán kính nằm trong [min_radius_px, max_radius_px] của cấu hình
+        ref = config.get("reference_object", {})
+        r_min = int(ref.get("min_radius_px", 20)) + 2
+        r_max = int(ref.get("max_radius_px", 100)) - 2
+        self.coin_radius = int(np.clip(0.04 * min(self.width, self.height), r_min, r_max))
+        self.coin_strip = 2 * self.coin_radius + 16
+
+    @staticmethod
+    def _class_colors(hsv_ranges):
+        """Màu BGR tại tâm khoảng đầu tiên của từng lớp màu"""
+        colors = []
+        for ranges in hsv_ranges.values():
+            if not ranges:
+                continue
+            r = ranges[0]
+            hsv = np.array([[[np.mean(r["H"]), min(230, np.mean(r["S"]) + 40),
+                              min(220, np.mean(r["V"]) + 30)]]], dtype=np.float32)
+            hsv = np.clip(np.round(hsv), 0, 255).astype(np.uint8)
+            colors.append(tuple(int(c) for c in cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR)[0, 0]))
+        return colors or [(40, 40, 200)]
+
+    def layout(self):
+        """Lưới ô đặt quả (không chồng nhau) trong vùng trừ dải đồng xu"""
+        area_w = self.width - self.coin_strip
+        n = max(1, self.n_objects)
+        cols = max(1, int(np.ceil(np.sqrt(n * area_w / self.height))))
+        rows = int(np.ceil(n / cols))
+        return area_w / cols, self.height / rows, cols
+
+    def generate(self):
+        """
+        Sinh một khung BGR
+
+        Trả về (frame, truth) với truth là danh sách {"center", "axes", "defect"}
+        """
+        h, w = self.height, self.width
+        canvas = np.empty((h, w, 3), dtype=np.uint8)
+        canvas[:] = self.BACKGROUND_BGR
+
+        cell_w, cell_h, cols = self.layout()
+        base_axis = 0.36 * min(cell_w, cell_h)
+        truth = []
+        for i in range(self.n_objects):
+            row, col = divmod(i, cols)
+            cx = (col + 0.5) * cell_w + self.rng.uniform(-0.05, 0.05) * cell_w
+            cy = (row + 0.5) * cell_h + self.rng.uniform(-0.05, 0.05) * cell_h
+            a = base_axis * self.rng.uniform(0.85, 1.0)
+            b = a * self.rng.uniform(0.75, 0.95)
+            angle = self.rng.uniform(0, 180)
+            center = (int(round(cx)), int(round(cy)))
+            axes = (max(2, int(round(a))), max(2, int(round(b))))
+            color = self.colors[i % len(self.colors)]
+            cv2.ellipse(canvas, center, axes, angle, 0, 360, color, -1, cv2.LINE_AA)
+
+            defect = self.defect_every > 0 and i % self.defect_every == 0
+            if defect:
+                # Vài đốm tối (giảm mạnh độ sáng) bên trong quả
+                for _ in range(int(self.rng.integers(1, 4))):
+                    off = self.rng.uniform(-0.4, 0.4, size=2) * (axes[1], axes[1])
+                    spot_r = max(1, int(axes[1] * self.rng.uniform(0.10, 0.22)))
+                    spot = tuple(int(c * 0.35) for c in color)
+                    cv2.circle(canvas, (int(cx + off[0]), int(cy + off[1])), spot_r, spot, -1, cv2.LINE_AA)
+            truth.append({"center": center, "axes": axes, "defect": bool(defect)})
+
+        # Đồng xu tham chiếu ở dải lề phải
+        coin_center = (w - self.coin_strip // 2, h // 2)
+        cv2.circle(canvas, coin_center, self.coin_radius, self.COIN_BGR, -1, cv2.LINE_AA)
+        cv2.circle(canvas, coin_center, self.coin_radius, (120, 122, 125), 2, cv2.LINE_AA)
+
+        # Vân: trường sáng tối tần số thấp + nhiễu Gauss
+        shading = self.rng.normal(1.0, 0.06, size=(h // 32 + 2, w // 32 + 2)).astype(np.float32)
+        shading = cv2.resize(shading, (w, h), interpolation=cv2.INTER_CUBIC)
+        frame = canvas.astype(np.float32) * shading[:, :, None]
+        frame += self.rng.normal(0.0, 4.0, size=(h, w, 1)).astype(np.float32)
+        np.clip(frame, 0, 255, out=frame)
+        return frame.astype(np.uint8), truth
+
+
+def current_rss_mb():
+    """RSS hiện tại (MB) nếu có psutil, nếu không trả về đỉnh RSS của tiến trình"""
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss / (1024 * 1024)
+    except ImportError:
+        pass
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux báo KB, macOS báo byte
+        return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+    except ImportError:
+        return None
+
+
+def load_base_config(config_file):
+    """Cấu hình gốc (config.json) cung cấp các mục chung mà cấu hình sản phẩm không có"""
+    try:
+        with open(config_file, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def build_system(product_config, base_config, workdir):
+    """
+    Tạo FruitClassificationSystem từ cấu hình sản phẩm (ghi ra file tạm như GUI)
+
+    Hiệu chuẩn chạy đồng bộ trong các khung warmup, cache ghi vào workdir.
+    """
+    config = dict(base_config)
+    config.update(product_config)
+    ref = dict(base_config.get("reference_object", {}))
+    ref.update({"mode": "once", "cache_file": os.path.join(workdir, "scale_calibration.json")})
+    config["reference_object"] = ref
+    config["profiling"] = {"enabled": True, "window": 10000}
+
+    config_path = os.path.join(workdir, f"bench_{config.get('product', 'product')}.json")
+    with open(config_path, 'w', encoding='utf-8') as f:
+        json.dump(config, f, ensure_ascii=False)
+    system = FruitClassificationSystem(config_path)
+    system.set_camera_key("benchmark")
+    return system, config
+
+
+def match_truth(results, truth):
+    """
+    Ghép kết quả với quả thật của cảnh theo tâm (gần nhất, mỗi bên dùng một lần)
+
+    Một kết quả chỉ được ghép nếu tâm bbox nằm trong bán trục lớn của quả.
+    Trả về danh sách (result, truth_item) đã ghép.
+    """
+    centers = [(x + w / 2.0, y + h / 2.0) for x, y, w, h in (r["bbox"] for r in results)]
+    pairs = []
+    for j, item in enumerate(truth):
+        for i, (cx, cy) in enumerate(centers):
+            d = np.hypot(cx - item["center"][0], cy - item["center"][1])
+            if d <= max(item["axes"]):
+                pairs.append((d, i, j))
+    pairs.sort()
+    used_results, used_truth, matched = set(), set(), []
+    for _, i, j in pairs:
+        if i in used_results or j in used_truth:
+            continue
+        used_results.add(i)
+        used_truth.add(j)
+        matched.append((results[i], truth[j]))
+    return matched
+
+
+def run_case(system, scenes, frames, warmup, n_objects):
+    """
+    Chạy process_frame lần lượt trên các khung đã sinh sẵn (lặp vòng)
+
+    scenes: danh sách (frame, truth) từ SyntheticSceneGenerator.generate.
+    Trả về dict chỉ số của case: fps, phân vị ms/khung, ms/đối tượng, đỉnh RSS,
+    p50 từng bước (từ StageTimer) và độ chính xác so với truth: recall phát
+    hiện, sai số trung bình/p95 của d_eq_mm so với đường kính tương đương
+    2*sqrt(a*b) của elip đã vẽ (quy đổi bằng mm/pixel đã hiệu chuẩn).
+    """
+    for i in range(warmup):
+        system.process_frame(scenes[i % len(scenes)][0])
+    system.timer.reset()
+
+    durations = []
+    detected = []
+    n_truth = 0
+    d_errors = []
+    peak_rss = current_rss_mb()
+    for i in range(max(1, frames)):
+        frame, truth = scenes[(warmup + i) % len(scenes)]
+        t0 = time.perf_counter()
+        _, results, _ = system.process_frame(frame)
+        durations.append((time.perf_counter() - t0) * 1000.0)
+        detected.append(len(results))
+        n_truth += len(truth)
+        mm_per_px = system.scale_state["mm_per_px"] or 1.0
+        for result, item in match_truth(results, truth):
+            d_truth_mm = 2.0 * np.sqrt(item["axes"][0] * item["axes"][1]) * mm_per_px
+            d_errors.append(abs(result["d_eq_mm"] - d_truth_mm))
+        rss = current_rss_mb()
+        if rss is not None and (peak_rss is None or rss > peak_rss):
+            peak_rss = rss
+
+    durations = np.asarray(durations, dtype=np.float64)
+    mean_ms = float(durations.mean())
+    p50, p95, p99 = np.percentile(durations, (50, 95, 99)).tolist()
+    d_errors = np.asarray(d_errors, dtype=np.float64)
+    return {
+        "fps": 1000.0 / mean_ms if mean_ms > 0 else 0.0,
+        "frame_ms_mean": mean_ms,
+        "frame_ms_p50": p50,
+        "frame_ms_p95": p95,
+        "frame_ms_p99": p99,
+        "per_object_ms": mean_ms / max(1, n_objects),
+        "detected_objects": float(np.mean(detected)) if detected else 0.0,
+        "recall": d_errors.size / n_truth if n_truth else 0.0,
+        "d_eq_err_mm_mean": float(d_errors.mean()) if d_errors.size else None,
+        "d_eq_err_mm_p95": float(np.percentile(d_errors, 95)) if d_errors.size else None,
+        "peak_rss_mb": peak_rss,
+        "stage_ms_p50": {name: s["p50"] for name, s in system.timing_summary().items()},
+        "measured_frames": int(durations.size),
+    }
+
+
+def case_key(product, resolution, n_objects, pyramid_scale):
+    return f"{product}|{resolution}|n{n_objects}|s{pyramid_scale:g}"
+
+
+def run_suite(resolutions, objects, products, pyramid_scales, frames, warmup,
+              config_file="config.json", seed=0, variants=3, verbose=True):
+    """
+    Quét toàn bộ tổ hợp (sản phẩm × độ phân giải × số quả × pyramid.scale)
+
+    Mỗi case sinh sẵn `variants` khung khác nhau rồi lặp lại để đủ số khung đo.
+    """
+    manager = FruitConfigManager()
+    products = products or list(manager.configs)
+    base_config = load_base_config(config_file)
+
+    report = {
+        "meta": {
+            "created": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "machine": platform.machine(),
+            "cpu_count": os.cpu_count(),
+            "numpy": np.__version__,
+            "opencv": cv2.__version__,
+            "cv2_threads": cv2.getNumThreads(),
+            "frames": frames,
+            "warmup": warmup,
+            "seed": seed,
+        },
+        "cases": {},
+    }
+
+    with tempfile.TemporaryDirectory(prefix="fruit_bench_") as workdir:
+        for product in products:
+            product_config = manager.get_config(product)
+            if product_config is None:
+                print(f"Bỏ qua sản phẩm không có cấu hình: {product}")
+                continue
+            for res_name in resolutions:
+                width, height = RESOLUTIONS[res_name]
+                # Hệ thống mới cho mỗi độ phân giải: mm/px hiệu chuẩn lại trong warmup
+                system, config = build_system(product_config, base_config, workdir)
+                for n_objects in objects:
+                    generator = SyntheticSceneGenerator(width, height, n_objects, config, seed=seed)
+                    scenes = [generator.generate() for _ in range(max(1, variants))]
+                    for pyramid_scale in pyramid_scales:
+                        system.set_segmentation_scale(pyramid_scale)
+                        case = run_case(system, scenes, frames, warmup, n_objects)
+                        case.update({"product": product, "resolution": res_name,
+                                     "width": width, "height": height,
+                                     "objects": n_objects, "pyramid_scale": pyramid_scale})
+                        key = case_key(product, res_name, n_objects, pyramid_scale)
+                        report["cases"][key] = case
+                        if verbose:
+                            print(f"{key:<32} {case['fps']:7.1f} fps  p95 {case['frame_ms_p95']:8.2f} ms  "
+                                  f"{case['per_object_ms']:7.3f} ms/obj  det {case['detected_objects']:5.1f}  "
+                                  f"recall {case['recall']:5.3f}  d_eq err {case['d_eq_err_mm_mean'] or 0:5.2f}/"
+                                  f"{case['d_eq_err_mm_p95'] or 0:5.2f} mm  "
+                                  f"rss {case['peak_rss_mb'] or 0:7.1f} MB")
+    return report
+
+
+def compare_reports(baseline, current, tolerance=None):
+    """
+    So sánh với baseline
+
+    Trả về danh sách hồi quy: (key, chỉ số, giá trị baseline, giá trị hiện tại, % thay đổi).
+    fps giảm quá tolerance["fps"]; frame_ms_p95/peak_rss_mb tăng quá ngưỡng tương ứng.
+    """
+    tolerance = {**DEFAULT_TOLERANCE, **(tolerance or {})}
+    regressions = []
+    for key, case in current.get("cases", {}).items():
+        base = baseline.get("cases", {}).get(key)
+        if base is None:
+            continue
+        for metric, tol in tolerance.items():
+            old, new = base.get(metric), case.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            worse = change < -tol if metric == "fps" else change > tol
+            if worse:
+                regressions.append((key, metric, old, new, change * 100.0))
+    return regressions
+
+
+def legacy_record_bytes(objects_per_frame):
+    """Ước lượng byte/quả của session_data kiểu cũ (list các dict, datetime dùng chung mỗi khung)"""
+    sample = {'timestamp': datetime.now(), 'size': 'M', 'ripeness': 'Ripe', 'defect': 'OK',
+              'diameter_mm': 52.3, 'defect_ratio': 0.01}
+    return (sys.getsizeof(sample) + 2 * sys.getsizeof(52.3) + 8
+            + sys.getsizeof(sample['timestamp']) / max(1, objects_per_frame))
+
+
+def simulate_statistics_shift(hours=8.0, fps=30.0, objects_per_frame=10, seed=0):
+    """
+    Mô phỏng một ca làm việc qua StatisticsManager.update_stats
+
+    Chức năng: Gọi update_stats mỗi khung với objects_per_frame quả ngẫu nhiên,
+    đo thời gian, RSS và dung lượng dữ liệu chi tiết (RAM / đĩa), so với ước
+    lượng cho cách lưu list dict trước đây
+    """
+    rng = np.random.default_rng(seed)
+    frames = int(hours * 3600 * fps)
+    sizes, ripeness, defects = ['S', 'M', 'L', 'XL'], ['Green', 'Medium', 'Ripe'], ['OK', 'Defective']
+    manager = StatisticsManager()
+    rss_before = current_rss_mb()
+    start_time = datetime(2024, 1, 1, 6, 0, 0).timestamp()
+    started = time.perf_counter()
+    for frame in range(frames):
+        timestamp = datetime.fromtimestamp(start_time + frame / fps)
+        results = [{'size': sizes[i % 4], 'ripeness': ripeness[i % 3], 'defect': defects[1 if i % 7 == 0 else 0],
+                    'd_eq_mm': 40.0 + 30.0 * rng.random(), 'defect_ratio': 0.05 * rng.random()}
+                   for i in range(frame, frame + objects_per_frame)]
+        manager.update_stats(results, timestamp)
+    elapsed = time.perf_counter() - started
+    usage = manager.memory_usage()
+    legacy = legacy_record_bytes(objects_per_frame)
+    return {
+        'hours': hours, 'fps': fps, 'objects_per_frame': objects_per_frame,
+        'records': usage['records'],
+        'update_us_per_frame': elapsed / max(1, frames) * 1e6,
+        'columnar_bytes_per_record': usage['bytes_per_record'],
+        'columnar_memory_mb': usage['memory_bytes'] / (1024 * 1024),
+        'columnar_disk_mb': usage['disk_bytes'] / (1024 * 1024),
+        'legacy_bytes_per_record': legacy,
+        'legacy_estimate_mb': usage['records'] * legacy / (1024 * 1024),
+        'rss_before_mb': rss_before,
+        'rss_after_mb': current_rss_mb(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark process_frame trên cảnh tổng hợp")
+    parser.add_argument("--preset", choices=list(PRESETS), default="quick",
+                        help="Bộ tham số quét có sẵn")
+    parser.add_argument("--resolutions", nargs="+", choices=list(RESOLUTIONS),
+                        help="Ghi đè danh sách độ phân giải")
+    parser.add_argument("--objects", nargs="+", type=int, help="Ghi đè số quả mỗi khung")
+    parser.add_argument("--products", nargs="+", help="Ghi đè danh sách sản phẩm (mặc định: tất cả)")
+    parser.add_argument("--pyramid-scales", nargs="+", type=float, help="Ghi đè danh sách pyramid.scale")
+    parser.add_argument("--frames", type=int, help="Số khung đo mỗi case")
+    parser.add_argument("--warmup", type=int, help="Số khung chạy trước (không tính)")
+    parser.add_argument("--config", default="config.json", help="Cấu hình gốc")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="benchmark_results.json", help="File JSON kết quả")
+    parser.add_argument("--compare", help="File baseline JSON để kiểm tra hồi quy")
+    parser.add_argument("--tolerance", type=float,
+                        help="Ngưỡng chung cho mọi chỉ số (vd 0.1 = 10%%)")
+    parser.add_argument("--stats-shift", type=float, metavar="HOURS",
+                        help="Chỉ mô phỏng bộ nhớ StatisticsManager cho một ca HOURS giờ")
+    parser.add_argument("--stats-fps", type=float, default=30.0, help="FPS khi mô phỏng ca")
+    parser.add_argument("--stats-objects", type=int, default=10, help="Số quả mỗi khung khi mô phỏng ca")
+    args = parser.parse_args()
+
+    if args.stats_shift:
+        shift = simulate_statistics_shift(args.stats_shift, args.stats_fps, args.stats_objects, args.seed)
+        print(f"=== CA {shift['hours']:g} GIỜ: {shift['records']:,} bản ghi ===")
+        print(f"Cột (mới): {shift['columnar_bytes_per_record']} B/quả, RAM {shift['columnar_memory_mb']:.1f} MB, "
+              f"đĩa {shift['columnar_disk_mb']:.1f} MB")
+        print(f"List dict (cũ, ước lượng): {shift['legacy_bytes_per_record']:.0f} B/quả, "
+              f"{shift['legacy_estimate_mb']:.0f} MB")
+        rss = [f"{v:.0f}" if v is not None else "-" for v in (shift['rss_before_mb'], shift['rss_after_mb'])]
+        print(f"update_stats: {shift['update_us_per_frame']:.1f} µs/khung, RSS {rss[0]} -> {rss[1]} MB")
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({"statistics_shift": shift}, f, indent=2, ensure_ascii=False)
+        return
+
+    preset = dict(PRESETS[args.preset])
+    for name in ("resolutions", "objects", "products", "pyramid_scales", "frames", "warmup"):
+        value = getattr(args, name)
+        if value is not None:
+            preset[name] = value
+
+    report = run_suite(preset["resolutions"], preset["objects"], preset["products"],
+                       preset["pyramid_scales"], preset["frames"], preset["warmup"],
+                       config_file=args.config, seed=args.seed)
+    report["meta"]["preset"] = args.preset
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"Đã lưu kết quả benchmark: {args.output}")
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        tolerance = None
+        if args.tolerance is not None:
+            tolerance = {metric: args.tolerance for metric in DEFAULT_TOLERANCE}
+        regressions = compare_reports(baseline, report, tolerance)
+        if regressions:
+            print(f"\n=== PHÁT HIỆN {len(regressions)} HỒI QUY so với {args.compare} ===")
+            for key, metric, old, new, pct in regressions:
+                print(f"{key:<32} {metric:<14} {old:10.2f} -> {new:10.2f} ({pct:+.1f}%)")
+            sys.exit(1)
+        print(f"Không có hồi quy so với {args.compare}")
+
+
+if __name__ == "__main__":
+    main()
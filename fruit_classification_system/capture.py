@@ -0,0 +1,193 @@
+# capture.py - Luồng đọc camera riêng với bộ đệm vòng giữ khung mới nhất
+import threading
+import time
+from collections import deque
+
+import cv2
+
+
+class CapturedFrame:
+    """Một khung đọc từ camera kèm số thứ tự và thời điểm grab (time.monotonic)"""
+
+    __slots__ = ("frame", "index", "timestamp")
+
+    def __init__(self, frame, index, timestamp):
+        self.frame = frame
+        self.index = index
+        self.timestamp = timestamp
+
+    def age_ms(self, now=None):
+        """Tuổi của khung (ms) tính từ lúc grab"""
+        return ((now if now is not None else time.monotonic()) - self.timestamp) * 1000.0
+
+
+class CaptureThread:
+    """
+    Đọc camera trên luồng riêng, tách khỏi vòng lặp xử lý
+
+    Chức năng: Luồng nền gọi grab() liên tục để bộ đệm của driver không tích
+    khung cũ, gắn thời điểm grab cho từng khung và chỉ giữ buffer_size khung
+    mới nhất trong bộ đệm vòng. read() luôn trả khung mới nhất chưa lấy; các
+    khung bị ghi đè hoặc bị bỏ qua được đếm vào dropped.
+    """
+
+    def __init__(self, source=0, buffer_size=2, width=None, height=None, fps=None,
+                 backend=None, max_failures=30):
+        self.source = source
+        self.buffer_size = max(1, int(buffer_size))
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.backend = backend
+        self.max_failures = max_failures
+
+        self.grabbed = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.last_latency_ms = 0.0
+        self.stopped = False
+
+        self._cap = None
+        self._buffer = deque(maxlen=self.buffer_size)
+        self._last_read_index = -1
+        self._cond = threading.Condition()
+        self._thread = None
+        self._started_at = None
+
+    @classmethod
+    def from_config(cls, source, config, **overrides):
+        """Tạo luồng đọc theo mục "camera" của cấu hình (tham số overrides ưu tiên)"""
+        cam = config.get("camera", {})
+        settings = {
+            "buffer_size": cam.get("buffer_size", 2),
+            "width": cam.get("width"),
+            "height": cam.get("height"),
+            "fps": cam.get("fps"),
+        }
+        settings.update(overrides)
+        return cls(source, **settings)
+
+    def open(self):
+        """Mở camera (thử backend chỉ định trước, ví dụ CAP_DSHOW, rồi backend mặc định)"""
+        cap = None
+        if self.backend is not None:
+            try:
+                cap = cv2.VideoCapture(self.source, self.backend)
+            except Exception:
+                cap = None
+        if cap is None or not cap.isOpened():
+            cap = cv2.VideoCapture(self.source)
+        if not cap.isOpened():
+            return False
+
+        if self.width:
+            cap.set(cv2.CAP_PROP_FRAME_WIDTH, self.width)
+        if self.height:
+            cap.set(cv2.CAP_PROP_FRAME_HEIGHT, self.height)
+        if self.fps:
+            cap.set(cv2.CAP_PROP_FPS, self.fps)
+        # Bộ đệm driver nhỏ nhất có thể; khung cũ được bỏ ở bộ đệm vòng của ta
+        cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+        self._cap = cap
+        return True
+
+    def start(self):
+        """Mở camera và chạy luồng đọc; trả về False nếu không mở được"""
+        if self._cap is None and not self.open():
+            return False
+        self.stopped = False
+        self._started_at = time.monotonic()
+        self._thread = threading.Thread(target=self._run, name="CaptureThread", daemon=True)
+        self._thread.start()
+        return True
+
+    def _run(self):
+        failures = 0
+        while not self.stopped:
+            if not self._cap.grab():
+                failures += 1
+                if failures >= self.max_failures:
+                    break
+                time.sleep(0.005)
+                continue
+            timestamp = time.monotonic()
+            ok, frame = self._cap.retrieve()
+            if not ok or frame is None:
+                failures += 1
+                if failures >= self.max_failures:
+                    break
+                continue
+            failures = 0
+
+            with self._cond:
+                if len(self._buffer) == self.buffer_size and self._buffer[0].index > self._last_read_index:
+                    # Khung cũ nhất chưa được lấy sẽ bị ghi đè
+                    self.dropped += 1
+                self._buffer.append(CapturedFrame(frame, self.grabbed, timestamp))
+                self.grabbed += 1
+                self._cond.notify_all()
+
+        with self._cond:
+            self.stopped = True
+            self._cond.notify_all()
+
+    def read(self, timeout=2.0):
+        """
+        Lấy khung mới nhất chưa đọc (chờ tối đa timeout giây)
+
+        Trả về (ok, CapturedFrame); ok=False khi camera đã dừng hoặc hết thời gian chờ
+        """
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while not self._buffer or self._buffer[-1].index <= self._last_read_index:
+                remaining = deadline - time.monotonic()
+                if self.stopped or remaining <= 0:
+                    return False, None
+                self._cond.wait(remaining)
+
+            latest = self._buffer[-1]
+            # Các khung chưa đọc cũ hơn khung mới nhất bị bỏ qua
+            self.dropped += sum(1 for item in self._buffer
+                                if self._last_read_index < item.index < latest.index)
+            self._last_read_index = latest.index
+            self.delivered += 1
+        self.last_latency_ms = latest.age_ms()
+        return True, latest
+
+    def recent(self):
+        """Bản sao danh sách các khung đang giữ trong bộ đệm vòng (cũ → mới)"""
+        with self._cond:
+            return list(self._buffer)
+
+    def capture_fps(self):
+        if self._started_at is None:
+            return 0.0
+        elapsed = time.monotonic() - self._started_at
+        return self.grabbed / elapsed if elapsed > 0 else 0.0
+
+    def stats(self):
+        """Thống kê: số khung grab/giao/bỏ, FPS camera và độ trễ khung gần nhất"""
+        return {
+            "grabbed": self.grabbed,
+            "delivered": self.delivered,
+            "dropped": self.dropped,
+            "capture_fps": self.capture_fps(),
+            "latency_ms": self.last_latency_ms,
+        }
+
+    def stop(self):
+        """Dừng luồng đọc và giải phóng camera"""
+        self.stopped = True
+        if self._thread is not None:
+            self._thread.join(timeout=2.0)
+            self._thread = None
+        if self._cap is not None:
+            self._cap.release()
+            self._cap = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+        return False
@@ -1,14 +1,18 @@
 # complete_integration.py - Tích hợp đầy đủ tất cả các tính năng
 import cv2
 import numpy as np
-import json
 import argparse
 from datetime import datetime
 import os
 
 # Import các modules đã tạo
 from main import FruitClassificationSystem
-from advanced_features import AdvancedFeatures, ObjectTracker, StatisticsManager, ConveyorBeltHandler
+from advanced_features import (AdvancedFeatures, ObjectTracker, KalmanTracker, StatisticsManager, ConveyorBeltHandler,
+                               TrackClassificationCache)
+from async_writer import AsyncImageWriter
+from batch_executor import BatchExecutor
+from capture import CaptureThread
+from governor import LoadGovernor
 
 
 class CompleteIntegratedSystem:
@@ -20,9 +24,9 @@ class CompleteIntegratedSystem:
         """
         # Khởi tạo các thành phần chính
         self.classification_system = FruitClassificationSystem(config_file)
-        self.object_tracker = ObjectTracker(max_disappeared=15, max_distance=80)
+        self.conveyor_handler = ConveyorBeltHandler.from_config(self.classification_system.config)
+        self.object_tracker = self.create_tracker()
         self.statistics_manager = StatisticsManager()
-        self.conveyor_handler = ConveyorBeltHandler(belt_speed_px_per_frame=12)
 
         # Cấu hình mode hoạt động
         self.mode = "camera"  # "camera", "batch", "conveyor"
@@ -33,6 +37,15 @@ class CompleteIntegratedSystem:
         # Tạo thư mục output
         os.makedirs(self.output_dir, exist_ok=True)
 
+        # Ghi ảnh/JSON chụp từ camera trên luồng nền (không chặn vòng lặp xử lý)
+        self.writer = AsyncImageWriter.from_config(self.classification_system.config)
+        # Luồng đọc camera (chỉ có khi đang chạy chế độ camera)
+        self.capture = None
+        # Tự giảm chất lượng khi không kịp FPS mục tiêu (mục "governor")
+        self.governor = LoadGovernor.from_config(self.classification_system)
+        # Chỉ xử lý vùng băng tải (mục "roi")
+        self.apply_conveyor_roi()
+
         print("Đã khởi tạo hệ thống tích hợp hoàn chỉnh")
 
     def run_camera_mode(self, camera_id=0, enable_recording=False):
@@ -43,15 +56,18 @@ class CompleteIntegratedSystem:
         """
         print("=== CHẠY CHE ĐỘ CAMERA THỜI GIAN THỰC ===")
 
-        cap = cv2.VideoCapture(camera_id)
-        if not cap.isOpened():
+        # Đọc camera 1280x720@30 trên luồng riêng, xử lý luôn lấy khung mới nhất
+        self.capture = CaptureThread.from_config(camera_id, self.classification_system.config,
+                                                 width=1280, height=720, fps=30)
+        if not self.capture.start():
             print("Không thể mở camera!")
+            self.capture = None
             return
 
-        # Thiết lập camera
-        cap.set(cv2.CAP_PROP_FRAME_WIDTH, 1280)
-        cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 720)
-        cap.set(cv2.CAP_PROP_FPS, 30)
+        # Hiệu chuẩn mm/px theo camera: dùng cache nếu có, nếu không dò trên luồng nền
+        self.classification_system.set_camera_key(f"camera{camera_id}")
+        self.classification_system.set_calibration_mode("background")
+        self.setup_track_cache()
 
         # Khởi tạo ghi video nếu cần
         video_writer = None
@@ -71,13 +87,16 @@ class CompleteIntegratedSystem:
         print("- 'r': Bắt đầu/dừng ghi video")
         print("- 's': Xuất báo cáo thống kê")
         print("- 'c': Reset bộ đếm")
+        if self.classification_system.segmentation_mode() == "background":
+            print("- 'b': Học lại nền (băng tải trống)")
         print("- ESC: Thoát")
 
         try:
             while True:
-                ret, frame = cap.read()
+                ret, captured = self.capture.read()
                 if not ret:
                     break
+                frame = captured.frame
 
                 frame_count += 1
 
@@ -131,19 +150,74 @@ class CompleteIntegratedSystem:
                 elif key == ord('c'):  # C - Reset counter
                     self.reset_counters()
                     print("Đã reset bộ đếm")
+                elif key == ord('b'):  # B - Học lại nền băng tải
+                    self.classification_system.reset_background()
+                    print("Đang học lại nền, để băng tải trống")
 
         except KeyboardInterrupt:
             print("Người dùng dừng chương trình")
 
         finally:
             # Cleanup
-            cap.release()
+            print(f"Camera: {self.capture.grabbed} khung, bỏ {self.capture.dropped} khung cũ")
+            self.capture.stop()
+            self.capture = None
+            if self.governor.enabled:
+                print(f"Mức chất lượng cuối: {self.governor.format_status()} "
+                      f"({self.governor.changes} lần đổi mức)")
             if video_writer is not None:
                 video_writer.release()
             cv2.destroyAllWindows()
 
+            # Chờ ghi xong các ảnh đã chụp
+            self.writer.flush()
+
             # Xuất báo cáo cuối session
             self.export_final_report()
+            self.governor.reset()
+
+    def apply_conveyor_roi(self):
+        """
+        Đặt vùng quan tâm theo các vùng xử lý của ConveyorBeltHandler
+
+        Chức năng: Khi bật "roi.use_conveyor_zones", dải x của các vùng trong
+        "roi.zones" (cộng "margin_px") được dùng làm ROI, đa giác "roi.polygon"
+        (nếu có) vẫn áp dụng; kết quả luôn theo tọa độ khung gốc
+        """
+        roi_config = self.classification_system.config.get("roi", {})
+        if not roi_config.get("enabled", False) or not roi_config.get("use_conveyor_zones", True):
+            return
+        x_range = self.conveyor_handler.roi_x_range(roi_config.get("zones"))
+        if x_range is not None:
+            self.classification_system.set_roi(x_range=x_range)
+            print(f"ROI băng tải: x = {x_range[0]}..{x_range[1]} px")
+
+    def create_tracker(self):
+        """
+        Tạo tracker theo mục "tracking" của cấu hình
+
+        Chức năng: "motion_model": "constant_velocity" dùng KalmanTracker dự đoán vị
+        trí theo vận tốc băng tải (không mất dấu khi băng tải chạy nhanh hơn
+        max_distance mỗi frame); mặc định ghép theo centroid cuối (ObjectTracker)
+        """
+        config = self.classification_system.config
+        if config.get("tracking", {}).get("motion_model", "none") == "constant_velocity":
+            return KalmanTracker.from_config(config, belt_velocity=self.conveyor_handler.belt_velocity())
+        return ObjectTracker.from_config(config)
+
+    def setup_track_cache(self):
+        """
+        Bật cache phân loại theo ID tracking (mục "track_cache")
+
+        Chức năng: Khi bật, hệ thống phân loại tự tracking ngay sau phân đoạn và
+        không phân loại lại quả đã xác nhận; tắt khi không dùng tracking
+        """
+        cache_config = self.classification_system.config.get("track_cache", {})
+        if self.enable_tracking and cache_config.get("enabled", False):
+            cache = TrackClassificationCache.from_config(self.object_tracker, self.classification_system.config)
+            self.classification_system.set_track_cache(cache)
+        else:
+            self.classification_system.set_track_cache(None)
 
     def process_single_frame(self, frame, frame_number, enable_tracking=True):
         """
@@ -151,32 +225,33 @@ class CompleteIntegratedSystem:
 
         Chức năng: Pipeline xử lý frame tích hợp tracking và phân tích
         """
-        # 1. Phân loại cơ bản
-        vis, results, mask = self.classification_system.process_frame(frame)
+        # 1. Phân loại cơ bản (qua bộ điều tiết tải: có thể dùng lại kết quả khung trước)
+        vis, results, mask = self.governor.process(frame)
+        # Khung dùng lại kết quả cũ không có quan sát mới: không cập nhật tracking/thống kê
+        fresh = not self.governor.last_reused
 
         # 2. Object tracking (nếu bật)
         tracked_results = results
-        if enable_tracking and results:
-            object_mapping = self.object_tracker.update(results)
-
-            # Cập nhật ID tracking cho results
-            for result in tracked_results:
-                if result:
-                    # Tìm tracked ID tương ứng
-                    for tracked_id, detection_idx in object_mapping.items():
-                        if detection_idx < len(results) and results[detection_idx] == result:
-                            result['tracked_id'] = tracked_id
-                            break
-
-                    # Kiểm tra xem có nên đếm object này không (cho conveyor belt)
-                    if self.mode == "conveyor":
-                        tracked_id = result.get('tracked_id')
-                        if tracked_id and self.conveyor_handler.should_count_object(tracked_id, result['bbox']):
-                            result['should_count'] = True
+        if enable_tracking and results and fresh:
+            # Có cache tracking: ID đã được gán trong process_frame
+            if self.classification_system.track_cache is None:
+                detections = [r for r in tracked_results if r]
+                # Tracker trả về {object_id: chỉ số detection}: gán ID trực tiếp
+                # Ở mức "stride" của governor, mỗi lần cập nhật cách nhau nhiều frame
+                object_mapping = self.object_tracker.update(detections, dt=self.governor.stride)
+                for tracked_id, detection_idx in object_mapping.items():
+                    detections[detection_idx]['tracked_id'] = tracked_id
+
+            # Kiểm tra xem có nên đếm object này không (cho conveyor belt)
+            if self.mode == "conveyor":
+                for result in tracked_results:
+                    tracked_id = result.get('tracked_id') if result else None
+                    if tracked_id is not None and self.conveyor_handler.should_count_object(tracked_id, result['bbox']):
+                        result['should_count'] = True
 
         # 3. Cập nhật thống kê
         valid_results = [r for r in tracked_results if r is not None]
-        if valid_results:
+        if valid_results and fresh:
             self.statistics_manager.update_stats(valid_results)
 
         # 4. Vẽ thông tin bổ sung lên frame
@@ -230,9 +305,6 @@ class CompleteIntegratedSystem:
 
         Chức năng: Hiển thị thống kê realtime và trạng thái
         """
-        panel_width, panel_height = 250, 200
-        panel = np.zeros((panel_height, panel_width, 3), dtype=np.uint8)
-
         # Lấy thống kê hiện tại
         today = datetime.now().strftime("%Y-%m-%d")
         stats = self.statistics_manager.daily_stats.get(today, {})
@@ -251,6 +323,39 @@ class CompleteIntegratedSystem:
             f"Defects: {defective_count}",
             f"Quality: {((total_processed - defective_count) / max(1, total_processed) * 100):.1f}%",
             f"Tracking: {'ON' if self.enable_tracking else 'OFF'}",
+        ]
+
+        # Mức chất lượng đang áp dụng của bộ điều tiết tải
+        if self.governor.enabled:
+            info_lines.append(self.governor.format_status())
+        # Tỷ lệ quả dùng lại phân loại đã xác nhận (cache tracking)
+        track_cache = self.classification_system.track_cache
+        if track_cache is not None:
+            info_lines.append(f"Cache: {track_cache.hit_rate() * 100:.0f}% hit, {len(track_cache.entries)} IDs")
+        # Tiến độ học nền (chế độ phân đoạn "background")
+        if self.classification_system.segmentation_mode() == "background":
+            background = self.classification_system.get_background_model()
+            if not background.ready:
+                info_lines.append(f"BG learn {background.learned}/{background.learn_frames}")
+        # Tỷ lệ khung bỏ qua vì cảnh không đổi (băng tải trống/dừng)
+        if self.governor.motion_gate is not None:
+            info_lines.append(self.governor.motion_gate.format_status())
+
+        # Độ trễ từ lúc grab và số khung bỏ của luồng đọc camera
+        if self.capture is not None:
+            info_lines.append(f"Cam: {self.capture.last_latency_ms:.0f} ms, drop {self.capture.dropped}")
+
+        # Thời gian xử lý theo bước (p50/p95, ms) khi bật profiling
+        timer = self.classification_system.timer
+        if timer.enabled:
+            timing = timer.summary()
+            total = timing.get("total")
+            if total is not None:
+                info_lines.append(f"Time p50/p95: {total['p50']:.1f}/{total['p95']:.1f} ms")
+                for name, ms in timer.top_stages(3):
+                    info_lines.append(f"  {name}: {ms:.1f} ms")
+
+        info_lines += [
             "",
             "Controls:",
             "SPACE: Save",
@@ -258,6 +363,9 @@ class CompleteIntegratedSystem:
             "ESC: Exit"
         ]
 
+        panel_width, panel_height = 250, max(200, 20 + len(info_lines) * 15)
+        panel = np.zeros((panel_height, panel_width, 3), dtype=np.uint8)
+
         for i, line in enumerate(info_lines):
             color = (255, 255, 255)
             if line.startswith("Quality:"):
@@ -271,6 +379,12 @@ class CompleteIntegratedSystem:
                     color = (0, 0, 255)  # Đỏ - kém
             elif line.startswith("Tracking:"):
                 color = (0, 255, 0) if self.enable_tracking else (128, 128, 128)
+            elif line.startswith("Time") or line.startswith("  "):
+                color = (200, 200, 0)
+            elif line.startswith("Q") and line[1:2].isdigit():
+                # Xanh lá: đầy đủ, vàng: đã giảm nhẹ, đỏ: giảm mạnh (bỏ khung/chỉ khung)
+                level = self.governor.level
+                color = (0, 255, 0) if level == 0 else (0, 255, 255) if level < 4 else (0, 0, 255)
 
             cv2.putText(panel, line, (10, 20 + i * 15),
                         cv2.FONT_HERSHEY_SIMPLEX, 0.4, color, 1)
@@ -289,30 +403,31 @@ class CompleteIntegratedSystem:
         original_path = os.path.join(self.output_dir, f"original_{timestamp}.jpg")
         result_path = os.path.join(self.output_dir, f"result_{timestamp}.jpg")
 
-        cv2.imwrite(original_path, original_frame)
-        cv2.imwrite(result_path, processed_frame)
+        self.writer.write_image(original_path, original_frame, copy=True)
+        self.writer.write_image(result_path, processed_frame, copy=True)
 
         # Lưu dữ liệu JSON
         data_path = os.path.join(self.output_dir, f"data_{timestamp}.json")
-        with open(data_path, 'w', encoding='utf-8') as f:
-            json.dump({
-                'timestamp': timestamp,
-                'results': results,
-                'total_objects': len([r for r in results if r is not None]),
-                'frame_info': {
-                    'original_image': original_path,
-                    'processed_image': result_path
-                }
-            }, f, indent=2, ensure_ascii=False, default=str)
+        self.writer.write_json(data_path, {
+            'timestamp': timestamp,
+            'results': results,
+            'total_objects': len([r for r in results if r is not None]),
+            'frame_info': {
+                'original_image': original_path,
+                'processed_image': result_path
+            }
+        })
 
         print(f"Đã lưu kết quả: {timestamp}")
         return timestamp
 
-    def run_batch_mode(self, input_dir, file_pattern="*.jpg"):
+    def run_batch_mode(self, input_dir, file_pattern="*.jpg", workers=None):
         """
         Chế độ xử lý hàng loạt
 
-        Chức năng: Xử lý nhiều ảnh cùng lúc và tạo báo cáo tổng hợp
+        Chức năng: Xử lý nhiều ảnh song song trên nhiều tiến trình (BatchExecutor)
+        và tạo báo cáo tổng hợp
+        - workers: số tiến trình (None = theo mục "batch" của cấu hình / số lõi CPU)
         """
         import glob
 
@@ -335,29 +450,24 @@ class CompleteIntegratedSystem:
         batch_results = []
         processed_count = 0
 
-        for i, image_path in enumerate(image_files):
-            print(f"Xử lý {i + 1}/{len(image_files)}: {os.path.basename(image_path)}")
-
-            # Đọc ảnh
-            image = cv2.imread(image_path)
-            if image is None:
-                print(f"  Không thể đọc ảnh: {image_path}")
-                continue
-
-            try:
-                # Xử lý ảnh
-                vis, results, mask = self.classification_system.process_frame(image)
+        # Worker xử lý theo lô và tự ghi ảnh kết quả/mask; kết quả về theo đúng thứ tự ảnh
+        executor = BatchExecutor.from_system(self.classification_system, workers=workers)
+        print(f"Worker: {executor.workers} tiến trình x {executor.cv2_threads} luồng OpenCV, "
+              f"lô {executor.chunk_size} ảnh")
 
-                # Lưu kết quả
-                base_name = os.path.splitext(os.path.basename(image_path))[0]
-                result_path = os.path.join(batch_output, f"{base_name}_result.jpg")
-                mask_path = os.path.join(batch_output, f"{base_name}_mask.jpg")
+        with executor:
+            for i, record in enumerate(executor.run(image_files, batch_output)):
+                image_path = record["path"]
+                print(f"Xử lý {i + 1}/{len(image_files)}: {os.path.basename(image_path)}")
 
-                cv2.imwrite(result_path, vis)
-                cv2.imwrite(mask_path, mask)
+                if record["image_size"] is None:
+                    print(f"  Lỗi xử lý {image_path}: {record['error']}")
+                    continue
+                if record["error"]:
+                    print(f"  Cảnh báo {image_path}: {record['error']}")
 
                 # Thu thập kết quả
-                valid_results = [r for r in results if r is not None]
+                valid_results = record["results"]
                 batch_results.extend(valid_results)
 
                 # Cập nhật thống kê
@@ -367,17 +477,15 @@ class CompleteIntegratedSystem:
                 processed_count += 1
                 print(f"  Tìm thấy {len(valid_results)} đối tượng")
 
-            except Exception as e:
-                print(f"  Lỗi xử lý {image_path}: {e}")
-                continue
-
         # Tạo báo cáo batch
-        self.create_batch_report(batch_results, batch_output, processed_count)
+        self.create_batch_report(batch_results, batch_output, processed_count,
+                                 elapsed_s=executor.elapsed_s, workers=executor.workers)
 
-        print(f"Hoàn thành! Xử lý {processed_count}/{len(image_files)} ảnh")
+        print(f"Hoàn thành! Xử lý {processed_count}/{len(image_files)} ảnh "
+              f"({executor.images_per_second():.1f} ảnh/giây)")
         print(f"Kết quả lưu trong: {batch_output}")
 
-    def create_batch_report(self, results, output_dir, image_count):
+    def create_batch_report(self, results, output_dir, image_count, elapsed_s=None, workers=None):
         """
         Tạo báo cáo chi tiết cho batch processing
 
@@ -437,6 +545,11 @@ PHÂN LOẠI KÍCH THƯỚC:
                 report += f"- Số lượng khuyết tật nhẹ: {sum(1 for r in defect_ratios if 0.05 <= r < 0.1)}\n"
                 report += f"- Số lượng khuyết tật nặng: {sum(1 for r in defect_ratios if r >= 0.1)}\n"
 
+        if elapsed_s:
+            report += "\nHIỆU NĂNG:\n"
+            report += f"- Số tiến trình worker: {workers or 1}\n"
+            report += f"- Thời gian xử lý: {elapsed_s:.1f}s ({image_count / elapsed_s:.2f} ảnh/giây)\n"
+
         # Lưu báo cáo
         report_path = os.path.join(output_dir, "batch_report.txt")
         with open(report_path, 'w', encoding='utf-8') as f:
@@ -496,7 +609,8 @@ PHÂN LOẠI KÍCH THƯỚC:
         """
         self.statistics_manager = StatisticsManager()
         self.conveyor_handler.reset_counting()
-        self.object_tracker = ObjectTracker(max_disappeared=15, max_distance=80)
+        self.object_tracker = self.create_tracker()
+        self.setup_track_cache()
         print("Đã reset tất cả bộ đếm")
 
     def export_statistics(self):
@@ -547,10 +661,19 @@ Tỷ lệ khuyết tật hiện tại: {quality_trends.get('current_avg', 0) * 1
 
 CẤU HÌNH HỆ THỐNG:
 - Tracking: {'Bật' if self.enable_tracking else 'Tắt'}
+- Điều tiết tải: {self.governor.format_status() if self.governor.enabled else 'Tắt'}
+- Bỏ khung tĩnh: {f"{self.governor.motion_gate.skipped_fraction() * 100:.1f}% khung" if self.governor.motion_gate else 'Tắt'}
 - Phân tích chất lượng: {'Bật' if self.enable_quality_analysis else 'Tắt'}
 - Thư mục output: {self.output_dir}
 """
 
+        # Thời gian xử lý theo bước (nếu bật profiling)
+        timing = self.classification_system.timing_summary()
+        if timing:
+            final_report += "\nTHỜI GIAN XỬ LÝ (ms, p50/p95/p99):\n"
+            for name, t in timing.items():
+                final_report += f"- {name}: {t['p50']:.2f} / {t['p95']:.2f} / {t['p99']:.2f}\n"
+
         # Lưu báo cáo cuối
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         final_report_path = os.path.join(self.output_dir, f"final_report_{timestamp}.txt")
@@ -584,6 +707,12 @@ def main():
                         help="Bật ghi video")
     parser.add_argument("--disable-tracking", action="store_true",
                         help="Tắt object tracking")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Số tiến trình xử lý hàng loạt (mặc định: theo cấu hình/số lõi CPU)")
+    parser.add_argument("--profile", action="store_true",
+                        help="Đo thời gian từng bước xử lý (p50/p95/p99)")
+    parser.add_argument("--target-fps", type=float, default=None,
+                        help="Bật điều tiết tải: tự giảm chất lượng để giữ FPS này")
 
     args = parser.parse_args()
 
@@ -591,6 +720,11 @@ def main():
     system = CompleteIntegratedSystem(args.config)
     system.output_dir = args.output_dir
     system.enable_tracking = not args.disable_tracking
+    if args.profile:
+        system.classification_system.set_profiling(True)
+    if args.target_fps:
+        system.governor = LoadGovernor.from_config(system.classification_system,
+                                                   enabled=True, target_fps=args.target_fps)
 
     print(f"Khởi động hệ thống với mode: {args.mode}")
     print(f"Cấu hình: {args.config}")
@@ -601,7 +735,7 @@ def main():
         if args.mode == "camera":
             system.run_camera_mode(args.camera_id, args.enable_recording)
         elif args.mode == "batch":
-            system.run_batch_mode(args.input_dir)
+            system.run_batch_mode(args.input_dir, workers=args.workers)
         elif args.mode == "conveyor":
             system.run_conveyor_mode(args.camera_id)
     except KeyboardInterrupt:
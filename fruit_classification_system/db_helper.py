@@ -1,6 +1,9 @@
 import json
-from typing import Any, Dict, Optional
+import os
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional, Sequence
 
+import numpy as np
 import pymysql
 
 
@@ -24,7 +27,10 @@ class MySQLConnectionManager:
             autocommit=True,
         )
 
-    def cursor(self):
+    def cursor(self, streaming: bool = False):
+        """Return a dict cursor; streaming=True gives an unbuffered server-side cursor."""
+        if streaming:
+            return self._connection.cursor(pymysql.cursors.SSDictCursor)
         return self._connection.cursor()
 
     def close(self):
@@ -159,6 +165,234 @@ def fetch_classifications_by_capture(db: MySQLConnectionManager, capture_id: int
         cur.execute(sql, (int(capture_id),))
         return cur.fetchall()
 
+# Numeric classification columns exported ahead of the JSON features
+TRAINING_COLUMNS = (
+    "defect_area_ratio",
+    "color_ratio_red",
+    "color_ratio_green",
+    "a_star_value",
+    "b_star_value",
+)
+# Top-level numeric keys of `extra`, then numeric keys of `extra.raw`
+EXTRA_FEATURE_KEYS = ("d_eq_mm", "area_px", "circularity")
+RAW_SKIP_KEYS = {"id", "tracked_id"}
+LABEL_COLUMNS = ("size_label", "ripeness_label", "defect_detected")
+
+
+def _classification_filter(product: Optional[str], start_after: int, max_id: Optional[int]):
+    clauses = ["c.id > %s"]
+    params: List[Any] = [int(start_after)]
+    if max_id is not None:
+        clauses.append("c.id <= %s")
+        params.append(int(max_id))
+    join_sql = ""
+    if product:
+        join_sql = "JOIN products p ON c.product_id = p.id "
+        clauses.append("p.name = %s")
+        params.append(product)
+    return join_sql, "WHERE " + " AND ".join(clauses), params
+
+
+def classification_snapshot(db: MySQLConnectionManager, product: Optional[str] = None, start_after: int = 0):
+    """Row count and highest id of the classifications to export (upper bound for a stable export)."""
+    join_sql, where_sql, params = _classification_filter(product, start_after, None)
+    sql = f"SELECT COUNT(1) AS n, MAX(c.id) AS max_id FROM classifications c {join_sql}{where_sql}"
+    with db.cursor() as cur:
+        cur.execute(sql, tuple(params))
+        row = cur.fetchone()
+    return int(row["n"] or 0), (int(row["max_id"]) if row["max_id"] is not None else None)
+
+
+def iter_classification_batches(
+    db: MySQLConnectionManager,
+    batch_size: int = 5000,
+    product: Optional[str] = None,
+    start_after: int = 0,
+    max_id: Optional[int] = None,
+    columns: Sequence[str] = TRAINING_COLUMNS + LABEL_COLUMNS + ("extra",),
+) -> Iterator[List[Dict[str, Any]]]:
+    """Yield classification rows in id order, at most `batch_size` per list.
+
+    Keyset pagination (`c.id > last_id ORDER BY c.id LIMIT n`) keeps every page
+    an index range scan, and each page is read through a server-side cursor, so
+    memory is bounded by one batch regardless of table size. `extra` is decoded.
+    """
+    select_sql = ", ".join(["c.id"] + [f"c.{name}" for name in columns])
+    last_id = int(start_after)
+    while True:
+        join_sql, where_sql, params = _classification_filter(product, last_id, max_id)
+        sql = f"SELECT {select_sql} FROM classifications c {join_sql}{where_sql} ORDER BY c.id LIMIT %s"
+        params.append(int(batch_size))
+        with db.cursor(streaming=True) as cur:
+            cur.execute(sql, tuple(params))
+            batch = list(cur.fetchall_unbuffered())
+        if not batch:
+            return
+        for row in batch:
+            if "extra" in row:
+                row["extra"] = _decode_extra(row["extra"])
+        last_id = int(batch[-1]["id"])
+        yield batch
+        if len(batch) < batch_size:
+            return
+
+
+def _decode_extra(value) -> Dict[str, Any]:
+    if value is None:
+        return {}
+    if isinstance(value, (bytes, bytearray)):
+        value = value.decode("utf-8")
+    if isinstance(value, str):
+        try:
+            value = json.loads(value)
+        except ValueError:
+            return {}
+    return value if isinstance(value, dict) else {}
+
+
+def _as_float(value) -> Optional[float]:
+    if value is None or isinstance(value, bool):
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _raw_numeric_keys(extra: Dict[str, Any]) -> List[str]:
+    raw = extra.get("raw")
+    if not isinstance(raw, dict):
+        return []
+    return [key for key, value in raw.items()
+            if key not in RAW_SKIP_KEYS and key not in EXTRA_FEATURE_KEYS and _as_float(value) is not None]
+
+
+def discover_feature_names(
+    db: MySQLConnectionManager,
+    product: Optional[str] = None,
+    batch_size: int = 5000,
+    max_id: Optional[int] = None,
+) -> List[str]:
+    """Feature layout for `export_training_set`: fixed columns plus every numeric `raw.*` key seen."""
+    raw_keys = set()
+    for batch in iter_classification_batches(db, batch_size, product, max_id=max_id, columns=("extra",)):
+        for row in batch:
+            raw_keys.update(_raw_numeric_keys(row["extra"]))
+    return list(TRAINING_COLUMNS) + list(EXTRA_FEATURE_KEYS) + [f"raw.{key}" for key in sorted(raw_keys)]
+
+
+def flatten_classification(row: Dict[str, Any], feature_names: Sequence[str], out: np.ndarray) -> None:
+    """Write one row's features into `out` (float32 view); missing values are left untouched."""
+    extra = row.get("extra") or {}
+    raw = extra.get("raw") if isinstance(extra.get("raw"), dict) else {}
+    for i, name in enumerate(feature_names):
+        if name.startswith("raw."):
+            value = raw.get(name[4:])
+        elif name in row:
+            value = row[name]
+        else:
+            value = extra.get(name, raw.get(name))
+        value = _as_float(value)
+        if value is not None:
+            out[i] = value
+
+
+def classification_label(row: Dict[str, Any], label_columns: Sequence[str]) -> Optional[str]:
+    """Class name from label columns, e.g. ("ripeness_label", "size_label") -> "Ripe_M"."""
+    parts = []
+    for name in label_columns:
+        value = row.get(name)
+        if value is None or value == "":
+            return None
+        if name == "defect_detected":
+            value = "Defective" if int(value) else "Good"
+        parts.append(str(value))
+    return "_".join(parts)
+
+
+def export_training_set(
+    db: MySQLConnectionManager,
+    out_dir: str,
+    product: Optional[str] = None,
+    feature_names: Optional[Sequence[str]] = None,
+    label_columns: Sequence[str] = ("ripeness_label", "size_label"),
+    batch_size: int = 5000,
+    fill_value: float = float("nan"),
+) -> Dict[str, Any]:
+    """Stream classifications into `.npy` training files without holding the table in memory.
+
+    A COUNT/MAX(id) snapshot fixes the rows to export and sizes the output;
+    rows are then paged with `iter_classification_batches` and written straight
+    into memory-mapped arrays:
+
+    - features.npy: float32 (n_rows x n_features), missing values = fill_value
+    - labels.npy: int32 class codes (-1 = unlabeled), names in meta.json "classes"
+    - ids.npy: int64 classification ids
+    - meta.json: feature_names, classes, label_columns, n_rows, max_id, product
+
+    Rows deleted after the snapshot leave zero-filled rows past "n_rows";
+    `load_training_set` trims them. Use fill_value=0.0 (or drop NaN rows)
+    before `CustomKNN.fit`, which needs complete vectors.
+    """
+    total, max_id = classification_snapshot(db, product)
+    if feature_names is None:
+        feature_names = discover_feature_names(db, product, batch_size, max_id=max_id) if total else []
+    feature_names = list(feature_names)
+
+    os.makedirs(out_dir, exist_ok=True)
+    shape = (total, len(feature_names))
+    features = np.lib.format.open_memmap(os.path.join(out_dir, "features.npy"), mode="w+",
+                                         dtype=np.float32, shape=shape)
+    labels = np.lib.format.open_memmap(os.path.join(out_dir, "labels.npy"), mode="w+",
+                                       dtype=np.int32, shape=(total,))
+    ids = np.lib.format.open_memmap(os.path.join(out_dir, "ids.npy"), mode="w+",
+                                    dtype=np.int64, shape=(total,))
+
+    classes: Dict[str, int] = {}
+    written = 0
+    if total:
+        for batch in iter_classification_batches(db, batch_size, product, max_id=max_id):
+            # The snapshot bounds ids, but rows may still be inserted below max_id by concurrent writers
+            batch = batch[:total - written]
+            block = np.full((len(batch), len(feature_names)), fill_value, dtype=np.float32)
+            for i, row in enumerate(batch):
+                flatten_classification(row, feature_names, block[i])
+                label = classification_label(row, label_columns)
+                labels[written + i] = -1 if label is None else classes.setdefault(label, len(classes))
+                ids[written + i] = int(row["id"])
+            features[written:written + len(batch)] = block
+            written += len(batch)
+            if written >= total:
+                break
+
+    for array in (features, labels, ids):
+        array.flush()
+    del features, labels, ids
+
+    meta = {
+        "feature_names": feature_names,
+        "classes": list(classes),
+        "label_columns": list(label_columns),
+        "n_rows": written,
+        "max_id": max_id,
+        "product": product,
+        "exported_at": datetime.now().isoformat(),
+    }
+    with open(os.path.join(out_dir, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump(meta, f, indent=2, ensure_ascii=False)
+    return meta
+
+
+def load_training_set(out_dir: str, mmap_mode: Optional[str] = "r"):
+    """Open an exported training set: (features, label_codes, meta), trimmed to meta["n_rows"]."""
+    with open(os.path.join(out_dir, "meta.json"), "r", encoding="utf-8") as f:
+        meta = json.load(f)
+    n_rows = meta["n_rows"]
+    features = np.load(os.path.join(out_dir, "features.npy"), mmap_mode=mmap_mode)[:n_rows]
+    labels = np.load(os.path.join(out_dir, "labels.npy"), mmap_mode=mmap_mode)[:n_rows]
+    return features, labels, meta
+
+
 if __name__ == "__main__":
     cfg = load_config()
     db = MySQLConnectionManager(cfg)
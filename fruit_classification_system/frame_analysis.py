@@ -0,0 +1,691 @@
+# frame_analysis.py - Các thành phần phân tích dùng chung cho mỗi khung hình
+import json
+
+import cv2
+import numpy as np
+
+
+def equalization_lut(y):
+    """
+    Bảng tra cân bằng lược đồ xám tương đương cv2.equalizeHist cho kênh y
+
+    Chức năng: Tính ánh xạ trên một ảnh (vd. ảnh thu nhỏ) rồi áp dụng cho
+    ảnh khác cùng cảnh (vd. vùng cắt độ phân giải đầy đủ) bằng cv2.LUT
+    """
+    hist = np.bincount(y.ravel(), minlength=256)
+    total = y.size
+    nonzero = np.flatnonzero(hist)
+    if nonzero.size == 0:
+        return np.arange(256, dtype=np.uint8)
+    first = nonzero[0]
+    if hist[first] == total:
+        return np.full(256, first, dtype=np.uint8)
+    cdf = np.cumsum(hist) - hist[first]
+    lut = np.rint(cdf * (255.0 / (total - hist[first])))
+    return np.clip(lut, 0, 255).astype(np.uint8)
+
+
+class FrameBufferPool:
+    """
+    Bộ đệm ảnh dùng lại giữa các khung hình liên tiếp
+
+    Chức năng: Cấp mảng đầu ra (dst) theo tên cho các bước OpenCV; chỉ cấp phát
+    lại khi kích thước/kiểu thay đổi. Mảng trong pool bị ghi đè ở khung sau nên
+    chỉ dùng cho ảnh trung gian, không dùng cho kết quả trả về người gọi.
+    """
+
+    def __init__(self):
+        self._buffers = {}
+
+    def get(self, key, shape, dtype=np.uint8):
+        """Lấy bộ đệm key với đúng shape/dtype (cấp phát mới nếu khác)"""
+        shape = tuple(int(v) for v in shape)
+        buf = self._buffers.get(key)
+        if buf is None or buf.shape != shape or buf.dtype != dtype:
+            buf = np.empty(shape, dtype=dtype)
+            self._buffers[key] = buf
+        return buf
+
+    def nbytes(self):
+        """Tổng bộ nhớ đang giữ (byte)"""
+        return sum(buf.nbytes for buf in self._buffers.values())
+
+    def clear(self):
+        self._buffers = {}
+
+
+class FrameROI:
+    """
+    Vùng quan tâm (ROI) của khung hình
+
+    Chức năng: Hình chữ nhật cắt từ dải x (vùng băng tải, thêm lề margin) giao với
+    bbox của đa giác tĩnh (tọa độ pixel khung gốc). Chỉ vùng cắt được tiền xử lý,
+    phân đoạn và đo; mask đa giác (nếu có) giới hạn mask phân đoạn bên trong vùng
+    cắt. Kết quả được đổi về tọa độ khung gốc để vẽ và tracking.
+    """
+
+    def __init__(self, frame_shape, x_range=None, polygon=None, margin=0):
+        h, w = frame_shape[:2]
+        x0, y0, x1, y1 = 0, 0, w, h
+        if x_range is not None:
+            x0 = max(x0, int(x_range[0]) - int(margin))
+            x1 = min(x1, int(x_range[1]) + int(margin))
+        points = None
+        if polygon:
+            points = np.round(np.asarray(polygon, dtype=np.float32)).astype(np.int32).reshape(-1, 2)
+            px, py, pw, ph = cv2.boundingRect(points)
+            x0, y0 = max(x0, px), max(y0, py)
+            x1, y1 = min(x1, px + pw), min(y1, py + ph)
+        if x1 <= x0 or y1 <= y0:
+            raise ValueError(f"ROI nằm ngoài khung hình {w}x{h}")
+
+        self.rect = (x0, y0, x1, y1)
+        self.frame_shape = (h, w)
+        self.mask = None
+        if points is not None:
+            self.mask = np.zeros((y1 - y0, x1 - x0), dtype=np.uint8)
+            cv2.fillPoly(self.mask, [points - np.array([x0, y0], dtype=np.int32)], 255)
+        self._scaled_masks = {}
+
+    @property
+    def is_full_frame(self):
+        return self.mask is None and self.rect == (0, 0, self.frame_shape[1], self.frame_shape[0])
+
+    def crop(self, image):
+        """Vùng cắt của ảnh khung gốc (view, không sao chép)"""
+        x0, y0, x1, y1 = self.rect
+        return image[y0:y1, x0:x1]
+
+    def mask_for(self, shape):
+        """Mask đa giác theo kích thước ảnh phân đoạn (None nếu không có đa giác)"""
+        if self.mask is None:
+            return None
+        shape = (int(shape[0]), int(shape[1]))
+        if shape == self.mask.shape:
+            return self.mask
+        scaled = self._scaled_masks.get(shape)
+        if scaled is None:
+            scaled = cv2.resize(self.mask, (shape[1], shape[0]), interpolation=cv2.INTER_NEAREST)
+            self._scaled_masks[shape] = scaled
+        return scaled
+
+    def to_frame(self, results):
+        """Đổi bbox của kết quả từ tọa độ vùng cắt sang tọa độ khung gốc (sửa tại chỗ)"""
+        x0, y0 = self.rect[:2]
+        for result in results:
+            x, y, w, h = result["bbox"]
+            result["bbox"] = (x + x0, y + y0, w, h)
+        return results
+
+    def paste(self, frame, crop_image):
+        """Ảnh khung gốc (bản sao) với vùng cắt thay bằng crop_image (cùng kích thước vùng cắt)"""
+        x0, y0, x1, y1 = self.rect
+        out = frame.copy()
+        out[y0:y1, x0:x1] = crop_image
+        return out
+
+    def full_mask(self, crop_mask):
+        """Mask khung gốc (0 ngoài ROI) từ mask vùng cắt, phóng về kích thước vùng cắt nếu cần"""
+        x0, y0, x1, y1 = self.rect
+        if crop_mask.shape[:2] != (y1 - y0, x1 - x0):
+            crop_mask = cv2.resize(crop_mask, (x1 - x0, y1 - y0), interpolation=cv2.INTER_NEAREST)
+        out = np.zeros(self.frame_shape, dtype=crop_mask.dtype)
+        out[y0:y1, x0:x1] = crop_mask
+        return out
+
+
+class BackgroundModel:
+    """
+    Mô hình nền của băng tải trống cho camera cố định
+
+    Chức năng: learn_frames khung đầu (băng tải trống) được lấy trung bình làm ảnh
+    nền; sau đó foreground là pixel lệch khỏi nền quá threshold ở ít nhất một kênh
+    BGR. Nền thích nghi chậm (learning_rate) chỉ ở pixel nền để quả dừng trên băng
+    tải không bị học vào nền. Khi foreground chiếm quá max_foreground_ratio khung
+    (đổi ánh sáng, dịch camera) mô hình học lại từ đầu.
+    """
+
+    def __init__(self, learn_frames=30, learning_rate=0.002, threshold=30, max_foreground_ratio=0.6):
+        self.learn_frames = max(1, int(learn_frames))
+        self.learning_rate = float(learning_rate)
+        self.threshold = int(threshold)
+        self.max_foreground_ratio = float(max_foreground_ratio)
+        self.learned = 0
+        self.relearns = 0
+        self._model = None
+
+    @classmethod
+    def from_config(cls, config):
+        """Tạo mô hình từ mục "segmentation.background" của cấu hình"""
+        cfg = config.get("segmentation", {}).get("background", {})
+        return cls(learn_frames=cfg.get("learn_frames", 30),
+                   learning_rate=cfg.get("learning_rate", 0.002),
+                   threshold=cfg.get("threshold", 30),
+                   max_foreground_ratio=cfg.get("max_foreground_ratio", 0.6))
+
+    @property
+    def ready(self):
+        return self._model is not None and self.learned >= self.learn_frames
+
+    def reset(self):
+        """Học lại nền từ các khung tiếp theo"""
+        self._model = None
+        self.learned = 0
+
+    def apply(self, bgr):
+        """
+        Cập nhật mô hình với khung bgr và trả về mask foreground 0/255
+
+        Trả về None khi đang học nền (người gọi dùng phân đoạn màu thay thế)
+        """
+        if self._model is None or self._model.shape != bgr.shape:
+            self._model = bgr.astype(np.float32)
+            self.learned = 1
+            return None
+        if self.learned < self.learn_frames:
+            # Trung bình cộng các khung học: trọng số 1/(n+1) cho khung thứ n+1
+            cv2.accumulateWeighted(bgr, self._model, 1.0 / (self.learned + 1))
+            self.learned += 1
+            return None
+
+        diff = cv2.absdiff(bgr, cv2.convertScaleAbs(self._model))
+        channels = cv2.split(diff)
+        dist = channels[0]
+        for channel in channels[1:]:
+            dist = cv2.max(dist, channel)
+        _, foreground = cv2.threshold(dist, self.threshold, 255, cv2.THRESH_BINARY)
+
+        if cv2.countNonZero(foreground) > self.max_foreground_ratio * foreground.size:
+            self.relearns += 1
+            self.reset()
+            return None
+        cv2.accumulateWeighted(bgr, self._model, self.learning_rate, mask=cv2.bitwise_not(foreground))
+        return foreground
+
+
+class FrameContext:
+    """
+    Ngữ cảnh không gian màu của một khung hình
+
+    Chức năng: Chuyển đổi BGR sang HSV/LAB/xám/YCrCb khi cần (lazy),
+    mỗi không gian màu chỉ được tính tối đa một lần cho mỗi khung hình
+    và được chia sẻ giữa phân đoạn, trích xuất đặc trưng và phát hiện khuyết tật.
+    Nếu có buffers (FrameBufferPool), ảnh chuyển đổi được ghi vào bộ đệm dùng lại
+    theo tên tag, tránh cấp phát mới ở mỗi khung khi xử lý hàng loạt.
+    Nếu đặt window (x, y, w, h), chỉ pixel trong cửa sổ được chuyển đổi, ngoài
+    cửa sổ bằng 0 (dùng khi mọi đối tượng đã biết nằm trong cửa sổ đó).
+    """
+
+    CONVERSIONS = {
+        "hsv": cv2.COLOR_BGR2HSV,
+        "lab": cv2.COLOR_BGR2LAB,
+        "gray": cv2.COLOR_BGR2GRAY,
+        "ycrcb": cv2.COLOR_BGR2YCrCb,
+    }
+
+    def __init__(self, bgr, buffers=None, tag="ctx", window=None):
+        self.bgr = bgr
+        self.window = window
+        self._planes = {}
+        self._buffers = buffers
+        self._tag = tag
+
+    def set_window(self, window):
+        """Giới hạn các chuyển đổi sau đó trong cửa sổ (x, y, w, h); None = toàn khung"""
+        if self._planes:
+            raise RuntimeError("Phải đặt cửa sổ trước khi chuyển đổi không gian màu")
+        self.window = window
+
+    def get(self, name):
+        """Lấy một không gian màu, chỉ chuyển đổi ở lần gọi đầu tiên"""
+        plane = self._planes.get(name)
+        if plane is None:
+            code = self.CONVERSIONS[name]
+            if self.window is not None:
+                plane = self.map_window(lambda img: cv2.cvtColor(img, code), self.bgr,
+                                        3 if name != "gray" else None, np.uint8)
+            elif self._buffers is None:
+                plane = cv2.cvtColor(self.bgr, code)
+            else:
+                shape = self.bgr.shape[:2] if name == "gray" else self.bgr.shape[:2] + (3,)
+                plane = cv2.cvtColor(self.bgr, code, dst=self._buffers.get((self._tag, name), shape))
+            self._planes[name] = plane
+        return plane
+
+    def map_window(self, fn, image, channels, dtype):
+        """
+        Áp dụng fn chỉ trên cửa sổ của image, trả ảnh toàn khung (0 ngoài cửa sổ)
+
+        channels: số kênh của kết quả (None = một kênh)
+        """
+        shape = image.shape[:2] + ((channels,) if channels else ())
+        out = np.zeros(shape, dtype=dtype)
+        x, y, w, h = self.window
+        if w > 0 and h > 0:
+            out[y:y + h, x:x + w] = fn(image[y:y + h, x:x + w])
+        return out
+
+    @property
+    def hsv(self):
+        return self.get("hsv")
+
+    @property
+    def lab(self):
+        return self.get("lab")
+
+    @property
+    def gray(self):
+        return self.get("gray")
+
+    @property
+    def ycrcb(self):
+        return self.get("ycrcb")
+
+    def cached(self, key, factory):
+        """Lấy một ảnh dẫn xuất (vd. bản đồ lớp màu), chỉ tính ở lần gọi đầu tiên"""
+        value = self._planes.get(key)
+        if value is None:
+            value = factory()
+            self._planes[key] = value
+        return value
+
+    def computed_planes(self):
+        """Danh sách các không gian màu đã được chuyển đổi (phục vụ đo đạc)"""
+        return list(self._planes.keys())
+
+
+class ObjectStatsEngine:
+    """
+    Thống kê đồng thời mọi đối tượng từ một ảnh nhãn duy nhất
+
+    Chức năng: Tô kín các contour của khung thành ảnh nhãn (from_contours; hoặc
+    một đối tượng duy nhất từ mask cắt theo bbox, single_object), sau đó tính
+    diện tích, bbox, tâm, màu trung bình H/S/V/a*/b*, tỷ lệ màu và số pixel tối
+    cho tất cả đối tượng trong một lượt vector hóa (bincount), thay vì tạo mask
+    toàn khung hình cho từng đối tượng.
+    """
+
+    def __init__(self, labels, num_labels, stats, centroids):
+        """
+        - labels: ảnh nhãn int32 (0 = nền)
+        - stats: (num_labels x 5) [x, y, w, h, diện tích] theo thứ tự cv2.CC_STAT_*
+        - centroids: (num_labels x 2) tâm (cx, cy)
+        """
+        self.labels = labels
+        self.num_labels = num_labels
+        self.stats = stats
+        self.centroids = centroids
+        self._flat_labels = labels.ravel()
+        self.area = stats[:, cv2.CC_STAT_AREA].astype(np.float64)
+        self.values = {}
+
+    @classmethod
+    def from_contours(cls, shape, contours):
+        """
+        Ảnh nhãn từ các contour tô kín: contour i mang nhãn i + 1
+
+        Pixel trong contour nhưng không thuộc mask (lỗ do đốm khuyết tật tối,
+        cuống) vẫn tính cho đối tượng, giống mask tô kín theo contour khi đo
+        từng đối tượng riêng; tâm lấy theo moment của contour
+        """
+        labels = np.zeros(shape[:2], dtype=np.int32)
+        for i in range(len(contours)):
+            cv2.drawContours(labels, contours, i, i + 1, thickness=-1)
+        num_labels = len(contours) + 1
+        area = np.bincount(labels.ravel(), minlength=num_labels)
+        h, w = labels.shape
+        stats = [[0, 0, w, h, area[0]]]
+        centroids = [[0.0, 0.0]]
+        for i, contour in enumerate(contours):
+            stats.append(list(cv2.boundingRect(contour)) + [area[i + 1]])
+            m = cv2.moments(contour)
+            centroids.append([m["m10"] / m["m00"], m["m01"] / m["m00"]] if m["m00"] else
+                             [float(contour[0][0][0]), float(contour[0][0][1])])
+        return cls(labels, num_labels, np.array(stats, dtype=np.int32).reshape(-1, 5),
+                   np.array(centroids, dtype=np.float64))
+
+    @classmethod
+    def single_object(cls, mask):
+        """Toàn bộ pixel khác 0 của mask là một đối tượng (nhãn 1), vd. ảnh cắt theo bbox"""
+        labels = (mask > 0).astype(np.int32)
+        h, w = labels.shape
+        area = int(np.count_nonzero(labels))
+        stats = np.array([[0, 0, w, h, labels.size - area],
+                          [0, 0, w, h, area]], dtype=np.int32)
+        m = cv2.moments(labels.astype(np.uint8), binaryImage=True)
+        cx = m["m10"] / m["m00"] if m["m00"] else 0.0
+        cy = m["m01"] / m["m00"] if m["m00"] else 0.0
+        return cls(labels, 2, stats, np.array([[0.0, 0.0], [cx, cy]]))
+
+    def label_at(self, contour):
+        """Nhãn của đối tượng chứa contour (điểm đầu tiên nằm trên biên đối tượng)"""
+        x, y = contour[0][0]
+        return int(self.labels[y, x])
+
+    def bbox(self, label):
+        """Bounding box (x, y, w, h) của một nhãn"""
+        s = self.stats[label]
+        return (int(s[cv2.CC_STAT_LEFT]), int(s[cv2.CC_STAT_TOP]),
+                int(s[cv2.CC_STAT_WIDTH]), int(s[cv2.CC_STAT_HEIGHT]))
+
+    def centroid(self, label):
+        """Tâm (cx, cy) của một nhãn"""
+        cx, cy = self.centroids[label]
+        return float(cx), float(cy)
+
+    def mean_per_label(self, plane):
+        """Giá trị trung bình của một kênh cho từng nhãn"""
+        sums = np.bincount(self._flat_labels, weights=plane.ravel(), minlength=self.num_labels)
+        return sums / np.maximum(self.area, 1)
+
+    def count_per_label(self, condition):
+        """Số pixel thỏa điều kiện (mask bool) cho từng nhãn"""
+        return np.bincount(self._flat_labels[condition.ravel()], minlength=self.num_labels)
+
+    def object_pixels(self, plane, label):
+        """Các pixel của một đối tượng, chỉ duyệt trong bbox của nó"""
+        x, y, w, h = self.bbox(label)
+        inside = self.labels[y:y + h, x:x + w] == label
+        return plane[y:y + h, x:x + w][inside]
+
+    def compute(self, ctx, color_lut, class_map, dark_delta_T):
+        """
+        Tính các đặc trưng màu và khuyết tật cho tất cả đối tượng
+
+        Chức năng: Mỗi kênh màu chỉ duyệt toàn khung một lần, tỷ lệ màu dùng lại
+        bản đồ lớp màu của bước phân đoạn; chi phí không còn tăng theo
+        (số đối tượng x diện tích khung)
+        """
+        h, s, v = cv2.split(ctx.hsv)
+        l, a, b = cv2.split(ctx.lab)
+        area = np.maximum(self.area, 1)
+
+        values = {
+            "h_mean": self.mean_per_label(h),
+            "s_mean": self.mean_per_label(s),
+            "v_mean": self.mean_per_label(v),
+            "a_mean": self.mean_per_label(a),
+            "b_mean": self.mean_per_label(b),
+        }
+
+        # Tỷ lệ pixel theo từng màu trong cấu hình (dùng lại bản đồ lớp màu)
+        for color_key in color_lut.class_names:
+            color_mask = color_lut.class_mask(class_map, color_key)
+            values[f"ratio_{color_key}"] = self.count_per_label(color_mask) / area
+
+        # Khuyết tật: pixel tối hơn độ sáng trung bình của chính đối tượng đó
+        dark_threshold = self.mean_per_label(l) - dark_delta_T
+        dark = l < dark_threshold[self.labels]
+        values["defect_ratio"] = self.count_per_label(dark) / area
+
+        self.values = values
+        return values
+
+    def object_values(self, label):
+        """Các đặc trưng đã tính của một nhãn dưới dạng dict"""
+        return {key: float(arr[label]) for key, arr in self.values.items()}
+
+
+def _bit_dtype(n_bits):
+    """Kiểu số nguyên không dấu nhỏ nhất chứa được n_bits cờ"""
+    for dtype in (np.uint8, np.uint16, np.uint32, np.uint64):
+        if n_bits <= np.dtype(dtype).itemsize * 8:
+            return np.dtype(dtype)
+    raise ValueError(f"Quá nhiều dải màu để biên dịch bảng tra: {n_bits} (tối đa 64)")
+
+
+def _gather(table, index):
+    """Tra bảng theo từng pixel; dùng cv2.LUT khi bảng 256 phần tử và chỉ số 8-bit"""
+    if index.dtype == np.uint8 and table.shape[0] == 256 and table.dtype in (np.uint8, np.uint16):
+        return cv2.LUT(index, table)
+    return np.take(table, index)
+
+
+class ColorClassLUT:
+    """
+    Bảng tra lớp màu biên dịch từ hsv_ranges của cấu hình
+
+    Chức năng: Mỗi dải HSV là một hộp H x S x V nên được tách thành ba bảng
+    256 phần tử (một cho mỗi kênh) chứa cờ bit của các dải. Cờ dải của một pixel
+    là AND ba lần tra bảng; một bảng thứ tư gộp cờ dải thành cờ lớp màu.
+    Kết quả là bản đồ lớp màu (mỗi bit một màu) dùng cho cả mask foreground
+    và tỷ lệ màu, thay cho một lần cv2.inRange trên mỗi dải của mỗi màu.
+    """
+
+    def __init__(self, hsv_ranges):
+        self.key = json.dumps(hsv_ranges, sort_keys=True)
+        self.class_names = list(hsv_ranges.keys())
+        self.class_bits = {name: 1 << i for i, name in enumerate(self.class_names)}
+
+        ranges = [(ci, r) for ci, name in enumerate(self.class_names) for r in hsv_ranges[name]]
+        self.num_ranges = len(ranges)
+        range_dtype = _bit_dtype(max(1, self.num_ranges))
+        self.class_dtype = _bit_dtype(max(1, len(self.class_names)))
+
+        # Bảng theo kênh: channel_luts[c][x] = các dải có kênh c chứa giá trị x
+        self.channel_luts = [np.zeros(256, dtype=range_dtype) for _ in range(3)]
+        class_range_bits = [0] * len(self.class_names)
+        for ri, (ci, range_dict) in enumerate(ranges):
+            bit = 1 << ri
+            for channel_lut, channel in zip(self.channel_luts, ("H", "S", "V")):
+                lo = max(0, int(range_dict[channel][0]))
+                hi = min(255, int(range_dict[channel][1]))
+                if lo <= hi:
+                    channel_lut[lo:hi + 1] |= range_dtype.type(bit)
+            class_range_bits[ci] |= bit
+        self._class_range_bits = class_range_bits
+
+        # Bảng gộp cờ dải -> cờ lớp (đủ nhỏ khi tối đa 16 dải)
+        self.range_to_class = None
+        if self.num_ranges <= 16:
+            # Với cờ dải 8-bit, bảng đủ 256 phần tử để tra được bằng cv2.LUT
+            size = 256 if range_dtype == np.uint8 else 1 << self.num_ranges
+            codes = np.arange(size, dtype=np.uint32)
+            table = np.zeros(codes.shape[0], dtype=self.class_dtype)
+            for ci, range_bits in enumerate(class_range_bits):
+                table[(codes & range_bits) != 0] |= self.class_dtype.type(1 << ci)
+            self.range_to_class = table
+
+    def classify(self, hsv):
+        """
+        Bản đồ lớp màu cho ảnh HSV
+
+        Trả về ảnh cùng kích thước, bit i bật nếu pixel thuộc màu class_names[i]
+        """
+        h, s, v = cv2.split(hsv)
+        range_bits = _gather(self.channel_luts[0], h)
+        np.bitwise_and(range_bits, _gather(self.channel_luts[1], s), out=range_bits)
+        np.bitwise_and(range_bits, _gather(self.channel_luts[2], v), out=range_bits)
+
+        if self.range_to_class is not None:
+            return _gather(self.range_to_class, range_bits)
+
+        class_map = np.zeros(h.shape, dtype=self.class_dtype)
+        for ci, bits in enumerate(self._class_range_bits):
+            hit = (range_bits & range_bits.dtype.type(bits)) != 0
+            class_map[hit] |= self.class_dtype.type(1 << ci)
+        return class_map
+
+    def foreground_mask(self, class_map):
+        """Mask 0/255 của các pixel thuộc ít nhất một màu"""
+        if class_map.dtype in (np.uint8, np.uint16):
+            return cv2.compare(class_map, 0, cv2.CMP_NE)
+        return (class_map != 0).astype(np.uint8) * 255
+
+    def class_mask(self, class_map, name):
+        """Mask bool của các pixel thuộc màu name"""
+        bit = self.class_bits.get(name)
+        if bit is None:
+            return np.zeros(class_map.shape, dtype=bool)
+        return (class_map & class_map.dtype.type(bit)) != 0
+
+
+class DominantColorEstimator:
+    """
+    Ước lượng cụm màu chiếm ưu thế trong một đối tượng (thay cho KMeans đầy đủ)
+
+    Chức năng: Lấy mẫu tối đa pixel_budget pixel, tìm các đỉnh của lược đồ HSV
+    3D thô làm tâm cụm, tinh chỉnh vài vòng Lloyd rồi tính ratio_red_km /
+    ratio_green_km như phiên bản KMeans (tỷ lệ pixel thuộc cụm có tâm H nằm
+    trong dải màu). Phương thức "kmeans" dùng sklearn với tâm khởi tạo từ
+    lược đồ (n_init=1) để so sánh.
+    """
+
+    # Các tỷ lệ *_km được tính cho những màu này nếu cấu hình có định nghĩa
+    TARGET_COLORS = ("red", "green")
+
+    def __init__(self, hsv_ranges, enabled=True, method="histogram", k=3,
+                 pixel_budget=2000, bins=(18, 8, 8), iterations=2, min_pixels=200):
+        self.enabled = enabled
+        self.method = method
+        self.k = k
+        self.pixel_budget = pixel_budget
+        self.bins = tuple(bins)
+        self.iterations = iterations
+        self.min_pixels = min_pixels
+        self.targets = {
+            f"ratio_{color}_km": [(r["H"][0], r["H"][1]) for r in hsv_ranges[color]]
+            for color in self.TARGET_COLORS if color in hsv_ranges
+        }
+
+    @classmethod
+    def from_config(cls, config):
+        """Tạo bộ ước lượng từ mục "dominant_color" của cấu hình"""
+        cfg = config.get("dominant_color", {})
+        return cls(
+            config.get("hsv_ranges", {}),
+            enabled=cfg.get("enabled", True),
+            method=cfg.get("method", "histogram"),
+            k=cfg.get("k", 3),
+            pixel_budget=cfg.get("pixel_budget", 2000),
+            bins=cfg.get("bins", (18, 8, 8)),
+            iterations=cfg.get("iterations", 2),
+            min_pixels=cfg.get("min_pixels", 200),
+        )
+
+    def ratios(self, obj_pixels):
+        """
+        Tỷ lệ pixel thuộc các cụm màu đỏ/xanh của một đối tượng
+
+        obj_pixels: mảng (N, 3) các pixel HSV của đối tượng
+        """
+        if not self.enabled or not self.targets or obj_pixels.shape[0] < self.min_pixels:
+            return {}
+
+        pixels = self._subsample(obj_pixels)
+        if self.method == "kmeans":
+            labels, centers = self._kmeans(pixels)
+        else:
+            labels, centers = self._histogram_peaks(pixels)
+
+        counts = np.bincount(labels, minlength=len(centers))
+        total = max(1, labels.shape[0])
+        result = {}
+        for key, h_ranges in self.targets.items():
+            hit = np.array([any(lo <= c[0] <= hi for lo, hi in h_ranges) for c in centers])
+            result[key] = float(counts[hit].sum()) / total
+        return result
+
+    def _subsample(self, pixels):
+        """Lấy mẫu đều theo bước để không vượt quá pixel_budget"""
+        n = pixels.shape[0]
+        if self.pixel_budget and n > self.pixel_budget:
+            step = int(np.ceil(n / self.pixel_budget))
+            return pixels[::step]
+        return pixels
+
+    def _initial_centers(self, pixels, data):
+        """Tâm khởi tạo: trung bình pixel trong k ô lược đồ HSV đông nhất"""
+        bh, bs, bv = self.bins
+        hq = np.minimum(pixels[:, 0].astype(np.int32) * bh // 180, bh - 1)
+        sq = pixels[:, 1].astype(np.int32) * bs // 256
+        vq = pixels[:, 2].astype(np.int32) * bv // 256
+        cell = (hq * bs + sq) * bv + vq
+
+        hist = np.bincount(cell, minlength=bh * bs * bv)
+        k = max(1, min(self.k, int(np.count_nonzero(hist))))
+        peaks = np.argsort(hist)[::-1][:k]
+        return np.stack([data[cell == p].mean(axis=0) for p in peaks])
+
+    def _assign(self, data, centers):
+        """Gán mỗi pixel cho tâm gần nhất"""
+        dist = ((data[:, None, :] - centers[None, :, :]) ** 2).sum(axis=2)
+        return dist.argmin(axis=1)
+
+    def _histogram_peaks(self, pixels):
+        data = pixels.astype(np.float32)
+        centers = self._initial_centers(pixels, data)
+        labels = self._assign(data, centers)
+        for _ in range(self.iterations):
+            for j in range(len(centers)):
+                members = data[labels == j]
+                if members.shape[0] > 0:
+                    centers[j] = members.mean(axis=0)
+            labels = self._assign(data, centers)
+        return labels, centers
+
+    def _kmeans(self, pixels):
+        from sklearn.cluster import KMeans
+
+        data = pixels.astype(np.float32)
+        init = self._initial_centers(pixels, data)
+        km = KMeans(n_clusters=len(init), init=init, n_init=1, random_state=0)
+        labels = km.fit_predict(data)
+        return labels, km.cluster_centers_
+
+
+class FourierLowPassPlan:
+    """
+    Kế hoạch lọc thông thấp miền tần số cho một cặp (kích thước ảnh, radius_ratio)
+
+    Chức năng: Tính sẵn mặt nạ tròn (vẽ bằng cv2.circle quanh tâm phổ như trước)
+    rồi chuyển một lần sang bố cục không dịch (tần số 0 tại góc), nên mỗi khung
+    không cần fftshift/ifftshift; dùng lại các bộ đệm đã cấp phát (kể cả ảnh
+    vào float32) cho mọi khung cùng kích thước. Mặc định không pad: idft phức
+    rồi lấy độ lớn, chuẩn hóa min-max và cắt về uint8, kết quả trùng từng pixel
+    với cách cũ. pad_optimal=True pad 0 tới kích thước DFT tối ưu
+    (cv2.getOptimalDFTSize) cho nhanh hơn, đổi lại kết quả lệch nhẹ ở biên ảnh.
+    """
+
+    def __init__(self, shape, radius_ratio, pad_optimal=False):
+        h, w = shape
+        self.shape = (h, w)
+        self.radius_ratio = radius_ratio
+        self.pad_optimal = pad_optimal
+        if pad_optimal:
+            ph, pw = cv2.getOptimalDFTSize(h), cv2.getOptimalDFTSize(w)
+        else:
+            ph, pw = h, w
+
+        shifted = np.zeros((ph, pw), np.float32)
+        r = int(min(ph, pw) * max(0.02, min(0.45, radius_ratio)))
+        cv2.circle(shifted, (pw // 2, ph // 2), r, 1, -1)
+        mask = np.fft.ifftshift(shifted)
+        self.mask = cv2.merge([mask, mask])
+
+        # Vùng pad (ngoài h x w) luôn bằng 0, chỉ phần ảnh được ghi lại mỗi khung
+        self._input = np.zeros((ph, pw), dtype=np.float32)
+        self._spectrum = np.zeros((ph, pw, 2), dtype=np.float32)
+        self._back = np.zeros((ph, pw, 2), dtype=np.float32)
+        self._magnitude = np.zeros((ph, pw), dtype=np.float32)
+        self._cropped = np.zeros((h, w), dtype=np.float32) if (ph, pw) != (h, w) else None
+
+    def apply(self, gray):
+        """Lọc thông thấp ảnh xám uint8, trả về ảnh uint8 đã chuẩn hóa 0..255"""
+        h, w = self.shape
+        if self._cropped is None:
+            np.copyto(self._input, gray)
+            cv2.dft(self._input, dst=self._spectrum, flags=cv2.DFT_COMPLEX_OUTPUT)
+        else:
+            np.copyto(self._input[:h, :w], gray)
+            cv2.dft(self._input, dst=self._spectrum, flags=cv2.DFT_COMPLEX_OUTPUT, nonzeroRows=h)
+        cv2.multiply(self._spectrum, self.mask, dst=self._spectrum)
+        cv2.idft(self._spectrum, dst=self._back)
+        cv2.magnitude(self._back[:, :, 0], self._back[:, :, 1], magnitude=self._magnitude)
+        if self._cropped is None:
+            magnitude = self._magnitude
+        else:
+            magnitude = self._cropped
+            np.copyto(magnitude, self._magnitude[:h, :w])
+        cv2.normalize(magnitude, magnitude, 0, 255, cv2.NORM_MINMAX)
+        return np.uint8(magnitude)
@@ -1,4 +1,5 @@
 # fruit_configs.py - Cấu hình chi tiết cho nhiều loại sản phẩm nông nghiệp
+import copy
 import json
 
 
@@ -9,6 +10,18 @@ class FruitConfigManager:
     Chức năng: Tạo và quản lý cấu hình tối ưu cho từng loại quả
     """
 
+    # Chế độ phân đoạn: "color" (HSV + Otsu) hoặc "background" (trừ nền băng tải, camera cố định)
+    SEGMENTATION_MODES = ("color", "background")
+    DEFAULT_SEGMENTATION = {
+        "mode": "color",
+        "background": {
+            "learn_frames": 30,  # Số khung băng tải trống để học nền lúc khởi động
+            "learning_rate": 0.002,  # Tốc độ thích nghi chậm của nền
+            "threshold": 30,  # Độ lệch BGR tối thiểu để coi là foreground
+            "max_foreground_ratio": 0.6  # Foreground vượt tỷ lệ này thì học lại nền
+        }
+    }
+
     def __init__(self):
         self.configs = self.create_all_configs()
 
@@ -18,7 +31,7 @@ class FruitConfigManager:
 
         Return: Dictionary chứa cấu hình cho từng loại quả
         """
-        return {
+        configs = {
             "tomato": self.create_tomato_config(),
             "apple": self.create_apple_config(),
             "banana": self.create_banana_config(),
@@ -32,6 +45,10 @@ class FruitConfigManager:
             "rambutan": self.create_rambutan_config(),
             "longan": self.create_longan_config()
         }
+        # Mọi loại quả mặc định phân đoạn theo màu; đổi bằng set_segmentation_mode
+        for config in configs.values():
+            config.setdefault("segmentation", copy.deepcopy(self.DEFAULT_SEGMENTATION))
+        return configs
 
     def create_tomato_config(self):
         """Cấu hình cho cà chua"""
@@ -893,6 +910,26 @@ class FruitConfigManager:
         """
         return self.configs.get(fruit_type)
 
+    def set_segmentation_mode(self, fruit_type, mode, **background):
+        """
+        Chọn chế độ phân đoạn cho một loại quả
+
+        Args:
+            fruit_type: Loại quả
+            mode: "color" hoặc "background"
+            background: Tham số mô hình nền ghi đè (learn_frames, learning_rate, ...)
+
+        Returns:
+            True nếu cập nhật thành công
+        """
+        config = self.get_config(fruit_type)
+        if config is None or mode not in self.SEGMENTATION_MODES:
+            return False
+        segmentation = config.setdefault("segmentation", copy.deepcopy(self.DEFAULT_SEGMENTATION))
+        segmentation["mode"] = mode
+        segmentation.setdefault("background", {}).update(background)
+        return True
+
     def get_all_fruit_names(self):
         """Lấy danh sách tên tất cả các loại quả"""
         return [(key, config['name']) for key, config in self.configs.items()]
@@ -998,7 +1035,9 @@ class FruitConfigManager:
             "shape_constraints": {
                 "min_circularity": 0.6,
                 "max_aspect_ratio": 2.0
-            }
+            },
+
+            "segmentation": copy.deepcopy(self.DEFAULT_SEGMENTATION)
         }
 
         return template
@@ -1042,6 +1081,11 @@ class FruitConfigManager:
                         elif len(range_dict[channel]) != 2:
                             errors.append(f"HSV range {color}[{i}] kênh {channel} phải có 2 giá trị")
 
+        # Kiểm tra chế độ phân đoạn (tùy chọn)
+        mode = config.get('segmentation', {}).get('mode', 'color')
+        if mode not in self.SEGMENTATION_MODES:
+            errors.append(f"Chế độ phân đoạn không hợp lệ: {mode}")
+
         return len(errors) == 0, errors
 
 
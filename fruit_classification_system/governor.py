@@ -0,0 +1,293 @@
+# governor.py - Tự điều chỉnh mức chất lượng xử lý để giữ FPS mục tiêu
+import time
+
+import cv2
+import numpy as np
+
+
+class MotionGate:
+    """
+    Bộ phát hiện thay đổi cảnh trước process_frame
+
+    Chức năng: Thu nhỏ khung về `width` pixel, chuyển xám và so với ảnh tham chiếu
+    (khung được xử lý gần nhất). Nếu tỷ lệ pixel lệch quá pixel_threshold nhỏ hơn
+    min_changed_ratio thì cảnh coi như không đổi (băng tải trống/dừng) và có thể
+    dùng lại kết quả cũ; quá max_interval_s giây chưa xử lý thì buộc xử lý lại.
+    """
+
+    def __init__(self, width=160, pixel_threshold=20, min_changed_ratio=0.005, max_interval_s=1.0):
+        self.width = max(16, int(width))
+        self.pixel_threshold = int(pixel_threshold)
+        self.min_changed_ratio = float(min_changed_ratio)
+        self.max_interval_s = float(max_interval_s)
+        self.frames = 0
+        self.skipped = 0
+        self.last_changed_ratio = 0.0
+        self._reference = None
+        self._last_processed = 0.0
+
+    @classmethod
+    def from_config(cls, config):
+        """Tạo bộ phát hiện từ mục "motion" của cấu hình; None nếu không bật"""
+        cfg = config.get("motion", {})
+        if not cfg.get("enabled", False):
+            return None
+        return cls(width=cfg.get("width", 160),
+                   pixel_threshold=cfg.get("pixel_threshold", 20),
+                   min_changed_ratio=cfg.get("min_changed_ratio", 0.005),
+                   max_interval_s=cfg.get("max_interval_s", 1.0))
+
+    def _thumbnail(self, frame):
+        h, w = frame.shape[:2]
+        size = (self.width, max(1, int(round(h * self.width / w))))
+        small = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+        return cv2.cvtColor(small, cv2.COLOR_BGR2GRAY) if small.ndim == 3 else small
+
+    def should_process(self, frame, now=None):
+        """
+        True nếu khung cần xử lý đầy đủ (cảnh đổi, quá hạn hoặc chưa có tham chiếu)
+
+        Khung được xử lý trở thành ảnh tham chiếu mới
+        """
+        now = time.monotonic() if now is None else now
+        self.frames += 1
+        small = self._thumbnail(frame)
+        if self._reference is not None and self._reference.shape == small.shape:
+            diff = cv2.absdiff(small, self._reference)
+            self.last_changed_ratio = np.count_nonzero(diff > self.pixel_threshold) / diff.size
+            if (self.last_changed_ratio < self.min_changed_ratio
+                    and now - self._last_processed < self.max_interval_s):
+                self.skipped += 1
+                return False
+        self._reference = small
+        self._last_processed = now
+        return True
+
+    def skipped_fraction(self):
+        """Tỷ lệ khung được bỏ qua vì cảnh không đổi"""
+        return self.skipped / self.frames if self.frames else 0.0
+
+    def reset(self):
+        self.frames = 0
+        self.skipped = 0
+        self._reference = None
+
+    def format_status(self):
+        return f"Idle skip {self.skipped_fraction() * 100:.0f}%"
+
+
+class LoadGovernor:
+    """
+    Bộ điều tiết tải cho các chế độ camera
+
+    Chức năng: Đo thời gian xử lý mỗi khung, so với ngân sách (1000 / target_fps
+    hoặc latency_budget_ms). Quá ngân sách liên tục thì hạ một mức chất lượng,
+    dư nhiều (dưới headroom * ngân sách) đủ lâu thì nâng lại một mức. Các mức
+    cộng dồn theo thứ tự trong LEVELS. Khi bật profiling, bước nào gần như
+    không tốn thời gian (theo StageTimer) thì mức bỏ bước đó được nhảy qua.
+    """
+
+    # (tên, nhãn hiển thị, các bước StageTimer mà mức này cắt giảm)
+    LEVELS = (
+        ("full", "Full", ()),
+        ("no_kmeans", "No KMeans", ("dominant_color",)),
+        ("no_otsu", "No Otsu/FFT", ("otsu",)),
+        ("low_scale", "Low scale", ()),
+        ("stride", "Every Nth", ()),
+        ("boxes_only", "Boxes only", ("drawing",)),
+    )
+
+    def __init__(self, system, enabled=True, target_fps=20.0, latency_budget_ms=None,
+                 headroom=0.75, down_after=5, up_after=45, reduced_scale=0.5,
+                 frame_stride=2, min_stage_share=0.03, smoothing=0.2, motion_gate=None):
+        self.system = system
+        # Bỏ qua khung khi cảnh không đổi (độc lập với enabled)
+        self.motion_gate = motion_gate
+        self.enabled = bool(enabled)
+        self.budget_ms = float(latency_budget_ms) if latency_budget_ms else 1000.0 / float(target_fps)
+        self.headroom = float(headroom)
+        self.down_after = max(1, int(down_after))
+        self.up_after = max(1, int(up_after))
+        self.reduced_scale = float(reduced_scale)
+        self.frame_stride = max(2, int(frame_stride))
+        self.min_stage_share = float(min_stage_share)
+        self.smoothing = float(smoothing)
+
+        self.level = 0
+        self.frame_ms = None  # trung bình trượt (EMA) thời gian xử lý một khung
+        self.level_ms = {}  # thời gian trung bình đã quan sát ở từng mức
+        self.changes = 0
+        self.last_reused = False
+
+        self._over = 0
+        self._under = 0
+        self._frame_index = 0
+        self._last_output = None
+        # Trạng thái gốc của system để khôi phục khi nâng mức
+        self._base_scale = system.segmentation_scale
+        self._base_render_mode = None
+
+    @classmethod
+    def from_config(cls, system, **overrides):
+        """Tạo bộ điều tiết theo mục "governor" của cấu hình (overrides ưu tiên)"""
+        cfg = system.config.get("governor", {})
+        settings = {
+            "enabled": cfg.get("enabled", False),
+            "target_fps": cfg.get("target_fps", 20),
+            "latency_budget_ms": cfg.get("latency_budget_ms"),
+            "headroom": cfg.get("headroom", 0.75),
+            "down_after": cfg.get("down_after", 5),
+            "up_after": cfg.get("up_after", 45),
+            "reduced_scale": cfg.get("reduced_scale", 0.5),
+            "frame_stride": cfg.get("frame_stride", 2),
+            "min_stage_share": cfg.get("min_stage_share", 0.03),
+        }
+        settings.update({k: v for k, v in overrides.items() if v is not None})
+        settings.setdefault("motion_gate", MotionGate.from_config(system.config))
+        return cls(system, **settings)
+
+    @property
+    def level_name(self):
+        return self.LEVELS[self.level][0]
+
+    @property
+    def stride(self):
+        """Số khung trên mỗi lần xử lý thật ở mức hiện tại"""
+        return self.frame_stride if self.level >= 4 else 1
+
+    def process(self, frame):
+        """
+        Xử lý một khung theo mức chất lượng hiện tại
+
+        Trả về (vis, results, mask) như system.process_frame. Khi cảnh không đổi
+        (motion_gate), trả lại nguyên kết quả và hình vẽ của lần xử lý trước. Ở mức
+        "stride", khung không đến lượt dùng lại kết quả/mask của lần xử lý trước
+        và chỉ vẽ lại khung bao lên ảnh mới. Cả hai trường hợp: last_reused = True.
+        """
+        system = self.system
+        index = self._frame_index
+        self._frame_index += 1
+
+        if self._last_output is not None:
+            if self.motion_gate is not None:
+                # Chỉ xét thay đổi trong vùng quan tâm (bỏ qua máy móc ngoài băng tải)
+                roi = system.get_roi(frame.shape)
+                if not self.motion_gate.should_process(roi.crop(frame) if roi is not None else frame):
+                    self.last_reused = True
+                    return self._last_output
+            if self.enabled and index % self.stride != 0:
+                _, results, mask = self._last_output
+                self.last_reused = True
+                return system.draw_results(frame, None, results), results, mask
+
+        start = time.perf_counter()
+        # Khung xử lý thật cách nhau `stride` khung: tracker (cache) dự đoán qua khoảng đó
+        output = system.process_frame(frame, track_dt=self.stride)
+        elapsed_ms = (time.perf_counter() - start) * 1000.0
+        self.last_reused = False
+        self._last_output = output
+        if self.enabled:
+            self.observe(elapsed_ms)
+        return output
+
+    def observe(self, elapsed_ms):
+        """Cập nhật thời gian xử lý của một khung và đổi mức nếu cần"""
+        timings = self.system.last_timings
+        if timings.get("total"):
+            # Có profiling: dùng tổng thời gian do StageTimer đo
+            elapsed_ms = timings["total"]
+        if self.frame_ms is None:
+            self.frame_ms = elapsed_ms
+        else:
+            self.frame_ms += self.smoothing * (elapsed_ms - self.frame_ms)
+        self.level_ms[self.level] = self.frame_ms
+
+        # Chi phí trung bình mỗi khung hiển thị (mức "stride" chia đều cho N khung)
+        cost = self.frame_ms / self.stride
+        if cost > self.budget_ms:
+            self._over += 1
+            self._under = 0
+        elif cost < self.budget_ms * self.headroom:
+            self._under += 1
+            self._over = 0
+        else:
+            self._over = self._under = 0
+
+        if self._over >= self.down_after and self.level < len(self.LEVELS) - 1:
+            self.set_level(self._next_lower_level())
+        elif self._under >= self.up_after and self.level > 0:
+            # Chỉ nâng khi mức trên (nếu đã đo) vừa ngân sách, tránh dao động qua lại
+            known = self.level_ms.get(self.level - 1)
+            if known is None or known / (self.frame_stride if self.level - 1 >= 4 else 1) <= self.budget_ms:
+                self.set_level(self.level - 1)
+            else:
+                self._under = 0
+
+    def _next_lower_level(self):
+        """Mức thấp hơn kế tiếp, bỏ qua mức cắt bước gần như không tốn thời gian"""
+        level = self.level + 1
+        timer = self.system.timer
+        if not timer.enabled:
+            return level
+        last = timer.last
+        total = last.get("total", 0.0)
+        while level < len(self.LEVELS) - 1 and total > 0:
+            stages = self.LEVELS[level][2]
+            if not stages or sum(last.get(s, 0.0) for s in stages) >= self.min_stage_share * total:
+                break
+            level += 1
+        return level
+
+    def set_level(self, level):
+        """Áp dụng một mức chất lượng (các mức cộng dồn)"""
+        level = max(0, min(len(self.LEVELS) - 1, int(level)))
+        system = self.system
+        system.set_quality(skip_dominant_color=level >= 1, skip_otsu=level >= 2)
+
+        if level >= 3:
+            base = self._base_scale if self._base_scale is not None else system.get_segmentation_scale()
+            system.set_segmentation_scale(min(base, self.reduced_scale))
+        else:
+            system.set_segmentation_scale(self._base_scale)
+
+        if level >= 5:
+            if self._base_render_mode is None:
+                self._base_render_mode = system.render_mode
+            system.set_render_mode("boxes_only")
+        elif self._base_render_mode is not None:
+            system.set_render_mode(self._base_render_mode)
+            self._base_render_mode = None
+
+        if level != self.level:
+            self.changes += 1
+            # Đo lại từ đầu ở mức mới
+            self.frame_ms = None
+        self.level = level
+        self._over = self._under = 0
+
+    def reset(self):
+        """Trở về chất lượng đầy đủ"""
+        self.set_level(0)
+        self.level_ms = {}
+        self._last_output = None
+        if self.motion_gate is not None:
+            self.motion_gate.reset()
+
+    def status(self):
+        """Trạng thái hiện tại: mức, tên, thời gian khung (ms) và ngân sách"""
+        return {
+            "level": self.level,
+            "name": self.level_name,
+            "frame_ms": self.frame_ms,
+            "budget_ms": self.budget_ms,
+            "stride": self.stride,
+            "changes": self.changes,
+        }
+
+    def format_status(self):
+        """Chuỗi ngắn cho info panel, ví dụ 'Q2 No Otsu/FFT 41/50 ms'"""
+        label = self.LEVELS[self.level][1]
+        if not self.enabled:
+            return "Q0 Full (governor off)"
+        frame_ms = f"{self.frame_ms:.0f}" if self.frame_ms is not None else "-"
+        return f"Q{self.level} {label} {frame_ms}/{self.budget_ms:.0f} ms"
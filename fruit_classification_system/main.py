@@ -5,20 +5,195 @@ import json
 import time
 from datetime import datetime
 import os
-from sklearn.cluster import KMeans
+import threading
+
+from frame_analysis import (BackgroundModel, ColorClassLUT, DominantColorEstimator,
+                            FourierLowPassPlan, FrameBufferPool, FrameContext, FrameROI,
+                            ObjectStatsEngine, equalization_lut)
+from capture import CaptureThread
+from governor import LoadGovernor
+from performance import StageTimer
+
+
+class ScaleCalibrator:
+    """
+    Điều phối hiệu chuẩn mm/pixel ngoài luồng xử lý chính
+
+    Chức năng: Chạy phép dò vật tham chiếu (HoughCircles) một lần ("once") hoặc
+    trên luồng nền ("background"), thử lại với thời gian chờ tăng gấp đôi khi
+    không thấy vật tham chiếu, và lưu mm/pixel theo camera/cấu hình/độ phân giải
+    để lần khởi động sau không phải dò lại. Thời gian chờ tính bằng giây khi chạy
+    camera (clock="time") và bằng số khung khi xử lý theo lô (clock="frames").
+    """
+
+    def __init__(self, detect_fn, ref_config):
+        self.detect_fn = detect_fn
+        self.mode = ref_config.get("mode", "once")  # "once" | "background" | "off"
+        self.retry_initial_s = float(ref_config.get("retry_initial_s", 1.0))
+        self.retry_max_s = float(ref_config.get("retry_max_s", 60.0))
+        self.max_attempts = int(ref_config.get("max_attempts", 0))  # 0 = không giới hạn
+        self.retry_initial_frames = int(ref_config.get("retry_initial_frames", 8))
+        self.retry_max_frames = int(ref_config.get("retry_max_frames", 480))
+        self.cache_file = ref_config.get("cache_file", "scale_calibration.json")
+
+        self.clock = "time"  # "time" | "frames"
+        self.attempts = 0
+        self.status = "idle"  # "idle" | "running" | "retry_wait" | "done" | "gave_up" | "cached"
+        self._delay = self.retry_initial_s
+        self._next_attempt = 0.0
+        self._frames = 0
+        self._thread = None
+        self._lock = threading.Lock()
+        self._checked_keys = set()
+
+    def load_cached(self, key):
+        """Đọc mm/pixel đã lưu cho key (mỗi key chỉ đọc file một lần)"""
+        if key in self._checked_keys:
+            return None
+        self._checked_keys.add(key)
+        entry = self._read_cache().get(key)
+        if entry and entry.get("mm_per_px"):
+            self.status = "cached"
+            return float(entry["mm_per_px"])
+        return None
+
+    def set_clock(self, clock: str):
+        """Đơn vị thời gian chờ thử lại: "time" (giây) | "frames" (số khung, dùng khi chạy lô)"""
+        if clock == self.clock:
+            return
+        with self._lock:
+            self.clock = clock
+            self._delay = self.retry_initial_frames if clock == "frames" else self.retry_initial_s
+            if self._next_attempt != float("inf"):
+                self._next_attempt = 0.0
+
+    def _now(self):
+        return self._frames if self.clock == "frames" else time.monotonic()
+
+    def save(self, key, mm_per_px, extra=None):
+        """
+        Lưu mm/pixel cho key vào file cache
+
+        Ghi ra file tạm cùng thư mục rồi os.replace để các worker chạy song song
+        không để lại file JSON ghi dở.
+        """
+        with self._lock:
+            cache = self._read_cache()
+            cache[key] = {
+                "mm_per_px": float(mm_per_px),
+                "updated": datetime.now().isoformat(timespec="seconds"),
+                **(extra or {})
+            }
+            tmp_file = f"{self.cache_file}.{os.getpid()}.{threading.get_ident()}.tmp"
+            try:
+                with open(tmp_file, 'w', encoding='utf-8') as f:
+                    json.dump(cache, f, indent=2, ensure_ascii=False)
+                os.replace(tmp_file, self.cache_file)
+            except OSError as e:
+                print(f"Không thể lưu cache hiệu chuẩn: {e}")
+                if os.path.exists(tmp_file):
+                    os.remove(tmp_file)
+
+    def _read_cache(self):
+        try:
+            with open(self.cache_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def submit(self, bgr, on_result, ctx=None):
+        """
+        Gọi ở mỗi khung khi chưa có mm/pixel
+
+        Chức năng: Chỉ thực sự dò khi đã hết thời gian chờ và không có lần dò nào
+        đang chạy; kết quả thành công được trả qua on_result(mm_per_px).
+        ctx (FrameContext của bgr) chỉ được dùng khi dò đồng bộ.
+        """
+        if self.mode == "off" or self.status == "gave_up":
+            return
+        with self._lock:
+            self._frames += 1
+            now = self._now()
+            if now < self._next_attempt or (self._thread is not None and self._thread.is_alive()):
+                return
+            if self.max_attempts and self.attempts >= self.max_attempts:
+                self.status = "gave_up"
+                return
+            self.attempts += 1
+            self.status = "running"
+            # Chặn lần thử tiếp theo cho tới khi lần này kết thúc
+            self._next_attempt = float("inf")
+
+        if self.mode == "background":
+            self._thread = threading.Thread(target=self._run, args=(bgr.copy(), on_result, None),
+                                            daemon=True)
+            self._thread.start()
+        else:
+            self._run(bgr, on_result, ctx)
+
+    def _run(self, bgr, on_result, ctx):
+        try:
+            mm_per_px = self.detect_fn(bgr, ctx)
+        except Exception as e:
+            print(f"Lỗi hiệu chuẩn tỷ lệ: {e}")
+            mm_per_px = None
+
+        if mm_per_px is not None:
+            self.status = "done"
+            on_result(mm_per_px)
+            return
+
+        # Không thấy vật tham chiếu: chờ lâu dần trước khi thử lại
+        with self._lock:
+            self.status = "retry_wait"
+            self._next_attempt = self._now() + self._delay
+            limit = self.retry_max_frames if self.clock == "frames" else self.retry_max_s
+            self._delay = min(self._delay * 2, limit)
 
 
 class FruitClassificationSystem:
-    def __init__(self, config_file="config.json"):
+    def __init__(self, config_file="config.json", config=None):
         """
         Khởi tạo hệ thống phân loại sản phẩm
 
         Tham số:
         - config_file: tệp cấu hình chứa ngưỡng và tham số cho từng loại quả
+        - config: dict cấu hình có sẵn (vd. truyền sang tiến trình worker); ưu tiên hơn config_file
         """
-        self.config = self.load_config(config_file)
+        self.config = config if config is not None else self.load_config(config_file)
         self.scale_state = {"mm_per_px": None}
+        # Khóa cache hiệu chuẩn: camera + cấu hình (+ độ phân giải lúc chạy)
+        self.camera_key = "default"
+        self._scale_calibrator = None
         self.results_log = []
+        # Bảng tra lớp màu biên dịch từ hsv_ranges (tạo lại khi cấu hình thay đổi)
+        self._color_lut = None
+        # Bộ ước lượng cụm màu chiếm ưu thế (thay cho KMeans theo từng đối tượng)
+        self._dominant_estimator = None
+        self._dominant_key = None
+        # Kế hoạch lọc DFT theo (kích thước, radius_ratio) cho segment_with_otsu
+        self._fourier_plans = {}
+        # Kernel hình thái học theo kích thước (tạo một lần, dùng lại mọi khung)
+        self._kernels = {}
+        # Bộ đệm ảnh trung gian; chỉ bật trong process_frames (xử lý hàng loạt)
+        self._buffers = None
+        self._batch_buffers = None
+        # Tỷ lệ phân đoạn ghi đè (None = theo "pyramid.scale" trong cấu hình)
+        self.segmentation_scale = None
+        # Mô hình nền băng tải cho chế độ phân đoạn "background" (tạo khi cần)
+        self._background = None
+        # Vùng quan tâm: mục "roi" của cấu hình, ghi đè lúc chạy bằng set_roi
+        self.roi_override = {}
+        self._roi = None
+        self._roi_key = None
+        # Cache phân loại theo ID tracking (None = tắt; xem set_track_cache)
+        self.track_cache = None
+        # Bước có thể bỏ khi cần giữ FPS (do LoadGovernor điều khiển)
+        self.skip_dominant_color = False
+        self.skip_otsu = False
+        # Đo thời gian từng bước (mục "profiling"); tắt thì gần như không tốn chi phí
+        self.timer = StageTimer.from_config(self.config)
+        self.last_timings = {}
         # ---- MỚI: chế độ render để kiểm soát chữ vẽ lên frame ----
         # "full": vẽ khung + text từng đối tượng + panel tổng
         # "minimal": vẽ khung + panel tổng (không text từng đối tượng)
@@ -33,6 +208,17 @@ class FruitClassificationSystem:
         """
         self.render_mode = mode
 
+    def set_quality(self, skip_dominant_color=None, skip_otsu=None):
+        """
+        Bật/tắt các bước tốn kém nhưng không bắt buộc (None = giữ nguyên):
+        - skip_dominant_color: bỏ ước lượng cụm màu chiếm ưu thế (ratio_*_km)
+        - skip_otsu: bỏ ngưỡng Otsu + lọc Fourier, chỉ dùng mask HSV
+        """
+        if skip_dominant_color is not None:
+            self.skip_dominant_color = bool(skip_dominant_color)
+        if skip_otsu is not None:
+            self.skip_otsu = bool(skip_otsu)
+
     def load_config(self, config_file):
         """Tải cấu hình từ tệp JSON"""
         try:
@@ -61,7 +247,13 @@ class FruitClassificationSystem:
             },
             "defect": {"dark_delta_T": 25, "area_ratio_tau": 0.06},
             "morphology": {"open_kernel": 3, "close_kernel": 5, "min_area": 200},
-            "watershed": {"distance_threshold_rel": 0.5}
+            "watershed": {"distance_threshold_rel": 0.5},
+            "dominant_color": {"enabled": True, "method": "histogram", "pixel_budget": 2000},
+            "otsu": {"lowpass": "fourier", "radius_ratio": 0.08, "pad_optimal": False},
+            "pyramid": {"scale": 1.0},
+            "segmentation": {"mode": "color"},
+            "roi": {"enabled": False, "x_range": None, "polygon": None, "margin_px": 0},
+            "profiling": {"enabled": False, "window": 300}
         }
 
     def color_correction_lab_clahe(self, bgr):
@@ -82,82 +274,129 @@ class FruitClassificationSystem:
         return cv2.cvtColor(lab_corrected, cv2.COLOR_LAB2BGR)
 
     # ====== BỔ SUNG THEO GIÁO TRÌNH: Tiền xử lý ======
-    def histogram_equalization_global(self, bgr):
+    def histogram_equalization_global(self, bgr, ctx=None):
         """Cân bằng lược đồ xám toàn cục trên kênh độ sáng (YCrCb-Y)."""
-        ycrcb = cv2.cvtColor(bgr, cv2.COLOR_BGR2YCrCb)
+        ycrcb = (ctx or FrameContext(bgr)).ycrcb
         y, cr, cb = cv2.split(ycrcb)
         y_eq = cv2.equalizeHist(y)
-        out = cv2.merge([y_eq, cr, cb])
-        return cv2.cvtColor(out, cv2.COLOR_YCrCb2BGR)
+        out = cv2.merge([y_eq, cr, cb], dst=self.buffer("heq_ycrcb", ycrcb.shape))
+        return cv2.cvtColor(out, cv2.COLOR_YCrCb2BGR, dst=self.buffer("heq_bgr", ycrcb.shape))
 
-    def fourier_low_pass(self, gray, radius_ratio: float = 0.1):
+    def fourier_low_pass(self, gray, radius_ratio: float = 0.1, pad_optimal: bool = False):
         """Lọc thông thấp theo miền tần số (DFT) trên ảnh xám.
         radius_ratio: bán kính mặt nạ tròn so với kích thước ngắn hơn của ảnh.
+        pad_optimal: pad tới kích thước DFT tối ưu (nhanh hơn, không còn trùng từng pixel với bản không pad).
+        Mặt nạ và bộ đệm được lưu theo (kích thước, radius_ratio) và dùng lại giữa các khung hình.
+        """
+        return self.get_fourier_plan(gray.shape[:2], radius_ratio, pad_optimal).apply(gray)
+
+    def get_fourier_plan(self, shape, radius_ratio, pad_optimal=False):
+        """Lấy (hoặc tạo) kế hoạch lọc DFT cho một bộ (kích thước, radius_ratio, pad_optimal)"""
+        key = (int(shape[0]), int(shape[1]), float(radius_ratio), bool(pad_optimal))
+        plan = self._fourier_plans.get(key)
+        if plan is None:
+            # Giới hạn số kế hoạch giữ lại khi kích thước ảnh thay đổi liên tục
+            if len(self._fourier_plans) >= 8:
+                self._fourier_plans.clear()
+            plan = FourierLowPassPlan(key[:2], radius_ratio, pad_optimal=key[3])
+            self._fourier_plans[key] = plan
+        return plan
+
+    def spatial_low_pass(self, gray, radius_ratio: float = 0.1):
+        """Lọc thông thấp miền không gian tương đương (Gaussian) với mặt nạ DFT cùng radius_ratio.
+        Tần số cắt r/h (dọc) và r/w (ngang) chu kỳ/pixel ứng với sigma = kích thước / (2*pi*r).
         """
         h, w = gray.shape[:2]
-        dft = cv2.dft(np.float32(gray), flags=cv2.DFT_COMPLEX_OUTPUT)
-        dft_shift = np.fft.fftshift(dft)
-        mask = np.zeros((h, w, 2), np.float32)
-        cy, cx = h // 2, w // 2
-        r = int(min(h, w) * max(0.02, min(0.45, radius_ratio)))
-        cv2.circle(mask, (cx, cy), r, (1, 1), -1)
-        fshift = dft_shift * mask
-        f_ishift = np.fft.ifftshift(fshift)
-        img_back = cv2.idft(f_ishift)
-        img_back = cv2.magnitude(img_back[:, :, 0], img_back[:, :, 1])
-        img_back = cv2.normalize(img_back, None, 0, 255, cv2.NORM_MINMAX)
-        return np.uint8(img_back)
-
-    def denoise(self, img, method="median", k=3):
+        r = max(1.0, min(h, w) * max(0.02, min(0.45, radius_ratio)))
+        sigma_x = w / (2 * np.pi * r)
+        sigma_y = h / (2 * np.pi * r)
+        low = cv2.GaussianBlur(gray, (0, 0), sigmaX=sigma_x, sigmaY=sigma_y)
+        return cv2.normalize(low, None, 0, 255, cv2.NORM_MINMAX)
+
+    def denoise(self, img, method="median", k=3, dst=None):
         """
         Giảm nhiễu cho ảnh
 
         Chức năng: Loại bỏ nhiễu muối tiêu và nhiễu Gaussian
+        - dst: bộ đệm đầu ra (tùy chọn) để dùng lại giữa các khung
         """
         if method == "median":
-            return cv2.medianBlur(img, k)
+            return cv2.medianBlur(img, k, dst=dst)
         elif method == "gaussian":
-            return cv2.GaussianBlur(img, (k, k), 1.0)
+            return cv2.GaussianBlur(img, (k, k), 1.0, dst=dst)
         return img
 
-    def segment_by_color_hsv_lab(self, bgr):
+    def segment_by_color_hsv_lab(self, bgr, ctx=None):
         """
         Phân đoạn vật thể dựa trên màu sắc trong không gian HSV và LAB
 
         Chức năng: Tách foreground (quả) khỏi background bằng ngưỡng màu
         """
-        hsv = cv2.cvtColor(bgr, cv2.COLOR_BGR2HSV)
-        lab = cv2.cvtColor(bgr, cv2.COLOR_BGR2LAB)
-
-        mask = np.zeros(hsv.shape[:2], dtype=np.uint8)
+        ctx = ctx or FrameContext(bgr)
 
-        # Kết hợp mask từ các dải màu HSV
-        for color_name, ranges in self.config["hsv_ranges"].items():
-            for range_dict in ranges:
-                lower_hsv = np.array([range_dict["H"][0], range_dict["S"][0], range_dict["V"][0]])
-                upper_hsv = np.array([range_dict["H"][1], range_dict["S"][1], range_dict["V"][1]])
-                color_mask = cv2.inRange(hsv, lower_hsv, upper_hsv)
-                mask = cv2.bitwise_or(mask, color_mask)
+        # Kết hợp mask từ các dải màu HSV: một lần tra bảng lớp màu cho mọi dải,
+        # bản đồ lớp màu được giữ trong ctx để tính tỷ lệ màu về sau
+        class_map = self.color_class_map(ctx)
+        return self.get_color_lut().foreground_mask(class_map)
 
-        # Kết hợp với điều kiện a* trong LAB để tăng độ chính xác
-        a_channel = lab[:, :, 1]
-        if "lab_thresholds" in self.config:
-            lab_mask = np.ones(a_channel.shape, dtype=np.uint8) * 255
-            mask = cv2.bitwise_and(mask, lab_mask)
-
-        return mask
+    def get_color_lut(self):
+        """
+        Bảng tra lớp màu của cấu hình hiện tại
 
-    def segment_with_otsu(self, bgr):
+        Chức năng: Biên dịch hsv_ranges một lần, chỉ biên dịch lại khi cấu hình thay đổi
+        """
+        hsv_ranges = self.config.get("hsv_ranges", {})
+        key = json.dumps(hsv_ranges, sort_keys=True)
+        if self._color_lut is None or self._color_lut.key != key:
+            self._color_lut = ColorClassLUT(hsv_ranges)
+        return self._color_lut
+
+    def color_class_map(self, ctx):
+        """Bản đồ lớp màu (bit theo màu) của khung hình, tính tối đa một lần cho mỗi ctx"""
+        lut = self.get_color_lut()
+        if ctx.window is not None:
+            # Chỉ tra bảng trong cửa sổ foreground (chế độ phân đoạn "background")
+            return ctx.cached(("color_classes", lut.key),
+                              lambda: ctx.map_window(lut.classify, ctx.hsv, None, lut.class_dtype))
+        return ctx.cached(("color_classes", lut.key), lambda: lut.classify(ctx.hsv))
+
+    def segmentation_mode(self):
+        """Chế độ phân đoạn: "color" (HSV + Otsu) hoặc "background" (trừ nền băng tải)"""
+        return self.config.get("segmentation", {}).get("mode", "color")
+
+    def get_background_model(self):
+        """Mô hình nền theo mục "segmentation.background" (tạo một lần)"""
+        if self._background is None:
+            self._background = BackgroundModel.from_config(self.config)
+        return self._background
+
+    def reset_background(self):
+        """Học lại nền băng tải trống từ các khung tiếp theo"""
+        if self._background is not None:
+            self._background.reset()
+
+    def segment_with_otsu(self, bgr, ctx=None):
         """Ngưỡng Otsu trên ảnh xám sau khi lọc thông thấp Fourier (tùy chọn)."""
-        gray = cv2.cvtColor(bgr, cv2.COLOR_BGR2GRAY)
-        # Lọc thông thấp để giảm nhiễu tần cao trước Otsu
-        low = self.fourier_low_pass(gray, radius_ratio=0.08)
-        _, mask = cv2.threshold(low, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+        gray = (ctx or FrameContext(bgr)).gray
+        # Lọc thông thấp để giảm nhiễu tần cao trước Otsu:
+        # "fourier" (mặc định, DFT có cache), "spatial" (Gaussian tương đương) hoặc "none"
+        otsu_cfg = self.config.get("otsu", {})
+        radius_ratio = otsu_cfg.get("radius_ratio", 0.08)
+        lowpass = otsu_cfg.get("lowpass", "fourier")
+        if lowpass == "spatial":
+            low = self.spatial_low_pass(gray, radius_ratio=radius_ratio)
+        elif lowpass == "none":
+            low = gray
+        else:
+            low = self.fourier_low_pass(gray, radius_ratio=radius_ratio,
+                                        pad_optimal=otsu_cfg.get("pad_optimal", False))
+        _, mask = cv2.threshold(low, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU,
+                                dst=self.buffer("otsu_mask", low.shape))
         return mask
 
-    def segment_in_ycbcr(self, bgr, cb_range=None, cr_range=None):
+    def segment_in_ycbcr(self, bgr, cb_range=None, cr_range=None, ctx=None):
         """Phân đoạn trong không gian YCbCr bằng ngưỡng Cb/Cr (nếu cấu hình yêu cầu)."""
-        ycrcb = cv2.cvtColor(bgr, cv2.COLOR_BGR2YCrCb)
+        ycrcb = (ctx or FrameContext(bgr)).ycrcb
         y, cr, cb = cv2.split(ycrcb)
         cb_lo, cb_hi = (0, 255) if cb_range is None else cb_range
         cr_lo, cr_hi = (0, 255) if cr_range is None else cr_range
@@ -165,34 +404,58 @@ class FruitClassificationSystem:
         mask_cr = cv2.inRange(cr, cr_lo, cr_hi)
         return cv2.bitwise_and(mask_cb, mask_cr)
 
-    def clean_mask(self, mask):
+    def clean_mask(self, mask, scale: float = 1.0):
         """
         Làm sạch mask bằng các phép hình thái học
 
         Chức năng: Loại bỏ nhiễu nhỏ, lấp lỗ, làm mượt biên
+        - scale: tỷ lệ của mask so với khung gốc; kernel và min_area được co theo
         """
         morph_config = self.config["morphology"]
+        open_k = self.scaled_kernel_size(morph_config["open_kernel"], scale)
+        close_k = self.scaled_kernel_size(morph_config["close_kernel"], scale)
+        min_area = morph_config["min_area"] * scale * scale
 
         # Opening: loại bỏ nhiễu nhỏ
-        open_kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE,
-                                                (morph_config["open_kernel"], morph_config["open_kernel"]))
-        mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, open_kernel)
+        mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, self.morph_kernel(open_k),
+                                dst=self.buffer("mask_open", mask.shape))
 
-        # Closing: lấp lỗ
-        close_kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE,
-                                                 (morph_config["close_kernel"], morph_config["close_kernel"]))
-        mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, close_kernel)
+        # Closing: lấp lỗ (kết quả trả về người gọi nên luôn là mảng mới)
+        mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, self.morph_kernel(close_k))
 
         # Loại bỏ các vùng nhỏ
         contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
         for contour in contours:
             area = cv2.contourArea(contour)
-            if area < morph_config["min_area"]:
+            if area < min_area:
                 cv2.fillPoly(mask, [contour], 0)
 
         return mask
 
-    def find_objects_by_contours(self, bgr, mask, use_canny: bool = False):
+    def morph_kernel(self, k):
+        """Kernel elip k x k, tạo một lần cho mỗi kích thước"""
+        k = int(k)
+        kernel = self._kernels.get(k)
+        if kernel is None:
+            kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (k, k))
+            self._kernels[k] = kernel
+        return kernel
+
+    def buffer(self, key, shape, dtype=np.uint8):
+        """Bộ đệm trung gian khi đang xử lý hàng loạt; None (OpenCV tự cấp phát) nếu không"""
+        if self._buffers is None:
+            return None
+        return self._buffers.get(key, shape, dtype)
+
+    @staticmethod
+    def scaled_kernel_size(k, scale):
+        """Kích thước kernel hình thái học (lẻ, >= 1) sau khi co theo tỷ lệ ảnh"""
+        if scale >= 1.0:
+            return int(k)
+        k_scaled = max(1, int(round(k * scale)))
+        return k_scaled if k_scaled % 2 == 1 else k_scaled + 1
+
+    def find_objects_by_contours(self, bgr, mask, use_canny: bool = False, scale: float = 1.0):
         """Tách nhiều đối tượng bằng contour; có thể dùng Canny để tinh biên."""
         proc = mask
         if use_canny:
@@ -202,15 +465,16 @@ class FruitClassificationSystem:
             proc = cv2.bitwise_and(proc, edges)
         contours, _ = cv2.findContours(proc, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
         # Lọc theo diện tích tối thiểu từ cấu hình
-        min_area = self.config.get("morphology", {}).get("min_area", 200)
+        min_area = self.config.get("morphology", {}).get("min_area", 200) * scale * scale
         contours = [c for c in contours if cv2.contourArea(c) >= min_area]
         return contours
 
-    def extract_features(self, bgr, obj_mask, object_id):
+    def extract_features(self, bgr, obj_mask, object_id, ctx=None):
         """
         Trích xuất đặc trưng từ một đối tượng
 
         Chức năng: Tính toán các thông số hình học, màu sắc và khuyết tật
+        - ctx: FrameContext của khung hình (dùng chung HSV/LAB giữa các đối tượng)
         """
         # Tìm contour
         contours, _ = cv2.findContours(obj_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
@@ -220,6 +484,65 @@ class FruitClassificationSystem:
         contour = max(contours, key=cv2.contourArea)
 
         # Đặc trưng hình học
+        shape = self.shape_features(contour)
+
+        # Đặc trưng màu sắc (lấy từ ngữ cảnh khung hình, không chuyển đổi lại)
+        ctx = ctx or FrameContext(bgr)
+        hsv = ctx.hsv
+        lab = ctx.lab
+
+        # Tính màu trung bình trong vùng mask
+        colors = {
+            "h_mean": cv2.mean(hsv[:, :, 0], obj_mask)[0],
+            "s_mean": cv2.mean(hsv[:, :, 1], obj_mask)[0],
+            "v_mean": cv2.mean(hsv[:, :, 2], obj_mask)[0],
+            "a_mean": cv2.mean(lab[:, :, 1], obj_mask)[0],
+            "b_mean": cv2.mean(lab[:, :, 2], obj_mask)[0],
+        }
+
+        # Tính tỷ lệ pixel cho các màu được định nghĩa trong config (linh hoạt theo từng loại quả)
+        for color_key in self.config.get("hsv_ranges", {}).keys():
+            colors[f"ratio_{color_key}"] = self.calculate_color_ratio(hsv, obj_mask, color_key)
+
+        # (Tùy chọn) ước lượng cụm màu chiếm ưu thế
+        if self.use_dominant_color():
+            colors.update(self.dominant_color_ratios(hsv[obj_mask > 0]))
+
+        # Phát hiện khuyết tật
+        colors["defect_ratio"] = self.detect_defects(lab[:, :, 0], obj_mask)
+
+        return self.assemble_features(object_id, shape, colors)
+
+    def extract_features_from_stats(self, engine, contour, object_id, ctx):
+        """
+        Trích xuất đặc trưng của một đối tượng từ ObjectStatsEngine
+
+        Chức năng: Hình học lấy từ contour, màu sắc/khuyết tật lấy từ thống kê
+        đã tính một lượt cho cả khung hình (không tạo mask toàn khung cho đối tượng)
+        """
+        label = engine.label_at(contour)
+        if label <= 0:
+            return None
+
+        shape = self.shape_features(contour)
+        colors = engine.object_values(label)
+        if self.use_dominant_color():
+            colors.update(self.dominant_color_ratios(engine.object_pixels(ctx.hsv, label)))
+
+        return self.assemble_features(object_id, shape, colors)
+
+    def compute_object_stats(self, contours, ctx):
+        """
+        Tô kín các contour thành ảnh nhãn và tính thống kê màu/khuyết tật cho mọi
+        đối tượng trong một lượt (đốm tối là lỗ trong mask vẫn được tính)
+        """
+        engine = ObjectStatsEngine.from_contours(ctx.bgr.shape, contours)
+        engine.compute(ctx, self.get_color_lut(), self.color_class_map(ctx),
+                       self.config["defect"]["dark_delta_T"])
+        return engine
+
+    def shape_features(self, contour):
+        """Đặc trưng hình học của một contour (diện tích, chu vi, đường kính, độ tròn, bbox)"""
         area = cv2.contourArea(contour)
         perimeter = cv2.arcLength(contour, True)
 
@@ -234,67 +557,53 @@ class FruitClassificationSystem:
         x, y, w, h = cv2.boundingRect(contour)
         aspect_ratio = w / h if h > 0 else 0
 
-        # Đặc trưng màu sắc
-        hsv = cv2.cvtColor(bgr, cv2.COLOR_BGR2HSV)
-        lab = cv2.cvtColor(bgr, cv2.COLOR_BGR2LAB)
-
-        # Tính màu trung bình trong vùng mask
-        h_mean = cv2.mean(hsv[:, :, 0], obj_mask)[0]
-        s_mean = cv2.mean(hsv[:, :, 1], obj_mask)[0]
-        v_mean = cv2.mean(hsv[:, :, 2], obj_mask)[0]
-
-        a_mean = cv2.mean(lab[:, :, 1], obj_mask)[0]
-        b_mean = cv2.mean(lab[:, :, 2], obj_mask)[0]
-
-        # Tính tỷ lệ pixel cho các màu được định nghĩa trong config (linh hoạt theo từng loại quả)
-        color_ratios = {}
-        for color_key in self.config.get("hsv_ranges", {}).keys():
-            color_ratios[f"ratio_{color_key}"] = self.calculate_color_ratio(hsv, obj_mask, color_key)
-
-        # (Tùy chọn) K-means trên HSV trong vùng đối tượng để ước lượng cụm màu chiếm ưu thế
-        try:
-            obj_pixels = hsv[obj_mask > 0]
-            if obj_pixels.shape[0] >= 200:  # đủ mẫu
-                k = 3
-                km = KMeans(n_clusters=k, n_init=5, random_state=0)
-                labels_k = km.fit_predict(obj_pixels)
-                centers = km.cluster_centers_  # H,S,V trung bình mỗi cụm
-                # Ước lượng tỉ lệ cụm có H nằm trong dải "đỏ" hoặc "xanh" nếu có trong cấu hình
-                def in_any_range(h_val, ranges):
-                    for r in ranges:
-                        if r["H"][0] <= h_val <= r["H"][1]:
-                            return True
-                    return False
-                if "red" in self.config.get("hsv_ranges", {}):
-                    red_mask = [in_any_range(c[0], self.config["hsv_ranges"]["red"]) for c in centers]
-                    color_ratios["ratio_red_km"] = float(np.sum(red_mask[i] for i in labels_k)) / max(1, len(labels_k))
-                if "green" in self.config.get("hsv_ranges", {}):
-                    green_mask = [in_any_range(c[0], self.config["hsv_ranges"]["green"]) for c in centers]
-                    color_ratios["ratio_green_km"] = float(np.sum(green_mask[i] for i in labels_k)) / max(1, len(labels_k))
-        except Exception:
-            pass
-
-        # Phát hiện khuyết tật
-        defect_ratio = self.detect_defects(lab[:, :, 0], obj_mask)
-
         return {
-            "id": object_id,
             "area_px": area,
             "perimeter": perimeter,
             "d_eq_px": d_eq_px,
             "d_eq_mm": d_eq_mm,
             "circularity": circularity,
             "aspect_ratio": aspect_ratio,
-            "h_mean": h_mean,
-            "s_mean": s_mean,
-            "v_mean": v_mean,
-            "a_mean": a_mean,
-            "b_mean": b_mean,
-            **color_ratios,
-            "defect_ratio": defect_ratio,
             "bbox": (x, y, w, h)
         }
 
+    def assemble_features(self, object_id, shape, colors):
+        """Ghép đặc trưng hình học và màu sắc theo thứ tự khóa cố định"""
+        features = {"id": object_id}
+        features.update({k: v for k, v in shape.items() if k != "bbox"})
+        features.update({k: v for k, v in colors.items() if k != "defect_ratio"})
+        features["defect_ratio"] = colors.get("defect_ratio", 0.0)
+        features["bbox"] = shape["bbox"]
+        return features
+
+    def get_dominant_color_estimator(self):
+        """
+        Bộ ước lượng cụm màu chiếm ưu thế theo mục "dominant_color" của cấu hình
+
+        Chức năng: Tạo một lần, chỉ tạo lại khi cấu hình màu thay đổi
+        """
+        key = json.dumps([self.config.get("dominant_color", {}), self.config.get("hsv_ranges", {})],
+                         sort_keys=True)
+        if self._dominant_estimator is None or self._dominant_key != key:
+            self._dominant_estimator = DominantColorEstimator.from_config(self.config)
+            self._dominant_key = key
+        return self._dominant_estimator
+
+    def use_dominant_color(self):
+        """Có tính cụm màu chiếm ưu thế cho khung này không (cấu hình bật và không bị bỏ qua)"""
+        return not self.skip_dominant_color and self.get_dominant_color_estimator().enabled
+
+    def dominant_color_ratios(self, obj_pixels):
+        """
+        Ước lượng cụm màu chiếm ưu thế trong vùng đối tượng
+
+        Trả về ratio_red_km / ratio_green_km nếu cấu hình có dải màu tương ứng
+        (rỗng khi tắt "dominant_color.enabled" hoặc đối tượng quá nhỏ).
+        Thời gian đo ở bước "dominant_color" của StageTimer.
+        """
+        with self.timer.stage("dominant_color"):
+            return self.get_dominant_color_estimator().ratios(obj_pixels)
+
     def calculate_color_ratio(self, hsv, obj_mask, color):
         """
         Tính tỷ lệ pixel có màu cụ thể trong đối tượng
@@ -304,17 +613,13 @@ class FruitClassificationSystem:
         if color not in self.config["hsv_ranges"]:
             return 0.0
 
-        total_pixels = np.sum(obj_mask > 0)
+        total_pixels = np.count_nonzero(obj_mask)
         if total_pixels == 0:
             return 0.0
 
-        color_pixels = 0
-        for range_dict in self.config["hsv_ranges"][color]:
-            lower = np.array([range_dict["H"][0], range_dict["S"][0], range_dict["V"][0]])
-            upper = np.array([range_dict["H"][1], range_dict["S"][1], range_dict["V"][1]])
-            color_mask = cv2.inRange(hsv, lower, upper)
-            combined_mask = cv2.bitwise_and(color_mask, obj_mask)
-            color_pixels += np.sum(combined_mask > 0)
+        lut = self.get_color_lut()
+        color_mask = lut.class_mask(lut.classify(hsv), color)
+        color_pixels = np.count_nonzero(color_mask & (obj_mask > 0))
 
         return color_pixels / total_pixels
 
@@ -406,27 +711,73 @@ class FruitClassificationSystem:
             "defect_vi": defect_vi,
         }
 
-    def calibrate_scale_from_reference(self, bgr):
+    def calibrate_scale_from_reference(self, bgr, ctx=None):
         """
         Hiệu chuẩn tỷ lệ pixel/mm từ vật tham chiếu
 
         Chức năng: Xác định tỷ lệ chuyển đổi từ pixel sang mm thực tế
         """
-        # Tìm đồng xu hoặc vật tham chiếu có kích thước biết trước
-        gray = cv2.cvtColor(bgr, cv2.COLOR_BGR2GRAY)
-        circles = cv2.HoughCircles(gray, cv2.HOUGH_GRADIENT, 1, 50,
-                                   param1=50, param2=30, minRadius=20, maxRadius=100)
+        # Tìm đồng xu hoặc vật tham chiếu có kích thước biết trước (mục "reference_object")
+        ref = self.config.get("reference_object", {})
+        gray = (ctx or FrameContext(bgr)).gray
+        circles = cv2.HoughCircles(gray, cv2.HOUGH_GRADIENT, 1, ref.get("min_dist_px", 50),
+                                   param1=ref.get("hough_param1", 50), param2=ref.get("hough_param2", 30),
+                                   minRadius=int(ref.get("min_radius_px", 20)),
+                                   maxRadius=int(ref.get("max_radius_px", 100)))
 
         if circles is not None:
             circles = np.round(circles[0, :]).astype("int")
-            if len(circles) > 0:
-                # Giả sử đồng xu có đường kính 24mm
-                reference_diameter_mm = 24.0
+            if len(circles) > 0 and circles[0][2] > 0:
+                # Mặc định đồng xu có đường kính 24mm
+                reference_diameter_mm = float(ref.get("diameter_mm", 24.0))
                 reference_diameter_px = circles[0][2] * 2
                 return reference_diameter_mm / reference_diameter_px
 
         return None
 
+    def set_camera_key(self, key):
+        """Đặt định danh camera dùng cho cache hiệu chuẩn mm/pixel"""
+        self.camera_key = str(key)
+
+    def set_calibration_mode(self, mode: str):
+        """Chế độ hiệu chuẩn: "once" (đồng bộ) | "background" (luồng nền) | "off" """
+        self.get_scale_calibrator().mode = mode
+
+    def get_scale_calibrator(self):
+        if self._scale_calibrator is None:
+            self._scale_calibrator = ScaleCalibrator(self.calibrate_scale_from_reference,
+                                                     self.config.get("reference_object", {}))
+        return self._scale_calibrator
+
+    def scale_cache_key(self, frame_shape):
+        """Khóa cache: camera | sản phẩm | đường kính tham chiếu | độ phân giải"""
+        h, w = frame_shape[:2]
+        ref = self.config.get("reference_object", {})
+        return f"{self.camera_key}|{self.config.get('product', 'unknown')}|" \
+               f"{float(ref.get('diameter_mm', 24.0))}mm|{w}x{h}"
+
+    def update_scale_calibration(self, bgr, ctx=None):
+        """
+        Đảm bảo có tỷ lệ mm/pixel mà không chạy HoughCircles ở mỗi khung
+
+        Chức năng: Dùng giá trị đã lưu nếu có; nếu không, giao cho ScaleCalibrator
+        (một lần hoặc chạy nền, thử lại với thời gian chờ tăng dần)
+        """
+        if self.scale_state["mm_per_px"] is not None:
+            return
+        calibrator = self.get_scale_calibrator()
+        key = self.scale_cache_key(bgr.shape)
+        cached = calibrator.load_cached(key)
+        if cached is not None:
+            self.scale_state["mm_per_px"] = cached
+            return
+
+        def on_result(mm_per_px):
+            self.scale_state["mm_per_px"] = mm_per_px
+            calibrator.save(key, mm_per_px, {"frame_size": [bgr.shape[1], bgr.shape[0]]})
+
+        calibrator.submit(bgr, on_result, ctx)
+
     def draw_results(self, bgr, labels, results):
         """
         Vẽ kết quả phân loại lên ảnh
@@ -502,85 +853,442 @@ class FruitClassificationSystem:
 
         return vis
 
-    def process_frame(self, bgr):
+    def get_segmentation_scale(self):
+        """Tỷ lệ ảnh dùng cho phân đoạn ở chế độ kim tự tháp (1.0 = độ phân giải gốc)"""
+        scale = self.segmentation_scale
+        if scale is None:
+            scale = self.config.get("pyramid", {}).get("scale", 1.0)
+        return float(min(1.0, max(0.1, scale)))
+
+    def set_segmentation_scale(self, scale):
+        """Ghi đè tỷ lệ phân đoạn (None = dùng giá trị "pyramid.scale" của cấu hình)"""
+        self.segmentation_scale = scale
+
+    def set_roi(self, x_range=None, polygon=None, margin_px=None):
         """
-        Xử lý một khung hình hoàn chỉnh
+        Đặt vùng quan tâm lúc chạy (vd. từ vùng của ConveyorBeltHandler)
+
+        Tham số None giữ giá trị của mục "roi" trong cấu hình
+        - x_range: (x_bắt_đầu, x_kết_thúc) theo pixel khung gốc
+        - polygon: [[x, y], ...] theo pixel khung gốc
+        """
+        override = {"enabled": True}
+        if x_range is not None:
+            override["x_range"] = [int(x_range[0]), int(x_range[1])]
+        if polygon is not None:
+            override["polygon"] = [[float(x), float(y)] for x, y in polygon]
+        if margin_px is not None:
+            override["margin_px"] = int(margin_px)
+        self.roi_override = override
+
+    def clear_roi(self):
+        """Bỏ vùng quan tâm đặt lúc chạy (trở về mục "roi" của cấu hình)"""
+        self.roi_override = {}
+
+    def get_roi(self, frame_shape):
+        """
+        Vùng quan tâm cho khung kích thước frame_shape (None = xử lý toàn khung)
 
-        Chức năng: Pipeline chính thực hiện tất cả các bước xử lý
+        Chức năng: Tạo FrameROI một lần cho mỗi kích thước khung/thiết lập ROI
         """
+        settings = dict(self.config.get("roi", {}))
+        settings.update(self.roi_override)
+        if not settings.get("enabled", False):
+            return None
+        key = json.dumps([list(frame_shape[:2]), settings.get("x_range"), settings.get("polygon"),
+                          settings.get("margin_px", 0)])
+        if key != self._roi_key:
+            self._roi_key = key
+            try:
+                roi = FrameROI(frame_shape, settings.get("x_range"), settings.get("polygon"),
+                               settings.get("margin_px", 0))
+                self._roi = None if roi.is_full_frame else roi
+            except ValueError as e:
+                print(f"Bỏ qua ROI, xử lý toàn khung: {e}")
+                self._roi = None
+        return self._roi
+
+    def segment_frame(self, bgr, scale: float = 1.0, roi_mask=None):
+        """
+        Tiền xử lý và phân đoạn một khung hình (có thể đã thu nhỏ theo scale)
+
+        - roi_mask: mask đa giác ROI cùng kích thước bgr (tùy chọn), giới hạn mask phân đoạn
+
+        Ở chế độ "background", mask foreground lấy từ mô hình nền (trên khung chưa
+        cân bằng) thay cho HSV + Otsu; HSV/LAB và bản đồ lớp màu chỉ được tính
+        trong bbox của foreground. Trong lúc học nền, dùng phân đoạn màu.
+
+        Trả về (raw_ctx, denoised, ctx, mask_clean, contours)
+        """
+        timer = self.timer
+        # Ngữ cảnh màu cho khung đầu vào (YCrCb cho cân bằng lược đồ)
+        raw_ctx = FrameContext(bgr, self._buffers, "raw")
+
+        foreground = None
+        if self.segmentation_mode() == "background":
+            with timer.stage("background"):
+                foreground = self.get_background_model().apply(bgr)
+
         # 1. Tiền xử lý ảnh (theo giáo trình)
         # - Histogram equalization toàn cục trên Y
-        heq = self.histogram_equalization_global(bgr)
+        with timer.stage("equalization"):
+            heq = self.histogram_equalization_global(bgr, raw_ctx)
         # - Lọc trung vị/gaussian (ưu tiên median)
-        denoised = self.denoise(heq, method="median", k=3)
-
-        # 2. Phân đoạn: ưu tiên HSV; có thể kết hợp Otsu/YCbCr nếu cần
-        mask_hsv = self.segment_by_color_hsv_lab(denoised)
-        # (Tùy chọn) Otsu để bổ trợ/giới hạn nền
-        try:
-            mask_otsu = self.segment_with_otsu(denoised)
-            mask = cv2.bitwise_and(mask_hsv, mask_otsu)
-        except Exception:
-            mask = mask_hsv
-        mask_clean = self.clean_mask(mask)
+        with timer.stage("denoise"):
+            denoised = self.denoise(heq, method="median", k=3, dst=self.buffer("denoised", heq.shape))
+
+        # Ngữ cảnh màu dùng chung cho mọi bước sau tiền xử lý:
+        # HSV/LAB/xám của khung đã lọc chỉ được chuyển đổi một lần
+        ctx = FrameContext(denoised, self._buffers, "ctx")
+
+        # 2. Phân đoạn: mô hình nền (khi đã học xong) hoặc HSV; có thể kết hợp Otsu/YCbCr nếu cần
+        if foreground is not None:
+            mask = foreground
+        else:
+            with timer.stage("hsv_mask"):
+                mask_hsv = self.segment_by_color_hsv_lab(denoised, ctx)
+            # (Tùy chọn) Otsu để bổ trợ/giới hạn nền
+            if self.skip_otsu:
+                mask = mask_hsv
+            else:
+                with timer.stage("otsu"):
+                    try:
+                        mask_otsu = self.segment_with_otsu(denoised, ctx)
+                        mask = cv2.bitwise_and(mask_hsv, mask_otsu, dst=self.buffer("seg_mask", mask_hsv.shape))
+                    except Exception:
+                        mask = mask_hsv
+        with timer.stage("clean_mask"):
+            if roi_mask is not None:
+                mask = cv2.bitwise_and(mask, roi_mask, dst=self.buffer("roi_mask", mask.shape))
+            mask_clean = self.clean_mask(mask, scale)
+        if foreground is not None:
+            # Mọi đối tượng nằm trong bbox của foreground: chỉ chuyển màu trong đó
+            ctx.set_window(cv2.boundingRect(mask_clean))
 
         # 3. Tách nhiều đối tượng bằng contour (Canny tùy chọn)
-        contours = self.find_objects_by_contours(denoised, mask_clean, use_canny=False)
+        with timer.stage("contours"):
+            contours = self.find_objects_by_contours(denoised, mask_clean, use_canny=False, scale=scale)
+
+        return raw_ctx, denoised, ctx, mask_clean, contours
 
-        # 4. Hiệu chuẩn tỷ lệ (chỉ thực hiện một lần)
-        if self.scale_state["mm_per_px"] is None:
-            mm_per_px = self.calibrate_scale_from_reference(bgr)
-            if mm_per_px is not None:
-                self.scale_state["mm_per_px"] = mm_per_px
+    def measure_objects_full_res(self, bgr, contours, scale, y_lut, object_ids=None):
+        """
+        Đo đối tượng ở độ phân giải gốc từ contour tìm được trên ảnh thu nhỏ
+
+        Chức năng: Phóng contour về khung gốc, chỉ tiền xử lý vùng bbox của từng
+        đối tượng (cân bằng bằng bảng tra y_lut của ảnh thu nhỏ + lọc trung vị),
+        tinh chỉnh biên bằng mask màu HSV ở độ phân giải gốc rồi tính đặc trưng
+        - object_ids: id gán cho từng contour (mặc định 1..n)
+        """
+        frame_h, frame_w = bgr.shape[:2]
+        inv = 1.0 / scale
+        # Lề quanh bbox: đủ cho sai số phóng to và viền của bộ lọc trung vị
+        margin = int(np.ceil(inv)) + 2
+        grow_kernel = self.morph_kernel(int(np.ceil(inv)) * 2 + 1)
+        morph_config = self.config["morphology"]
+        open_kernel = self.morph_kernel(morph_config["open_kernel"])
+        close_kernel = self.morph_kernel(morph_config["close_kernel"])
+        lut = self.get_color_lut()
+        use_dominant = self.use_dominant_color()
 
-        # 5. Trích xuất đặc trưng và phân loại
         results = []
-        for obj_id, contour in enumerate(contours, start=1):
-            obj_mask = np.zeros(mask_clean.shape, dtype=np.uint8)
-            cv2.drawContours(obj_mask, [contour], -1, 255, thickness=-1)
-            features = self.extract_features(denoised, obj_mask, obj_id)
+        if object_ids is None:
+            object_ids = range(1, len(contours) + 1)
+        for obj_id, contour in zip(object_ids, contours):
+            contour_full = np.round((contour.astype(np.float32) + 0.5) * inv - 0.5).astype(np.int32)
+            bx, by, bw, bh = cv2.boundingRect(contour_full)
+            x0, y0 = max(0, bx - margin), max(0, by - margin)
+            x1, y1 = min(frame_w, bx + bw + margin), min(frame_h, by + bh + margin)
+            if x1 <= x0 or y1 <= y0:
+                continue
 
-            if features is not None:
-                classification = self.classify_object(features)
-                features.update(classification)
-                results.append(features)
+            # Tiền xử lý chỉ trong vùng cắt
+            crop = bgr[y0:y1, x0:x1]
+            offset = np.array([x0, y0], dtype=np.int32)
+            ycrcb = cv2.cvtColor(crop, cv2.COLOR_BGR2YCrCb)
+            ycrcb[:, :, 0] = cv2.LUT(ycrcb[:, :, 0], y_lut)
+            crop_denoised = self.denoise(cv2.cvtColor(ycrcb, cv2.COLOR_YCrCb2BGR), method="median", k=3)
+            crop_ctx = FrameContext(crop_denoised)
+
+            # Mask thô phóng từ ảnh thu nhỏ, tinh chỉnh bằng mask màu ở độ phân giải gốc
+            coarse = np.zeros(crop.shape[:2], dtype=np.uint8)
+            cv2.drawContours(coarse, [contour_full - offset], -1, 255, thickness=-1)
+            class_map = self.color_class_map(crop_ctx)
+            refined = cv2.bitwise_and(lut.foreground_mask(class_map), cv2.dilate(coarse, grow_kernel))
+            refined = cv2.morphologyEx(refined, cv2.MORPH_OPEN, open_kernel)
+            refined = cv2.morphologyEx(refined, cv2.MORPH_CLOSE, close_kernel)
+            found, _ = cv2.findContours(refined, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+            if found:
+                obj_contour = max(found, key=cv2.contourArea)
+            else:
+                obj_contour = contour_full - offset
 
-        # 6. Vẽ kết quả (labels không dùng trong hiển thị hiện tại)
-        vis = self.draw_results(denoised, None, results)
+            obj_mask = np.zeros(crop.shape[:2], dtype=np.uint8)
+            cv2.drawContours(obj_mask, [obj_contour], -1, 255, thickness=-1)
+            engine = ObjectStatsEngine.single_object(obj_mask)
+            if engine.area[1] == 0:
+                continue
+            engine.compute(crop_ctx, lut, class_map, self.config["defect"]["dark_delta_T"])
+
+            shape = self.shape_features(obj_contour + offset)
+            colors = engine.object_values(1)
+            if use_dominant:
+                colors.update(self.dominant_color_ratios(engine.object_pixels(crop_ctx.hsv, 1)))
+            results.append(self.assemble_features(obj_id, shape, colors))
+
+        return results
+
+    def set_profiling(self, enabled: bool):
+        """Bật/tắt đo thời gian từng bước của process_frame"""
+        self.timer.set_enabled(enabled)
+        if not enabled:
+            self.last_timings = {}
+
+    def set_track_cache(self, cache):
+        """
+        Bật cache phân loại theo ID tracking (None = tắt)
+
+        Khi bật (TrackClassificationCache), process_frame gán ID tracking cho từng
+        contour ngay sau phân đoạn (kết quả có "tracked_id"); đối tượng đã được xác
+        nhận đủ số khung chỉ cập nhật vị trí, không trích xuất đặc trưng/phân loại lại
+        """
+        self.track_cache = cache
+
+    def contour_bbox(self, contour, scale, roi=None):
+        """Bbox (x, y, w, h) theo tọa độ khung gốc của contour tìm trên ảnh phân đoạn"""
+        x, y, w, h = cv2.boundingRect(contour)
+        if scale < 1.0:
+            x, y, w, h = (int(round(v / scale)) for v in (x, y, w, h))
+        if roi is not None:
+            x, y = x + roi.rect[0], y + roi.rect[1]
+        return x, y, w, h
+
+    def timing_summary(self):
+        """Phân vị p50/p95/p99 (ms) của từng bước trong cửa sổ trượt"""
+        return self.timer.summary()
+
+    def process_frame(self, bgr, return_timings: bool = False, render: bool = True, track_dt: int = 1):
+        """
+        Xử lý một khung hình hoàn chỉnh
+
+        Chức năng: Pipeline chính thực hiện tất cả các bước xử lý.
+        Khi "pyramid.scale" < 1: phân đoạn trên ảnh thu nhỏ, đo kích thước và màu
+        ở độ phân giải gốc chỉ trong bbox của từng đối tượng.
+        Khi bật ROI ("roi"/set_roi): chỉ xử lý vùng cắt, bbox và mask trả về
+        theo tọa độ khung gốc.
+        Khi bật cache tracking (set_track_cache): đối tượng đã xác nhận dùng lại
+        đặc trưng/phân loại đã lưu theo "tracked_id"; track_dt là số frame kể từ
+        khung xử lý trước (governor ở mức "stride" bỏ qua các khung giữa).
+
+        Trả về (vis, results, mask); khi return_timings=True trả thêm dict
+        thời gian (ms) từng bước của khung này (rỗng nếu chưa bật profiling).
+        render=False bỏ bước vẽ, vis trả về là None.
+        """
+        timer = self.timer
+        timer.begin_frame()
+
+        # Chỉ xử lý vùng quan tâm (view của khung gốc, không sao chép)
+        roi = self.get_roi(bgr.shape)
+        frame = roi.crop(bgr) if roi is not None else bgr
+
+        scale = self.get_segmentation_scale()
+        if scale < 1.0:
+            with timer.stage("resize"):
+                h, w = frame.shape[:2]
+                seg_shape = (int(round(h * scale)), int(round(w * scale))) + frame.shape[2:]
+                seg_input = cv2.resize(frame, None, dst=self.buffer("seg_input", seg_shape),
+                                       fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        else:
+            seg_input = frame
+
+        # 1-3. Tiền xử lý, phân đoạn, tách contour
+        roi_mask = roi.mask_for(seg_input.shape) if roi is not None else None
+        raw_ctx, denoised, ctx, mask_clean, contours = self.segment_frame(seg_input, scale, roi_mask)
+
+        # 4. Hiệu chuẩn tỷ lệ (cache / một lần / luồng nền, luôn trên khung gốc)
+        with timer.stage("calibration"):
+            self.update_scale_calibration(bgr, raw_ctx if scale >= 1.0 and roi is None else None)
+
+        # Gán ID tracking; đối tượng đã xác nhận lấy kết quả từ cache, chỉ cập nhật vị trí
+        track_ids = None
+        cached = {}
+        pending = list(range(len(contours)))
+        if self.track_cache is not None:
+            with timer.stage("tracking"):
+                boxes = [self.contour_bbox(contour, scale, roi) for contour in contours]
+                track_ids = self.track_cache.assign(boxes, dt=track_dt)
+                for i, track_id in enumerate(track_ids):
+                    hit = self.track_cache.lookup(track_id, boxes[i])
+                    if hit is not None:
+                        hit["id"] = i + 1
+                        cached[i] = hit
+                pending = [i for i in pending if i not in cached]
+
+        # 5. Trích xuất đặc trưng
+        with timer.stage("features"):
+            if not pending:
+                features_list = []
+            elif scale < 1.0:
+                y_lut = equalization_lut(raw_ctx.ycrcb[:, :, 0])
+                features_list = self.measure_objects_full_res(frame, [contours[i] for i in pending], scale,
+                                                              y_lut, object_ids=[i + 1 for i in pending])
+            else:
+                # Thống kê màu/khuyết tật cho mọi đối tượng trong một lượt trên ảnh nhãn
+                engine = self.compute_object_stats(contours, ctx)
+                features_list = [self.extract_features_from_stats(engine, contours[i], i + 1, ctx)
+                                 for i in pending]
+
+        # Phân loại
+        with timer.stage("classification"):
+            results = []
+            for features in features_list:
+                if features is not None:
+                    classification = self.classify_object(features)
+                    features.update(classification)
+                    results.append(features)
+            if roi is not None:
+                roi.to_frame(results)
+            if track_ids is not None:
+                for features in results:
+                    track_id = track_ids[features["id"] - 1]
+                    if track_id is not None:
+                        features["tracked_id"] = track_id
+                        self.track_cache.store(track_id, features)
+                if cached:
+                    results.extend(cached.values())
+                    results.sort(key=lambda r: r["id"])
 
+        # 6. Vẽ kết quả (labels không dùng trong hiển thị hiện tại)
+        with timer.stage("drawing"):
+            vis = None
+            if roi is not None:
+                # Vẽ và trả mask theo khung gốc; ngoài ROI giữ ảnh gốc, mask = 0
+                if render:
+                    vis = self.draw_results(bgr if scale < 1.0 else roi.paste(bgr, denoised), None, results)
+                mask_clean = roi.full_mask(mask_clean)
+            elif scale < 1.0:
+                if render:
+                    vis = self.draw_results(bgr, None, results)
+                mask_clean = cv2.resize(mask_clean, (bgr.shape[1], bgr.shape[0]), interpolation=cv2.INTER_NEAREST)
+            elif render:
+                vis = self.draw_results(denoised, None, results)
+
+        if timer.enabled:
+            self.last_timings = timer.end_frame()
+        if return_timings:
+            return vis, results, mask_clean, self.last_timings
         return vis, results, mask_clean
 
+    def process_frames(self, frames, render: bool = True):
+        """
+        Xử lý nhiều khung hình trong một lần gọi
+
+        Chức năng: Nhận list ảnh BGR hoặc mảng 4D (N, H, W, 3); ảnh trung gian
+        (YCrCb/HSV/LAB/xám, ảnh lọc, mask tạm) được ghi vào bộ đệm dùng lại cho
+        cả lô, bảng tra màu/kernel/kế hoạch DFT chỉ tạo một lần.
+        Trả về list (vis, results, mask) theo đúng thứ tự đầu vào;
+        render=False bỏ bước vẽ (vis = None) khi chỉ cần kết quả.
+        """
+        if self._batch_buffers is None:
+            self._batch_buffers = FrameBufferPool()
+        # Chuẩn bị trước bảng tra dùng chung cho cả lô
+        self.get_color_lut()
+        self.get_dominant_color_estimator()
+
+        outputs = []
+        self._buffers = self._batch_buffers
+        try:
+            for frame in frames:
+                outputs.append(self.process_frame(frame, render=render))
+        finally:
+            self._buffers = None
+        return outputs
+
+    def process_image_files(self, image_paths, chunk_size: int = 8, render: bool = True):
+        """
+        Đọc và xử lý danh sách file ảnh theo từng lô bằng process_frames
+
+        Trả về generator (path, image, output, elapsed_s, error) theo thứ tự:
+        output là (vis, results, mask) hoặc None nếu lỗi (error là thông báo).
+        Nếu một lô gặp lỗi, các ảnh trong lô được xử lý lại từng ảnh để chỉ
+        ảnh lỗi bị bỏ qua.
+        """
+        chunk_size = max(1, int(chunk_size))
+        # Ảnh trong lô không cách nhau theo thời gian thực: chờ thử lại tính theo khung
+        self.get_scale_calibrator().set_clock("frames")
+        for start in range(0, len(image_paths), chunk_size):
+            chunk = []
+            for path in image_paths[start:start + chunk_size]:
+                image = cv2.imread(path)
+                if image is None:
+                    yield path, None, None, 0.0, "Không thể đọc ảnh"
+                else:
+                    chunk.append((path, image))
+            if not chunk:
+                continue
+
+            t0 = time.time()
+            try:
+                outputs = self.process_frames([image for _, image in chunk], render=render)
+            except Exception:
+                outputs = None
+            if outputs is not None:
+                elapsed = (time.time() - t0) / len(chunk)
+                for (path, image), output in zip(chunk, outputs):
+                    yield path, image, output, elapsed, None
+                continue
+
+            for path, image in chunk:
+                t0 = time.time()
+                try:
+                    output = self.process_frame(image, render=render)
+                except Exception as e:
+                    yield path, image, None, 0.0, str(e)
+                else:
+                    yield path, image, output, time.time() - t0, None
+
     def run_camera(self, camera_id=0):
         """
         Chạy hệ thống với camera thời gian thực
 
         Chức năng: Xử lý video stream từ camera và hiển thị kết quả
         """
-        cap = cv2.VideoCapture(camera_id)
-
-        if not cap.isOpened():
+        # Đọc camera trên luồng riêng: vòng lặp luôn lấy khung mới nhất
+        capture = CaptureThread.from_config(camera_id, self.config)
+        if not capture.start():
             print("Không thể mở camera!")
             return
 
+        # Hiệu chuẩn trên luồng nền để không chặn vòng lặp camera
+        self.set_camera_key(f"camera{camera_id}")
+        self.set_calibration_mode("background")
+        # Tự giảm chất lượng khi không kịp FPS mục tiêu (mục "governor")
+        governor = LoadGovernor.from_config(self)
+
         print("Nhấn 's' để lưu kết quả, 'ESC' để thoát")
 
         frame_count = 0
         start_time = time.time()
 
         while True:
-            ret, frame = cap.read()
+            ret, captured = capture.read()
             if not ret:
                 break
+            frame = captured.frame
 
             # Xử lý khung hình
-            vis, results, mask = self.process_frame(frame)
+            vis, results, mask = governor.process(frame)
 
             # Tính FPS
             frame_count += 1
             if frame_count % 30 == 0:
                 elapsed = time.time() - start_time
                 fps = 30 / elapsed
-                print(f"FPS: {fps:.1f}")
+                timing = self.timer.format_status()
+                print(f"FPS: {fps:.1f} | trễ {captured.age_ms():.0f} ms, bỏ {capture.dropped} khung"
+                      f" | {governor.format_status()}"
+                      + (f" | {governor.motion_gate.format_status()}" if governor.motion_gate else "")
+                      + (f" | {timing}" if timing else ""))
                 start_time = time.time()
 
             # Hiển thị
@@ -596,7 +1304,8 @@ class FruitClassificationSystem:
                 cv2.imwrite(f"result_{timestamp}.jpg", vis)
                 print(f"Đã lưu kết quả: result_{timestamp}.jpg")
 
-        cap.release()
+        capture.stop()
+        governor.reset()
         cv2.destroyAllWindows()
 
     def save_results(self, results):
@@ -4,7 +4,6 @@
 import os
 import cv2
 import json
-import time
 import threading
 import tkinter as tk
 import pandas as pd
@@ -150,6 +149,10 @@ except Exception:
     fetch_captures_with_counts = None  # type: ignore
     fetch_classifications_by_capture = None  # type: ignore
 
+from async_writer import AsyncImageWriter
+from capture import CaptureThread
+from governor import LoadGovernor, MotionGate
+
 # Thử import FruitClassificationSystem từ main.py, đưa ra thông báo rõ ràng nếu thiếu
 try:
     from main import FruitClassificationSystem
@@ -186,10 +189,14 @@ class MainGUIInterface:
         self._product_id = None
         self.last_results = None
         self.last_image_path = None
+        self._writer = None  # AsyncImageWriter cho ảnh chụp camera
 
         # Tuỳ chọn hiển thị/hiệu năng (sẽ tạo widget trong create_control_panel)
         self.hide_text_var = tk.BooleanVar(value=True)  # Chỉ vẽ khung, không vẽ chữ lên video
-        self.fast_start_var = tk.BooleanVar(value=True)  # Mở nhanh: bỏ auto-calibrate khung đầu
+        self.fast_start_var = tk.BooleanVar(value=True)  # Mở nhanh: hiệu chuẩn mm/px chạy nền, không chặn khung đầu
+        self.profiling_var = tk.BooleanVar(value=False)  # Đo thời gian từng bước, hiện trên thanh trạng thái
+        self.governor_var = tk.BooleanVar(value=False)  # Tự giảm chất lượng để giữ FPS
+        self.motion_gate_var = tk.BooleanVar(value=False)  # Bỏ qua khung khi cảnh không đổi
         self.display_size_var = tk.StringVar(value="960x540")  # kích thước hiển thị camera
         self._display_wh = (960, 540)
 
@@ -381,8 +388,17 @@ class MainGUIInterface:
         tk.Checkbutton(opts_frame, text="Chỉ khung (không chữ)",
                        variable=self.hide_text_var, bg='#e8f4fd').pack(side=tk.LEFT, padx=(6, 15))
 
-        tk.Checkbutton(opts_frame, text="Mở nhanh (bỏ hiệu chuẩn khung đầu)",
-                       variable=self.fast_start_var, bg='#e8f4fd').pack(side=tk.LEFT)
+        tk.Checkbutton(opts_frame, text="Mở nhanh (hiệu chuẩn chạy nền)",
+                       variable=self.fast_start_var, bg='#e8f4fd').pack(side=tk.LEFT, padx=(0, 15))
+
+        tk.Checkbutton(opts_frame, text="Đo thời gian",
+                       variable=self.profiling_var, bg='#e8f4fd').pack(side=tk.LEFT, padx=(0, 15))
+
+        tk.Checkbutton(opts_frame, text="Giữ FPS (tự giảm chất lượng)",
+                       variable=self.governor_var, bg='#e8f4fd').pack(side=tk.LEFT, padx=(0, 15))
+
+        tk.Checkbutton(opts_frame, text="Bỏ khung tĩnh",
+                       variable=self.motion_gate_var, bg='#e8f4fd').pack(side=tk.LEFT)
 
         # --- chọn kích thước hiển thị/capture ---
         size_frame = tk.Frame(mode2_frame, bg='#e8f4fd')
@@ -465,6 +481,11 @@ class MainGUIInterface:
                                    bg='#34495e', fg='#bdc3c7', font=('Arial', 9))
         self.time_label.pack(side=tk.RIGHT, padx=10, pady=5)
 
+        # Thời gian xử lý theo bước (chỉ có nội dung khi bật "Đo thời gian")
+        self.perf_label = tk.Label(status_frame, text="",
+                                   bg='#34495e', fg='#bdc3c7', font=('Arial', 9))
+        self.perf_label.pack(side=tk.RIGHT, padx=10, pady=5)
+
         self.update_time()
 
     def update_time(self):
@@ -551,6 +572,9 @@ class MainGUIInterface:
     def update_status(self, message: str):
         self.status_label.config(text=message)
 
+    def update_perf_status(self, text: str):
+        self.perf_label.config(text=text)
+
     def update_results(self, text: str):
         self.results_text.config(state=tk.NORMAL)
         timestamp = datetime.now().strftime("%H:%M:%S")
@@ -688,24 +712,25 @@ class MainGUIInterface:
             batch_results = []
             processed_count = 0
 
-            for i, image_path in enumerate(image_files):
+            # Ảnh kết quả/mask được ghi trên luồng nền trong khi xử lý ảnh tiếp theo
+            writer = AsyncImageWriter.from_config(system.config)
+
+            # Đọc và xử lý theo lô (process_frames dùng lại bộ đệm giữa các ảnh)
+            outputs = system.process_image_files(image_files)
+            for i, (image_path, image, output, process_time, error) in enumerate(outputs):
                 try:
                     progress = f"Xử lý {i + 1}/{len(image_files)}: {os.path.basename(image_path)}"
                     self.root.after(0, lambda p=progress: self.update_status(p))
 
-                    image = cv2.imread(image_path)
-                    if image is None:
-                        raise ValueError("Không thể đọc ảnh")
-
-                    start_time = time.time()
-                    vis, results, mask = system.process_frame(image)
-                    process_time = time.time() - start_time
+                    if output is None:
+                        raise ValueError(error)
+                    vis, results, mask = output
 
                     base_name = os.path.splitext(os.path.basename(image_path))[0]
                     result_path = os.path.join(output_dir, f"{base_name}_result.jpg")
-                    mask_path = os.path.join(output_dir, f"{base_name}_mask.jpg")
-                    cv2.imwrite(result_path, vis)
-                    cv2.imwrite(mask_path, mask)
+                    mask_path = writer.mask_path(output_dir, base_name)
+                    writer.write_image(result_path, vis)
+                    writer.write_image(mask_path, mask)
 
                     valid_results = [r for r in results if r is not None]
                     batch_results.extend(valid_results)
@@ -737,6 +762,9 @@ class MainGUIInterface:
                     self.root.after(0, lambda t=error_text: self.update_results(t))
                     continue
 
+            # Chờ ghi xong ảnh trước khi mở bảng tổng hợp (bảng đọc lại ảnh kết quả)
+            writer.close()
+
             # Báo cáo tổng hợp
             self.create_batch_report(batch_results, output_dir, processed_count, len(image_files))
 
@@ -797,9 +825,16 @@ class MainGUIInterface:
             if hasattr(self.current_system, "set_render_mode"):
                 self.current_system.set_render_mode("boxes_only" if self.hide_text_var.get() else "full")
 
-            # Mở nhanh: bỏ auto-calibrate ở khung đầu để khởi động nhanh
-            if self.fast_start_var.get():
-                self.current_system.scale_state["mm_per_px"] = 1.0  # không None => bỏ calibrate tự động
+            # Đo thời gian từng bước (p50/p95 hiện trên thanh trạng thái)
+            if hasattr(self.current_system, "set_profiling"):
+                self.current_system.set_profiling(self.profiling_var.get())
+
+            # Hiệu chuẩn mm/px: dùng giá trị đã lưu cho camera này nếu có
+            if hasattr(self.current_system, "set_camera_key"):
+                self.current_system.set_camera_key(f"camera{camera_id}")
+                # Mở nhanh: không chặn khung đầu, dò vật tham chiếu trên luồng nền
+                if self.fast_start_var.get():
+                    self.current_system.set_calibration_mode("background")
 
             # Test mở camera (ưu tiên CAP_DSHOW trên Windows) + giảm buffer + set kích thước
             try:
@@ -849,24 +884,17 @@ class MainGUIInterface:
     def camera_processing_loop(self, camera_id: int):
         # mở cam theo backend nhanh hơn
         w, h = getattr(self, "_display_wh", (960, 540))
-        cap = None
+        capture = None
         video_writer = None
 
         try:
-            # Khởi tạo camera với error handling tốt hơn
-            try:
-                cap = cv2.VideoCapture(camera_id, cv2.CAP_DSHOW)
-            except Exception:
-                cap = cv2.VideoCapture(camera_id)
-
-            if not cap.isOpened():
+            # Đọc camera trên luồng riêng, vòng lặp xử lý luôn lấy khung mới nhất
+            config = self.current_system.config if self.current_system is not None else {}
+            capture = CaptureThread.from_config(camera_id, config, width=w, height=h, fps=30,
+                                                backend=cv2.CAP_DSHOW)
+            if not capture.start():
                 raise Exception(f"Không thể mở camera {camera_id}")
 
-            cap.set(cv2.CAP_PROP_FRAME_WIDTH, w)
-            cap.set(cv2.CAP_PROP_FRAME_HEIGHT, h)
-            cap.set(cv2.CAP_PROP_FPS, 30)
-            cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
-
             # ép kích thước cửa sổ hiển thị
             cv2.namedWindow("Camera - Phan loai san pham", cv2.WINDOW_NORMAL)
             cv2.resizeWindow("Camera - Phan loai san pham", w, h)
@@ -886,16 +914,22 @@ class MainGUIInterface:
             if self.current_system is None:
                 raise Exception("Hệ thống xử lý chưa được khởi tạo")
 
+            # Bộ điều tiết tải: mức chất lượng hiện trên thanh trạng thái
+            governor = LoadGovernor.from_config(self.current_system, enabled=self.governor_var.get())
+            if self.motion_gate_var.get() and governor.motion_gate is None:
+                governor.motion_gate = MotionGate()
+
             while self.is_camera_running:
-                ret, frame = cap.read()
+                ret, captured = capture.read()
                 if not ret:
                     self.root.after(0, lambda: self.update_status("Không thể đọc frame từ camera"))
                     break
+                frame = captured.frame
                 frame_count += 1
 
                 try:
                     # Xử lý frame với error handling
-                    vis, results, mask = self.current_system.process_frame(frame)
+                    vis, results, mask = governor.process(frame)
 
                     # Kiểm tra kết quả xử lý
                     if vis is None or mask is None:
@@ -925,6 +959,16 @@ class MainGUIInterface:
                     self.root.after(0, lambda v=valid_results: self.update_live_table(v))
                     if valid_results:
                         self.update_camera_statistics(valid_results, frame_count)
+                    perf_parts = []
+                    if governor.enabled:
+                        perf_parts.append(f"Chất lượng {governor.format_status()}")
+                    if governor.motion_gate is not None:
+                        perf_parts.append(f"Bỏ khung tĩnh {governor.motion_gate.skipped_fraction() * 100:.0f}%")
+                    if self.current_system.timer.enabled:
+                        perf_parts.append(self.current_system.timer.format_status())
+                    perf_parts.append(f"Trễ {capture.last_latency_ms:.0f} ms | bỏ {capture.dropped}")
+                    perf_text = " | ".join(p for p in perf_parts if p)
+                    self.root.after(0, lambda t=perf_text: self.update_perf_status(t))
 
                 # Ghi video nếu cần
                 if video_writer is not None:
@@ -946,8 +990,8 @@ class MainGUIInterface:
             self.root.after(0, lambda: messagebox.showerror("Lỗi Camera", f"Lỗi xử lý camera:\n{str(e)}"))
         finally:
             # Cleanup resources
-            if cap is not None:
-                cap.release()
+            if capture is not None:
+                capture.stop()
             if video_writer is not None:
                 video_writer.release()
             cv2.destroyAllWindows()
@@ -1015,8 +1059,10 @@ class MainGUIInterface:
         fruit_name = self.selected_fruit.get()
         original_path = f"camera_original_{fruit_name}_{timestamp}.jpg"
         result_path = f"camera_result_{fruit_name}_{timestamp}.jpg"
-        cv2.imwrite(original_path, original)
-        cv2.imwrite(result_path, processed)
+        # Ghi trên luồng nền để không chặn vòng lặp camera
+        writer = self.get_writer()
+        writer.write_image(original_path, original, copy=True)
+        writer.write_image(result_path, processed, copy=True)
 
         data = {
             'timestamp': timestamp,
@@ -1026,8 +1072,7 @@ class MainGUIInterface:
             'files': {'original': original_path, 'processed': result_path}
         }
         data_path = f"camera_data_{fruit_name}_{timestamp}.json"
-        with open(data_path, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=2, ensure_ascii=False, default=str)
+        writer.write_json(data_path, data)
         self.update_results(f"Đã lưu frame: {timestamp}")
 
         # Cập nhật last_* và lưu DB nếu bật
@@ -1041,6 +1086,13 @@ class MainGUIInterface:
             except Exception as db_e:
                 self.update_results(f"DB lỗi: {db_e}")
 
+    def get_writer(self):
+        """Bộ ghi ảnh nền dùng chung cho ảnh chụp từ camera (tạo khi cần, theo mục "output")"""
+        if self._writer is None:
+            config = self.current_system.config if self.current_system is not None else {}
+            self._writer = AsyncImageWriter.from_config(config)
+        return self._writer
+
     def create_batch_report(self, results, output_dir: str, processed_count: int, total_files: int):
         from collections import Counter
         if not results:
@@ -2323,6 +2375,9 @@ class MainGUIInterface:
     def on_closing(self):
         if self.is_camera_running:
             self.stop_camera()
+        # Ghi nốt ảnh chụp còn trong hàng đợi
+        if self._writer is not None:
+            self._writer.close()
         # Cleanup tất cả file tạm
         for fruit_key in self.fruit_configs.keys():
             temp_file = f"temp_{fruit_key}_config.json"
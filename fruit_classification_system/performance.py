@@ -0,0 +1,173 @@
+# performance.py - Đo thời gian từng bước xử lý và thống kê phân vị
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+
+class _StageScope:
+    """Khối `with` đo thời gian một bước và cộng dồn vào khung hiện tại"""
+
+    __slots__ = ("timer", "name", "start")
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.timer.record(self.name, (time.perf_counter() - self.start) * 1000.0)
+        return False
+
+
+class _NullScope:
+    """Khối `with` rỗng dùng khi tắt đo thời gian (không cấp phát, không gọi đồng hồ)"""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NULL_SCOPE = _NullScope()
+
+
+class StageTimer:
+    # Thứ tự hiển thị các bước của process_frame
+    # ("dominant_color" nằm bên trong "features": thời gian của nó cũng được tính vào "features")
+    STAGES = ("resize", "background", "equalization", "denoise", "hsv_mask", "otsu", "clean_mask",
+              "contours", "calibration", "tracking", "features", "dominant_color", "classification",
+              "drawing", "total")
+
+    def __init__(self, enabled=False, window=300):
+        """
+        Bộ đo thời gian theo bước xử lý
+
+        Chức năng: Ghi thời gian (ms) từng bước trong một khung hình, giữ cửa sổ
+        trượt `window` khung gần nhất để tính p50/p95/p99. Khi tắt, stage() trả
+        về khối rỗng dùng chung nên chi phí chỉ là một lần gọi hàm.
+        """
+        self.enabled = bool(enabled)
+        self.window = max(1, int(window))
+        self.history = {}
+        self.last = {}
+        self.frames = 0
+        self._current = {}
+        self._frame_start = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        """Tạo bộ đo từ mục "profiling" của cấu hình"""
+        cfg = config.get("profiling", {})
+        return cls(enabled=cfg.get("enabled", False), window=cfg.get("window", 300))
+
+    def set_enabled(self, enabled: bool):
+        """Bật/tắt đo thời gian (giữ nguyên lịch sử đã có)"""
+        self.enabled = bool(enabled)
+        self._frame_start = None
+
+    def reset(self):
+        """Xóa toàn bộ lịch sử đo"""
+        with self._lock:
+            self.history = {}
+            self.last = {}
+            self.frames = 0
+        self._current = {}
+        self._frame_start = None
+
+    def stage(self, name):
+        """Khối `with` đo một bước; gọi nhiều lần trong khung thì cộng dồn"""
+        if not self.enabled:
+            return _NULL_SCOPE
+        return _StageScope(self, name)
+
+    def record(self, name, ms):
+        """Cộng thời gian (ms) của bước name vào khung hiện tại"""
+        self._current[name] = self._current.get(name, 0.0) + ms
+
+    def begin_frame(self):
+        """Bắt đầu đo một khung mới"""
+        if not self.enabled:
+            return
+        self._current = {}
+        self._frame_start = time.perf_counter()
+
+    def end_frame(self):
+        """
+        Kết thúc khung: thêm "total" và đưa thời gian các bước vào cửa sổ trượt
+
+        Trả về dict {bước: ms} của khung vừa xong ({} khi đang tắt)
+        """
+        if not self.enabled or self._frame_start is None:
+            return {}
+        timings = self._current
+        timings["total"] = (time.perf_counter() - self._frame_start) * 1000.0
+        self._current = {}
+        self._frame_start = None
+        with self._lock:
+            for name, ms in timings.items():
+                samples = self.history.get(name)
+                if samples is None:
+                    samples = self.history[name] = deque(maxlen=self.window)
+                samples.append(ms)
+            self.last = timings
+            self.frames += 1
+        return dict(timings)
+
+    def percentiles(self, name, quantiles=(50, 95, 99)):
+        """Phân vị (ms) của bước name trong cửa sổ trượt; None nếu chưa có mẫu"""
+        with self._lock:
+            samples = self.history.get(name)
+            if not samples:
+                return None
+            values = np.fromiter(samples, dtype=np.float64, count=len(samples))
+        return dict(zip((f"p{q}" for q in quantiles), np.percentile(values, quantiles).tolist()))
+
+    def summary(self):
+        """
+        Thống kê mọi bước đã đo theo thứ tự STAGES
+
+        Trả về {bước: {"last", "p50", "p95", "p99", "count"}}
+        """
+        with self._lock:
+            names = [s for s in self.STAGES if s in self.history]
+            names += sorted(s for s in self.history if s not in self.STAGES)
+            snapshot = {name: np.fromiter(self.history[name], dtype=np.float64,
+                                          count=len(self.history[name]))
+                        for name in names}
+            last = dict(self.last)
+
+        out = {}
+        for name, values in snapshot.items():
+            if values.size == 0:
+                continue
+            p50, p95, p99 = np.percentile(values, (50, 95, 99)).tolist()
+            out[name] = {"last": last.get(name, 0.0), "p50": p50, "p95": p95,
+                         "p99": p99, "count": int(values.size)}
+        return out
+
+    def top_stages(self, n=3, key="p95"):
+        """n bước tốn thời gian nhất (bỏ "total") theo phân vị key"""
+        stats = self.summary()
+        ranked = sorted(((name, s[key]) for name, s in stats.items() if name != "total"),
+                        key=lambda item: item[1], reverse=True)
+        return ranked[:n]
+
+    def format_status(self, n=3):
+        """Chuỗi ngắn cho thanh trạng thái, ví dụ 'total p50 18.2/p95 25.1 ms | otsu 6.3 ...'"""
+        stats = self.summary()
+        total = stats.get("total")
+        if total is None:
+            return ""
+        parts = [f"total p50 {total['p50']:.1f}/p95 {total['p95']:.1f} ms"]
+        parts += [f"{name} {ms:.1f}" for name, ms in self.top_stages(n)]
+        return " | ".join(parts)
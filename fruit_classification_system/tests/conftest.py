@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Các module của hệ thống được import trực tiếp (vd. "from frame_analysis import ...")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
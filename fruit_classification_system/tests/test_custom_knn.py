@@ -0,0 +1,35 @@
+"""CustomKNN: save()/load() cho cùng kết quả dự đoán với mô hình vừa fit"""
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from advanced_features import CustomKNN  # noqa: E402
+
+
+def make_dataset(n=600, n_features=4, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.uniform(-5, 5, size=(3, n_features))
+    y = rng.integers(0, 3, size=n)
+    X = (centers[y] + rng.normal(0, 1.5, size=(n, n_features))).astype(np.float32)
+    labels = np.array(["Xanh", "Chín", "Hỏng"])[y]
+    return X, labels
+
+
+@pytest.mark.parametrize("algorithm", ["brute", "kd_tree", "ivf"])
+@pytest.mark.parametrize("standardize", [False, True])
+def test_save_load_round_trip(tmp_path, algorithm, standardize):
+    if algorithm == "kd_tree":
+        pytest.importorskip("scipy")
+    X, y = make_dataset()
+    queries = make_dataset(n=120, seed=1)[0]
+
+    knn = CustomKNN(k=5, algorithm=algorithm, n_lists=12, n_probe=3, standardize=standardize)
+    knn.fit(X, y)
+    knn.save(tmp_path / "knn")
+
+    for mmap_mode in ("r", None):
+        loaded = CustomKNN.load(tmp_path / "knn", mmap_mode=mmap_mode)
+        assert loaded.X_train.dtype == np.float32
+        np.testing.assert_array_equal(loaded.predict(queries), knn.predict(queries))
+        np.testing.assert_array_equal(loaded.predict_proba(queries), knn.predict_proba(queries))
+        assert loaded.predict(queries[:0]).shape == (0,)
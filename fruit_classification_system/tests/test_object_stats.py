@@ -0,0 +1,58 @@
+"""
+So sánh thống kê đối tượng một lượt (ObjectStatsEngine) với cách tính từng
+đối tượng của bản gốc (mask contour tô kín + extract_features) trên cảnh tổng hợp
+"""
+import json
+import os
+
+import pytest
+
+np = pytest.importorskip("numpy")
+cv2 = pytest.importorskip("cv2")
+
+from benchmark import SyntheticSceneGenerator  # noqa: E402
+from main import FruitClassificationSystem  # noqa: E402
+
+CONFIG_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "config.json")
+
+
+@pytest.fixture
+def system(tmp_path):
+    with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
+        config = json.load(f)
+    config["reference_object"] = dict(config.get("reference_object", {}),
+                                      mode="off", cache_file=str(tmp_path / "scale_calibration.json"))
+    config["pyramid"] = {"scale": 1.0}
+    return FruitClassificationSystem(config=config)
+
+
+def baseline_features(system, frame):
+    """Đặc trưng theo pipeline gốc: mỗi contour một mask tô kín"""
+    _, denoised, ctx, mask_clean, contours = system.segment_frame(frame)
+    features = []
+    for obj_id, contour in enumerate(contours, start=1):
+        obj_mask = np.zeros(mask_clean.shape, dtype=np.uint8)
+        cv2.drawContours(obj_mask, [contour], -1, 255, thickness=-1)
+        features.append(system.extract_features(denoised, obj_mask, obj_id, ctx))
+    return features
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_object_stats_match_per_object_masks(system, seed):
+    generator = SyntheticSceneGenerator(640, 480, 6, system.config, seed=seed, defect_every=2)
+    frame, truth = generator.generate()
+
+    expected = [f for f in baseline_features(system, frame) if f is not None]
+    _, results, _ = system.process_frame(frame, render=False)
+
+    assert len(results) == len(expected)
+    # Cảnh có quả khuyết tật: đốm tối (lỗ trong mask) phải được tính
+    assert any(t["defect"] for t in truth)
+    assert any(f["defect_ratio"] > 0 for f in expected)
+
+    ratio_keys = [k for k in expected[0] if k.startswith("ratio_")] + ["defect_ratio"]
+    for result, reference in zip(results, expected):
+        assert result["id"] == reference["id"]
+        for key in ratio_keys:
+            assert result[key] == pytest.approx(reference[key], abs=1e-3), key
+        assert result["defect"] == system.classify_object(reference)["defect"]